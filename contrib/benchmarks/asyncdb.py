@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Benchmark of the reactor stalls caused by the SMS DB
+
+Several modems receive SMS at the same time, every one of them is filed
+in the SMS DB as soon as it arrives. A probe scheduled every
+:data:`PROBE_INTERVAL` seconds measures how late the reactor runs it,
+that is how long the serial ports and DBus would have waited. The SMS
+are filed with the SmsProvider on the reactor thread, as it used to be
+done, and with the AsyncProvider. Run it from the top of the tree::
+
+    python contrib/benchmarks/asyncdb.py [messages] [modems]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, succeed
+from twisted.internet.task import LoopingCall
+
+from wader.common.asyncdb import AsyncProvider
+from wader.common.provider import SmsProvider, Message, inbox_folder
+from wader.common.utils import get_tz_aware_now
+
+# seconds between two probes
+PROBE_INTERVAL = 0.005
+# seconds between two SMS received by the same modem
+ARRIVAL_INTERVAL = 0.01
+
+
+class SyncIngest(object):
+    """Files the SMS on the reactor thread"""
+
+    def __init__(self, path):
+        self.provider = SmsProvider(path)
+        self.provider.add_folder(inbox_folder)
+
+    def add_sms(self, sms):
+        sms.thread = self.provider.get_thread_by_number(sms.number)
+        self.provider.add_sms(sms)
+        return succeed(None)
+
+    def close(self):
+        self.provider.close()
+        return succeed(None)
+
+
+class AsyncIngest(object):
+    """Files the SMS with the AsyncProvider"""
+
+    def __init__(self, path):
+        self.provider = AsyncProvider(lambda: SmsProvider(path))
+        self.provider.write('add_folder', inbox_folder)
+
+    def add_sms(self, sms):
+
+        def add_sms(thread):
+            sms.thread = thread
+            return self.provider.write('add_sms', sms)
+
+        d = self.provider.write('get_thread_by_number', sms.number)
+        d.addCallback(add_sms)
+        return d
+
+    def close(self):
+        return self.provider.close()
+
+
+def run(ingest, messages, modems):
+    """
+    Files ``messages`` SMS received by ``modems`` modems with ``ingest``
+
+    :return: a Deferred that fires with the probe delays and the seconds
+        it took to file them all
+    """
+    delays = []
+    last = [time.time()]
+
+    def probe():
+        now = time.time()
+        delays.append(max(now - last[0] - PROBE_INTERVAL, 0))
+        last[0] = now
+
+    loop = LoopingCall(probe)
+    loop.start(PROBE_INTERVAL)
+
+    start = time.time()
+    done = Deferred()
+    ds = []
+
+    def receive(count):
+        sms = Message(number='+3460000%04d' % (count % 50), text='x' * 100,
+                      _datetime=get_tz_aware_now())
+        ds.append(ingest.add_sms(sms))
+        if count + modems < messages:
+            reactor.callLater(ARRIVAL_INTERVAL, receive, count + modems)
+        elif len(ds) == messages:
+            # every SMS has arrived, wait for the ones being filed
+            d = DeferredList(ds, fireOnOneErrback=True)
+            d.addCallback(lambda _: loop.stop())
+            d.addCallback(lambda _: done.callback((delays,
+                                                   time.time() - start)))
+
+    for modem in range(modems):
+        reactor.callLater(0, receive, modem)
+
+    return done
+
+
+def main(messages=2000, modems=4):
+    messages, modems = int(messages), int(modems)
+    print "%d SMS from %d modems" % (messages, modems)
+    print "%-8s %14s %14s %14s" % ('provider', 'max stall (ms)',
+                                   'p99 stall (ms)', 'elapsed (s)')
+
+    def measure(_, name, cls):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        ingest = cls(path)
+
+        def report((delays, elapsed)):
+            delays.sort()
+            p99 = delays[int(len(delays) * 0.99)]
+            print "%-8s %14.1f %14.1f %14.2f" % (name, delays[-1] * 1000,
+                                                 p99 * 1000, elapsed)
+            return ingest.close()
+
+        def cleanup(ret):
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+            return ret
+
+        d = run(ingest, messages, modems)
+        d.addCallback(report)
+        d.addBoth(cleanup)
+        return d
+
+    d = succeed(None)
+    for name, cls in [('sync', SyncIngest), ('async', AsyncIngest)]:
+        d.addCallback(measure, name, cls)
+
+    d.addErrback(lambda failure: failure.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
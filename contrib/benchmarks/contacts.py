@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Benchmark of the SQLite contact provider searches and imports
+
+Fills contact DBs of several sizes and compares searching them by name
+and number with LIKE, as it used to be done, and with the indexes. Then
+it compares adding the contacts one by one with the batched import. Run
+it from the top of the tree::
+
+    python contrib/benchmarks/contacts.py [contacts ...]
+"""
+
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import wader.plugins
+wader.plugins.__path__.append(os.path.join(os.path.dirname(__file__), '..',
+                                           '..', 'plugins', 'contacts',
+                                           'sqlite', 'wader', 'plugins'))
+
+from wader.plugins.sqlite_provider import SQLiteContactProvider, SQLContact
+
+# largest DB filled with add_contact, bigger ones take too long
+MAX_ADD_CONTACT = 10000
+random.seed(0)
+FIRST_NAMES = [''.join([random.choice(string.ascii_lowercase)
+                        for j in range(random.randint(3, 8))]).capitalize()
+               for i in range(500)]
+LAST_NAMES = [''.join([random.choice(string.ascii_lowercase)
+                       for j in range(random.randint(4, 10))]).capitalize()
+              for i in range(2000)]
+
+
+def get_contacts(size):
+    for i in range(size):
+        name = u'%s %s' % (random.choice(FIRST_NAMES),
+                           random.choice(LAST_NAMES))
+        yield SQLContact(name, '+346%08d' % random.randint(0, 99999999))
+
+
+def find_by_name_like(provider, name):
+    """The name search as it used to be"""
+    c = provider.cursor
+    c.execute("select * from contact where name like ?", ('%%%s%%' % name,))
+    return c.fetchall()
+
+
+def find_by_number_like(provider, number):
+    """The number search as it used to be"""
+    c = provider.cursor
+    c.execute("select * from contact where number like ?",
+              ('%%%s%%' % number,))
+    return c.fetchall()
+
+
+def measure(func, *args):
+    """Returns the mean milliseconds ``func(*args)`` takes"""
+    repeat = 20
+    start = time.time()
+    for i in range(repeat):
+        func(*args)
+
+    return (time.time() - start) * 1000 / repeat
+
+
+def fill(size, bulk):
+    """Returns a provider with ``size`` contacts and the ms it took"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    os.unlink(path)
+    provider = SQLiteContactProvider()
+    provider.initialize(dict(path=path, mcc='21401'))
+    start = time.time()
+    if bulk:
+        provider.import_contacts(get_contacts(size))
+    else:
+        for contact in get_contacts(size):
+            # one autocommit transaction per contact
+            provider.add_contact(contact)
+
+    return provider, path, (time.time() - start) * 1000
+
+
+def main(*sizes):
+    sizes = map(int, sizes) or [1000, 10000, 50000]
+    for size in sizes:
+        provider, path, bulk = fill(size, True)
+        try:
+            number = provider.list_contacts()[size / 2].number
+            searches = [
+                ('name', FIRST_NAMES[0][:3], find_by_name_like,
+                 provider.find_contacts_by_name),
+                ('name', LAST_NAMES[7], find_by_name_like,
+                 provider.find_contacts_by_name),
+                ('number', number, find_by_number_like,
+                 provider.find_contacts_by_number),
+                ('number', number[:7], find_by_number_like,
+                 provider.find_contacts_by_number),
+            ]
+            for kind, text, like, indexed in searches:
+                print "%-8d %-6s %-14r like %8.2f indexed %8.2f (ms)" % (
+                    size, kind, text, measure(like, provider, text),
+                    measure(indexed, text))
+        finally:
+            provider.close()
+            os.unlink(path)
+
+        if size <= MAX_ADD_CONTACT:
+            provider, path, one_by_one = fill(size, False)
+            provider.close()
+            os.unlink(path)
+            one_by_one = "%8.1f" % one_by_one
+        else:
+            one_by_one = "%8s" % '-'
+        print "%-8d import add_contact %s import_contacts %8.1f (ms)" % (
+            size, one_by_one, bulk)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Benchmark of the mobile-broadband-provider-info import
+
+Imports the given serviceproviders.xml, the installed one by default,
+into an empty networks DB and reports the time it took and the peak
+memory of the process. Run it from the top of the tree::
+
+    python contrib/benchmarks/mbpi.py [serviceproviders.xml]
+"""
+
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from wader.common.consts import MBPI
+from wader.common.provider import NetworkProvider
+
+
+def main(xmlfile=MBPI):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    provider = NetworkProvider(path)
+    try:
+        start = time.time()
+        provider.populate_networks_from_mbpi(xmlfile)
+        elapsed = time.time() - start
+
+        c = provider.conn.cursor()
+        c.execute("select count(*) from network_info")
+        networks = c.fetchone()[0]
+        c.execute("select count(*) from apn")
+        apns = c.fetchone()[0]
+    finally:
+        provider.close()
+        os.unlink(path)
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%s (%d bytes)" % (xmlfile, os.path.getsize(xmlfile))
+    print "%d networks, %d APNs" % (networks, apns)
+    print "%.3fs, peak RSS %d KB" % (elapsed, peak)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Benchmark of the operator lookups by IMSI
+
+Looks up an IMSI of every MCC/MNC in the given networks DB, the installed
+one by default, with a query per candidate prefix, with the single query
+of ``NetworkProvider.get_network_by_id`` and with the ``NetworkTrie``.
+Run it from the top of the tree::
+
+    python contrib/benchmarks/networks.py [networks.db]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from wader.common.consts import NETWORKS_DB
+from wader.common.provider import (NetworkProvider, NetworkOperator,
+                                   NetworkTrie, NETWORK_OPERATOR_QUERY,
+                                   IMSI_PREFIX_LENGTHS)
+
+REPEAT = 5
+
+
+def lookup_per_prefix(provider, imsi):
+    """The lookup as it used to be, one query per candidate prefix"""
+    c = provider.conn.cursor()
+    for n in IMSI_PREFIX_LENGTHS:
+        c.execute(NETWORK_OPERATOR_QUERY + " where n.id=?", (imsi[:n],))
+        ret = [NetworkOperator.from_row(row[1:], row[0])
+               for row in c.fetchall()]
+        if ret:
+            return ret
+
+    return []
+
+
+def measure(func, imsis):
+    """Returns the mean microseconds a lookup takes"""
+    start = time.time()
+    for i in range(REPEAT):
+        for imsi in imsis:
+            func(imsi)
+
+    return (time.time() - start) * 10 ** 6 / (REPEAT * len(imsis))
+
+
+def main(path=NETWORKS_DB):
+    provider = NetworkProvider(path)
+    try:
+        c = provider.conn.cursor()
+        c.execute("select id from network_info")
+        # pad every MCC/MNC to a whole IMSI
+        imsis = [(row[0] + '0' * 15)[:15] for row in c.fetchall()]
+
+        start = time.time()
+        trie = NetworkTrie.from_provider(provider)
+        build = (time.time() - start) * 1000
+
+        for imsi in imsis:
+            expected = [(n.netid, n.apn) for n in
+                        lookup_per_prefix(provider, imsi)]
+            for func in [provider.get_network_by_id, trie.get_network_by_id]:
+                assert [(n.netid, n.apn) for n in func(imsi)] == expected
+
+        print "%s: %d networks" % (path, len(imsis))
+        print "trie built in %.3f ms" % build
+        print "%-12s %12s" % ('lookup', 'mean (us)')
+        for name, func in [
+                ('per prefix', lambda imsi: lookup_per_prefix(provider, imsi)),
+                ('one query', provider.get_network_by_id),
+                ('trie', trie.get_network_by_id)]:
+            print "%-12s %12.3f" % (name, measure(func, imsis))
+    finally:
+        provider.close()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Benchmark of the SmsProvider listings, searches and imports
+
+Fills SMS DBs with mailboxes of several sizes and compares listing every
+message and thread with a query per row for its thread and folder, as
+it used to be done, and with the JOIN based listings. Then it compares
+searching the messages with the full-text index and with LIKE, and
+copying the mailbox to another DB with ``add_sms`` and with the bulk
+import. Run it from the top of the tree::
+
+    python contrib/benchmarks/sms.py [messages ...]
+"""
+
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from wader.common.provider import (SmsProvider, Message, Thread,
+                                   inbox_folder, outbox_folder, drafts_folder)
+
+# messages per thread
+THREAD_SIZE = 20
+# the messages are made of these words, the first ones are more common
+random.seed(0)
+WORDS = [''.join([random.choice(string.ascii_lowercase)
+                  for j in range(random.randint(2, 9))])
+         for i in range(5000)]
+# largest mailbox copied with add_sms, bigger ones take too long
+MAX_ADD_SMS = 10000
+# a very common word, a rare one, two common words and a prefix
+SEARCHES = [WORDS[0], WORDS[4000], '%s %s' % (WORDS[1], WORDS[2]),
+            WORDS[40][:3]]
+
+
+def populate(provider, size):
+    for folder in [inbox_folder, outbox_folder, drafts_folder]:
+        provider.add_folder(folder)
+
+    # a single transaction, one per message would take ages
+    provider.conn.isolation_level = 'DEFERRED'
+    c = provider.conn.cursor()
+    now = int(time.time())
+    threads = []
+    for i in range(max(size / THREAD_SIZE, 1)):
+        number = '+34%09d' % i
+        c.execute("insert into thread values (null, ?, ?, 0, '', 0, ?)",
+                  (now, number, random.randint(1, 3)))
+        threads.append((c.lastrowid, number))
+
+    def messages():
+        for i in range(size):
+            thread_id, number = random.choice(threads)
+            text = ' '.join([WORDS[min(int(random.paretovariate(1)),
+                                       len(WORDS)) - 1]
+                             for j in range(random.randint(3, 20))])
+            yield (now - i * 60, number, text, random.randint(0, 3),
+                   thread_id)
+
+    c.executemany("insert into message values (null, ?, ?, ?, ?, ?)",
+                  messages())
+    provider.conn.commit()
+    provider.conn.isolation_level = None
+
+
+def list_sms_per_row(provider):
+    """The listing as it used to be, two queries per message"""
+    c = provider.conn.cursor()
+    c.execute("select * from message order by date desc")
+    for row in c:
+        thread = provider._get_thread_by_id(row[5])
+        yield Message.from_row(row, thread=thread)
+
+
+def list_threads_per_row(provider):
+    """The listing as it used to be, a query per thread"""
+    c = provider.conn.cursor()
+    c.execute("select * from thread order by date desc")
+    for row in c:
+        folder = provider._get_folder_by_id(row[6])
+        yield Thread.from_row(row, folder=folder)
+
+
+def measure(func):
+    """Returns the milliseconds it takes to consume ``func()``"""
+    start = time.time()
+    count = len(list(func()))
+    return count, (time.time() - start) * 1000
+
+
+def measure_search(provider, text, repeat=20):
+    """Returns the mean milliseconds a search of ``text`` takes"""
+    start = time.time()
+    for i in range(repeat):
+        provider.search_sms(text)
+
+    return (time.time() - start) * 1000 / repeat
+
+
+def copy_mailbox(provider, bulk):
+    """Returns the milliseconds it takes to copy ``provider`` to a new DB"""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    target = SmsProvider(path)
+    try:
+        for folder in [inbox_folder, outbox_folder, drafts_folder]:
+            target.add_folder(folder)
+
+        start = time.time()
+        if bulk:
+            target.import_sms(provider.export_sms())
+        else:
+            for sms in provider.export_sms():
+                # one autocommit transaction per message
+                sms.thread = target.get_thread_by_number(sms.number,
+                                                         sms.thread.folder)
+                target.add_sms(sms)
+
+        return (time.time() - start) * 1000
+    finally:
+        target.close()
+        os.unlink(path)
+
+
+def main(*sizes):
+    sizes = map(int, sizes) or [1000, 10000, 100000]
+    print "%-8s %-8s %14s %14s" % ('size', 'listing', 'per row (ms)',
+                                   'join (ms)')
+    for size in sizes:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        provider = SmsProvider(path)
+        try:
+            populate(provider, size)
+            cases = [
+                ('sms', lambda: list_sms_per_row(provider),
+                 provider.list_sms),
+                ('threads', lambda: list_threads_per_row(provider),
+                 provider.list_threads),
+            ]
+            for name, per_row, join in cases:
+                count, old = measure(per_row)
+                _count, new = measure(join)
+                assert count == _count
+                print "%-8d %-8s %14.1f %14.1f" % (size, name, old, new)
+
+            for text in SEARCHES:
+                fts = measure_search(provider, text)
+                provider.fts = False
+                like = measure_search(provider, text)
+                provider.fts = True
+                print "%-8d search %-14r fts %8.2f like %8.2f (ms)" % (
+                                                    size, text, fts, like)
+
+            bulk = copy_mailbox(provider, True)
+            if size <= MAX_ADD_SMS:
+                one_by_one = "%8.1f" % copy_mailbox(provider, False)
+            else:
+                one_by_one = "%8s" % '-'
+            print "%-8d import add_sms %s import_sms %8.1f (ms)" % (
+                                                size, one_by_one, bulk)
+        finally:
+            provider.close()
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Benchmark of the UsageProvider queries
+
+Fills a usage DB with several years of synthetic sessions and compares
+adding up the ``UsageItem`` of a day, a month and the whole history with
+the rollup based summaries. Run it from the top of the tree::
+
+    python contrib/benchmarks/usage.py [years] [sessions per day]
+"""
+
+import datetime
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from wader.common.provider import UsageProvider, date_to_datetime
+
+REPEAT = 20
+
+
+def populate(provider, years, per_day):
+    # a single transaction, one per session would take ages
+    provider.conn.isolation_level = 'DEFERRED'
+    today = datetime.date.today()
+    day = today - datetime.timedelta(days=365 * years)
+    while day <= today:
+        midnight = date_to_datetime(day)
+        for i in range(per_day):
+            # sessions never cross midnight, so both ways agree
+            minutes = random.randint(0, 1400)
+            start = midnight + datetime.timedelta(minutes=minutes)
+            end = start + datetime.timedelta(minutes=random.randint(1, 30))
+            provider.add_usage_item(start, end, random.randint(0, 10 ** 7),
+                                    random.randint(0, 10 ** 6),
+                                    random.random() > 0.2)
+        day += datetime.timedelta(days=1)
+
+    provider.conn.commit()
+    provider.conn.isolation_level = None
+
+
+def measure(func, *args):
+    """Returns the mean milliseconds a call to ``func`` takes"""
+    timer = timeit.Timer(lambda: func(*args))
+    return timer.timeit(REPEAT) * 1000.0 / REPEAT
+
+
+def main(years=5, per_day=10):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    provider = UsageProvider(path)
+    try:
+        populate(provider, years, per_day)
+        today = datetime.date.today()
+
+        def sum_items(items):
+            return sum([i.total() for i in items])
+
+        cases = [
+            ('day', lambda: sum_items(provider.get_usage_for_day(today)),
+             lambda: provider.get_usage_summary_for_day(today).total()),
+            ('month', lambda: sum_items(provider.get_usage_for_month(today)),
+             lambda: provider.get_usage_summary_for_month(today).total()),
+            ('total', lambda: sum_items(provider.get_total_usage()),
+             lambda: provider.get_total_usage_summary().total()),
+        ]
+
+        print "%d years, %d sessions per day" % (years, per_day)
+        print "%-8s %12s %12s" % ('query', 'items (ms)', 'rollup (ms)')
+        for name, items, rollup in cases:
+            assert items() == rollup()
+            print "%-8s %12.3f %12.3f" % (name, measure(items),
+                                          measure(rollup))
+    finally:
+        provider.close()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
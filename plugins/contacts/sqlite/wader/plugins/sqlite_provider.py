@@ -20,10 +20,22 @@ import sqlite3
 
 from zope.interface import implements
 from twisted.plugin import IPlugin
+from twisted.python import log
 
-from wader.common.contact import Contact
+VOBJECT_AVAILABLE = True
+try:
+    import vobject
+except ImportError:
+    VOBJECT_AVAILABLE = False
+
+from wader.common.contact import Contact, ContactNotifier
 from wader.common.encoding import to_u
+from wader.common.exceptions import PluginInitialisationError
 from wader.common.interfaces import IContactProvider
+from wader.common.phonenumber import (normalize_number, get_number_key,
+                                      numbers_match)
+from wader.common.provider import (build_fts_query, escape_like,
+                                   execute_script)
 from wader.common.utils import get_value_and_pop
 
 contact_SCHEMA = """
@@ -38,6 +50,69 @@ create table version (
     version integer default 1);
 """
 
+# version 2 columns, existing DBs get them and the indexes on initialize
+contact_V2_SCHEMA = """
+-- the lower case name, the name searches compare it with their prefix
+alter table contact add column name_key text;
+-- the number in E.164 form and its key, see wader.common.phonenumber
+alter table contact add column normalized text;
+alter table contact add column number_key text;
+
+create index contact_name_key_index on contact(name_key);
+create index contact_normalized_index on contact(normalized);
+create index contact_number_key_index on contact(number_key);
+"""
+
+# the MCC the numbers were normalized with, one row
+contact_MCC_SCHEMA = """
+create table if not exists number_mcc (mcc text)
+"""
+
+contact_FTS_SCHEMA = """
+create virtual table contact_fts using %(module)s;
+
+create trigger fki_contact_fts after insert on "contact"
+begin
+    insert into contact_fts(docid, name) values (new."id", new."name");
+end;
+
+create trigger fku_contact_fts after update of name on "contact"
+begin
+    update contact_fts set name = new."name" where docid = old."id";
+end;
+
+create trigger fkd_contact_fts after delete on "contact"
+begin
+    delete from contact_fts where docid = old."id";
+end;
+
+-- existing contacts
+insert into contact_fts(docid, name) select id, name from contact;
+"""
+
+# full-text modules tried, best first
+FTS_MODULES = ['fts4(name, tokenize=unicode61)', 'fts4(name)', 'fts3(name)']
+
+SCHEMA_VERSION = 2
+
+# contacts inserted at once by import_vcards
+IMPORT_BATCH_SIZE = 1000
+
+
+def get_name_key(name):
+    """Returns the key the name searches compare with their prefix"""
+    return to_u(name).lower()
+
+
+def get_prefix_range(prefix):
+    """
+    Returns the bounds of the strings that start with ``prefix``
+
+    ``x >= low and x < high`` can use an index, unlike ``x like 'p%'``.
+    """
+    return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
 class SQLContact(Contact):
     """I am a :class:`Contact` with email and a picture"""
 
@@ -56,7 +131,7 @@ class SQLContact(Contact):
         return (self.index, self.name, self.number, self.email, self.picture)
 
 
-class SQLiteContactProvider(object):
+class SQLiteContactProvider(ContactNotifier):
     """SQLite IContactProvider backend"""
 
     implements(IPlugin, IContactProvider)
@@ -66,16 +141,96 @@ class SQLiteContactProvider(object):
 
     def __init__(self):
         self.cursor = None
+        self.mcc = None
+        self.fts = False
 
     def initialize(self, init_obj):
+        """
+        Opens the DB at ``init_obj['path']``
+
+        ``init_obj['mcc']``, the MCC of the SIM, is optional and tells
+        which country the national numbers belong to.
+        """
         conn = sqlite3.connect(init_obj['path'], isolation_level=None)
         self.cursor = conn.cursor()
+        self.mcc = init_obj.get('mcc')
         try:
             self.cursor.executescript(contact_SCHEMA)
         except sqlite3.OperationalError:
             # database was present
             pass
 
+        self._upgrade()
+
+    def _get_columns(self, contact):
+        normalized = normalize_number(contact.number, self.mcc)
+        return (contact.name, contact.number, contact.email, contact.picture,
+                get_name_key(contact.name), normalized,
+                get_number_key(normalized))
+
+    def _upgrade(self):
+        # DBs created by older versions lack the search columns
+        conn = self.cursor.connection
+        self.cursor.execute("pragma table_info(contact)")
+        if 'number_key' not in [row[1] for row in self.cursor.fetchall()]:
+            conn.create_function('name_key', 1, get_name_key)
+            execute_script(self.cursor,
+                           "%s\n"
+                           "update contact set name_key = name_key(name);\n"
+                           "delete from version;\n"
+                           "insert into version values (%d);"
+                           % (contact_V2_SCHEMA, SCHEMA_VERSION))
+
+        self._normalize_numbers()
+
+        self.cursor.execute("select 1 from sqlite_master where type='table' "
+                            "and name='contact_fts'")
+        if self.cursor.fetchone() is not None:
+            self.fts = True
+            return
+
+        self.fts = False
+        for module in FTS_MODULES:
+            try:
+                execute_script(self.cursor,
+                               contact_FTS_SCHEMA % dict(module=module))
+            except sqlite3.OperationalError:
+                # module not available in this sqlite
+                continue
+
+            self.fts = True
+            break
+        else:
+            log.msg("No full-text search in sqlite %s, searching contacts "
+                    "will be slow" % sqlite3.sqlite_version)
+
+    def _normalize_numbers(self):
+        # national numbers are stored as numbers of the country of the
+        # MCC, they are normalized again when the SIM is from another one
+        conn = self.cursor.connection
+        mcc = self.mcc and to_u(self.mcc[:3]) or None
+        self.cursor.execute(contact_MCC_SCHEMA)
+        self.cursor.execute("select mcc from number_mcc")
+        row = self.cursor.fetchone()
+        if row is not None and row[0] == mcc:
+            return
+
+        conn.create_function('normalize_number', 1,
+                             lambda n: normalize_number(n, self.mcc))
+        conn.create_function('number_key', 1, get_number_key)
+        self.cursor.execute("begin immediate")
+        try:
+            self.cursor.execute("update contact set "
+                                "normalized = normalize_number(number)")
+            self.cursor.execute("update contact set "
+                                "number_key = number_key(normalized)")
+            self.cursor.execute("delete from number_mcc")
+            self.cursor.execute("insert into number_mcc values (?)", (mcc,))
+            self.cursor.execute("commit")
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
     def close(self):
         return self.cursor.close()
 
@@ -84,9 +239,12 @@ class SQLiteContactProvider(object):
         if not isinstance(contact, SQLContact):
             return
 
-        self.cursor.execute("insert into contact values(?, ?, ?, ?, ?)",
-                            contact.to_row())
+        self.cursor.execute("insert into contact (name, number, email, "
+                            "picture, name_key, normalized, number_key) "
+                            "values (?, ?, ?, ?, ?, ?, ?)",
+                            self._get_columns(contact))
         contact.index = self.cursor.lastrowid
+        self.notify_changes(changed=[contact])
         return contact
 
     def edit_contact(self, contact):
@@ -95,26 +253,65 @@ class SQLiteContactProvider(object):
             return
 
         self.cursor.execute(
-            "update contact set name=?, number=?, email=?, picture=? "
-            "where id=?", (contact.name, contact.number, contact.email,
-                           contact.picture, contact.index))
+            "update contact set name=?, number=?, email=?, picture=?, "
+            "name_key=?, normalized=?, number_key=? where id=?",
+            self._get_columns(contact) + (contact.index,))
+        self.notify_changes(changed=[contact])
         return contact
 
     def find_contacts_by_name(self, name):
-        """See :meth:`IContactProvider.find_contacts_by_name`"""
-        sql = "select * from contact where name like ?"
-        self.cursor.execute(sql, ("%%%s%%" % name,))
+        """
+        See :meth:`IContactProvider.find_contacts_by_name`
+
+        Returns the contacts whose name, or a word of it, starts with
+        ``name``, ordered by name.
+        """
+        key = get_name_key(name)
+        if not key:
+            return self.list_contacts()
+
+        low, high = get_prefix_range(key)
+        sql = ("select id, name, number, email, picture from contact "
+               "where name_key >= ? and name_key < ?")
+        args = (low, high)
+        query = build_fts_query(name)
+        if self.fts and query is not None:
+            sql += (" union select id, name, number, email, picture "
+                    "from contact where id in (select docid from contact_fts "
+                    "where contact_fts match ?)")
+            args += (query,)
+        elif not self.fts:
+            sql += " or name_key like ? escape '\\'"
+            args += ("%% %s%%" % escape_like(key),)
+
+        self.cursor.execute(sql + " order by name", args)
         return [SQLContact.from_row(r) for r in self.cursor.fetchall()]
 
     def find_contacts_by_number(self, number):
-        """See :meth:`IContactProvider.find_contacts_by_number`"""
-        sql = "select * from contact where number like ?"
-        self.cursor.execute(sql, ("%%%s%%" % number,))
-        return [SQLContact.from_row(r) for r in self.cursor.fetchall()]
+        """
+        See :meth:`IContactProvider.find_contacts_by_number`
+
+        Returns the contacts whose number is ``number`` or starts with it.
+        """
+        normalized = normalize_number(number, self.mcc)
+        if not normalized:
+            return []
+
+        low, high = get_prefix_range(normalized)
+        self.cursor.execute(
+            "select id, name, number, email, picture, normalized "
+            "from contact where number_key = ? "
+            "union select id, name, number, email, picture, normalized "
+            "from contact where normalized >= ? and normalized < ?",
+            (get_number_key(normalized), low, high))
+        return [SQLContact.from_row(r) for r in self.cursor.fetchall()
+                if r[5].startswith(normalized) or
+                numbers_match(r[5], normalized)]
 
     def list_contacts(self):
         """See :meth:`IContactProvider.list_contacts`"""
-        self.cursor.execute("select * from contact")
+        self.cursor.execute("select id, name, number, email, picture "
+                            "from contact")
         return [SQLContact.from_row(r) for r in self.cursor.fetchall()]
 
     def remove_contact(self, contact):
@@ -123,6 +320,88 @@ class SQLiteContactProvider(object):
             # filter out non SQLcontact
             sql = "delete from contact where id=?"
             self.cursor.execute(sql, (contact.index,))
+            self.notify_changes(removed=[contact])
+
+    def import_contacts(self, contacts, batch=IMPORT_BATCH_SIZE):
+        """
+        Adds ``contacts`` to the DB in a single transaction
+
+        They are inserted ``batch`` at a time and the change callbacks
+        are notified once everything has been committed.
+
+        :param contacts: iterable of :class:`SQLContact`
+        :return: the added contacts, with their indexes set
+        """
+        conn = self.cursor.connection
+        added = []
+        self.cursor.execute("begin immediate")
+        try:
+            pending = []
+            for contact in contacts:
+                pending.append(contact)
+                if len(pending) == batch:
+                    self._insert_batch(pending)
+                    added.extend(pending)
+                    pending = []
+
+            self._insert_batch(pending)
+            added.extend(pending)
+            self.cursor.execute("commit")
+        except:
+            conn.rollback()
+            raise
+
+        self.notify_changes(changed=added)
+        return added
+
+    def _insert_batch(self, contacts):
+        if not contacts:
+            return
+
+        # executemany does not tell the ids, the transaction holds the
+        # write lock so the next ones can be taken from the sequence
+        self.cursor.execute("select seq from sqlite_sequence "
+                            "where name='contact'")
+        row = self.cursor.fetchone()
+        first = (row and row[0] or 0) + 1
+        rows = [(first + i,) + self._get_columns(contact)
+                for i, contact in enumerate(contacts)]
+        self.cursor.executemany("insert into contact (id, name, number, "
+                                "email, picture, name_key, normalized, "
+                                "number_key) values (?, ?, ?, ?, ?, ?, ?, ?)",
+                                rows)
+        for i, contact in enumerate(contacts):
+            contact.index = first + i
+
+    def import_vcards(self, text, batch=IMPORT_BATCH_SIZE):
+        """
+        Adds the contacts of the vCards in ``text`` to the DB
+
+        The vCards without a telephone number are skipped. See
+        :meth:`import_contacts`.
+
+        :raise PluginInitialisationError: when python-vobject is not
+            installed
+        :return: the added contacts
+        """
+        if not VOBJECT_AVAILABLE:
+            raise PluginInitialisationError("install python-vobject")
+
+        return self.import_contacts(self._parse_vcards(text), batch)
+
+    def _parse_vcards(self, text):
+        for card in vobject.readComponents(text, allowQP=True):
+            number = card.getChildValue('tel')
+            if not number:
+                continue
+
+            if hasattr(card, 'fn'):
+                name = card.fn.value
+            else:
+                name = unicode(card.n.value).strip()
+
+            yield SQLContact(name, number,
+                             email=card.getChildValue('email', default=''))
 
 
 sqlite_provider = SQLiteContactProvider()
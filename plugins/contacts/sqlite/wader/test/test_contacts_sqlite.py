@@ -16,9 +16,15 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Unittests for the SQLite IContactProvider"""
+import sqlite3
+
 from twisted.trial import unittest
 
-from wader.plugins.sqlite_provider import sqlite_provider, SQLContact
+from wader.common.exceptions import PluginInitialisationError
+import wader.plugins.sqlite_provider
+from wader.plugins.sqlite_provider import (sqlite_provider, SQLContact,
+                                           SQLiteContactProvider,
+                                           SCHEMA_VERSION, VOBJECT_AVAILABLE)
 
 class TestSQLiteContactProvider(unittest.TestCase):
     """Test for the SQLite IContactProvider"""
@@ -101,3 +107,255 @@ class TestSQLiteContactProvider(unittest.TestCase):
         self.failIfIn(contact, list(self.provider.list_contacts()))
 
 
+OLD_DB_SCHEMA = """
+create table contact (
+    id integer primary key autoincrement,
+    name text not null,
+    number text not null,
+    email text,
+    picture blob);
+
+create table version (
+    version integer default 1);
+
+insert into contact values (null, 'Ana Gomez', '+34600123456', '', '');
+insert into contact values (null, 'John Smith', '0044 20 7946 0000', '', '');
+"""
+
+VCARDS = """BEGIN:VCARD
+VERSION:3.0
+FN:Ana Gomez
+N:Gomez;Ana;;;
+TEL:+34600123456
+EMAIL:ana@example.com
+END:VCARD
+BEGIN:VCARD
+VERSION:3.0
+FN:No Number
+N:Number;No;;;
+END:VCARD
+BEGIN:VCARD
+VERSION:3.0
+FN:John Smith
+N:Smith;John;;;
+TEL:0044 20 7946 0000
+END:VCARD
+"""
+
+
+class TestSQLiteContactSearch(unittest.TestCase):
+    """Tests for the indexes and the imports of the SQLite provider"""
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.provider = SQLiteContactProvider()
+        self.provider.initialize(dict(path=self.path, mcc='21401'))
+
+    def tearDown(self):
+        self.provider.close()
+
+    def add(self, name, number):
+        return self.provider.add_contact(SQLContact(name, number))
+
+    def names(self, contacts):
+        return sorted([contact.name for contact in contacts])
+
+    def test_find_by_name_prefix(self):
+        self.add(u'Ana Gomez', '+34600123456')
+        self.add(u'anabel', '+34600123457')
+        self.add(u'Juana', '+34600123458')
+
+        contacts = self.provider.find_contacts_by_name('ana')
+        self.assertEqual(self.names(contacts), [u'Ana Gomez', u'anabel'])
+
+    def test_find_by_name_word(self):
+        self.add(u'Ana Gomez', '+34600123456')
+        self.add(u'Gomeztrado', '+34600123457')
+        self.add(u'Pedro Agomez', '+34600123458')
+
+        contacts = self.provider.find_contacts_by_name('gom')
+        self.assertEqual(self.names(contacts), [u'Ana Gomez', u'Gomeztrado'])
+
+    def test_find_by_name_word_without_fts_is_literal(self):
+        self.provider.fts = False
+        self.add(u'Ana 50% Gomez', '+34600123456')
+        self.add(u'Ana 500 Gomez', '+34600123457')
+        self.add(u'Eva Perez', '+34600123458')
+
+        contacts = self.provider.find_contacts_by_name('gom')
+        self.assertEqual(self.names(contacts),
+                         [u'Ana 50% Gomez', u'Ana 500 Gomez'])
+        contacts = self.provider.find_contacts_by_name('50%')
+        self.assertEqual(self.names(contacts), [u'Ana 50% Gomez'])
+        self.assertEqual(self.provider.find_contacts_by_name('_'), [])
+
+    def test_find_by_name_follows_edits(self):
+        contact = self.add(u'Ana Gomez', '+34600123456')
+        contact.name = u'Eva Perez'
+        self.provider.edit_contact(contact)
+
+        self.assertEqual(self.provider.find_contacts_by_name('gomez'), [])
+        self.assertEqual(
+            self.names(self.provider.find_contacts_by_name('perez')),
+            [u'Eva Perez'])
+
+        self.provider.remove_contact(contact)
+        self.assertEqual(self.provider.find_contacts_by_name('perez'), [])
+
+    def test_find_by_national_number(self):
+        self.add(u'Ana Gomez', '+34 600 123 456')
+
+        contacts = self.provider.find_contacts_by_number('600123456')
+        self.assertEqual(self.names(contacts), [u'Ana Gomez'])
+        contacts = self.provider.find_contacts_by_number('0034600123456')
+        self.assertEqual(self.names(contacts), [u'Ana Gomez'])
+        # same key, another country
+        self.assertEqual(
+            self.provider.find_contacts_by_number('+44600123456'), [])
+
+    def test_find_by_national_number_without_mcc(self):
+        provider = SQLiteContactProvider()
+        provider.initialize(dict(path=self.mktemp()))
+        try:
+            provider.add_contact(SQLContact(u'Ana Gomez', '600 123 456'))
+            provider.add_contact(SQLContact(u'Eva Perez', '+34700123456'))
+            self.assertEqual(
+                self.names(provider.find_contacts_by_number('600123456')),
+                [u'Ana Gomez'])
+            self.assertEqual(
+                self.names(provider.find_contacts_by_number('+34600123456')),
+                [u'Ana Gomez'])
+            # same key, the digits before it differ
+            self.assertEqual(provider.find_contacts_by_number('500123456'),
+                             [])
+        finally:
+            provider.close()
+
+    def test_fts_falls_back_to_the_next_module(self):
+        self.patch(wader.plugins.sqlite_provider, 'FTS_MODULES',
+                   ['nosuchmod(name)', 'fts3(name)'])
+        path = self.mktemp()
+        provider = SQLiteContactProvider()
+        provider.initialize(dict(path=path, mcc='21401'))
+        try:
+            self.assertTrue(provider.fts)
+            provider.add_contact(SQLContact(u'Ana Gomez', '+34600123456'))
+            # the failed module left no transaction open
+            conn = sqlite3.connect(path)
+            self.assertEqual(
+                conn.execute("select name from contact").fetchall(),
+                [(u'Ana Gomez',)])
+            conn.close()
+        finally:
+            provider.close()
+
+    def test_search_uses_the_indexes(self):
+        c = self.provider.cursor
+        for sql in ["select * from contact where name_key >= 'a' "
+                    "and name_key < 'b'",
+                    "select * from contact where number_key = '1'",
+                    "select * from contact where normalized >= '+3' "
+                    "and normalized < '+4'"]:
+            c.execute("explain query plan " + sql)
+            plan = ' '.join([str(row[-1]) for row in c.fetchall()])
+            self.assertIn('INDEX', plan)
+
+    def test_upgrade_old_db(self):
+        path = self.mktemp()
+        conn = sqlite3.connect(path)
+        conn.executescript(OLD_DB_SCHEMA)
+        conn.close()
+
+        provider = SQLiteContactProvider()
+        provider.initialize(dict(path=path, mcc='21401'))
+        try:
+            self.assertEqual(
+                self.names(provider.find_contacts_by_name('smi')),
+                [u'John Smith'])
+            self.assertEqual(
+                self.names(provider.find_contacts_by_number('600123456')),
+                [u'Ana Gomez'])
+            self.assertEqual(
+                self.names(provider.find_contacts_by_number('+442079460000')),
+                [u'John Smith'])
+            provider.cursor.execute("select version from version")
+            self.assertEqual(provider.cursor.fetchall(), [(SCHEMA_VERSION,)])
+        finally:
+            provider.close()
+
+        # a second initialize finds it up to date
+        provider = SQLiteContactProvider()
+        provider.initialize(dict(path=path))
+        self.assertEqual(len(provider.list_contacts()), 2)
+        provider.close()
+
+    def test_numbers_follow_the_mcc(self):
+        self.add(u'John Smith', '020 7946 0000')
+        self.provider.close()
+
+        provider = SQLiteContactProvider()
+        provider.initialize(dict(path=self.path, mcc='23410'))
+        try:
+            self.assertEqual(
+                self.names(provider.find_contacts_by_number('+442079460000')),
+                [u'John Smith'])
+            provider.cursor.execute("select normalized from contact")
+            self.assertEqual(provider.cursor.fetchall(), [(u'+442079460000',)])
+            provider.cursor.execute("select mcc from number_mcc")
+            self.assertEqual(provider.cursor.fetchall(), [(u'234',)])
+        finally:
+            provider.close()
+
+        self.provider = SQLiteContactProvider()
+        self.provider.initialize(dict(path=self.path, mcc='21401'))
+        self.assertEqual(
+            self.provider.find_contacts_by_number('+442079460000'), [])
+
+    def test_import_contacts(self):
+        changes = []
+        self.provider.add_change_callback(
+            lambda provider, changed, removed: changes.append(len(changed)))
+        first = self.add(u'First', '+34600000000')
+        self.provider.remove_contact(first)
+
+        contacts = [SQLContact(u'Contact %d' % i, '+346000%05d' % i)
+                    for i in range(25)]
+        added = self.provider.import_contacts(contacts, batch=10)
+
+        self.assertEqual(len(added), 25)
+        # the ids of removed contacts are not reused
+        self.assertEqual([c.index for c in added], range(2, 27))
+        self.assertEqual(changes, [1, 0, 25])
+        found = self.provider.find_contacts_by_number('+34600000024')
+        self.assertEqual([c.index for c in found], [added[24].index])
+        self.assertEqual(len(self.provider.find_contacts_by_name('contact')),
+                         25)
+
+    def test_import_contacts_rolls_back(self):
+
+        def contacts():
+            yield SQLContact(u'Ana', '+34600000000')
+            raise ValueError("broken vCard")
+
+        self.assertRaises(ValueError, self.provider.import_contacts,
+                          contacts())
+        self.assertEqual(self.provider.list_contacts(), [])
+
+    def test_import_vcards(self):
+        if not VOBJECT_AVAILABLE:
+            raise unittest.SkipTest("python-vobject is not installed")
+
+        added = self.provider.import_vcards(VCARDS)
+
+        self.assertEqual(self.names(added), [u'Ana Gomez', u'John Smith'])
+        self.assertEqual(added[0].email, u'ana@example.com')
+        self.assertEqual(
+            self.names(self.provider.find_contacts_by_number('600123456')),
+            [u'Ana Gomez'])
+
+    def test_import_vcards_without_vobject(self):
+        self.patch(wader.plugins.sqlite_provider, 'VOBJECT_AVAILABLE', False)
+
+        self.assertRaises(PluginInitialisationError,
+                          self.provider.import_vcards, VCARDS)
+        self.assertEqual(self.provider.list_contacts(), [])
@@ -15,10 +15,37 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+ZYB contacts backend
+
+ZYB is a web service, a SOAP round trip takes too long to be done on
+the reactor thread every time the contacts are listed or searched. So
+the contacts are kept in a local sqlite mirror that serves every read,
+while :meth:`ZYBProvider.sync` brings it up to date in the background.
+
+The service does not tell what changed since the last time, every sync
+fetches the contact list and compares the change token of every contact,
+a digest of its vCard, with the one in the mirror. Only the contacts
+added, changed or removed are parsed, written and notified.
+"""
+
+import hashlib
 
 from zope.interface import implements
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread, deferToThreadPool
 from twisted.plugin import IPlugin
-import vobject
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+VOBJECT_AVAILABLE = True
+try:
+    import vobject
+except ImportError:
+    VOBJECT_AVAILABLE = False
 
 SUDS_AVAILABLE = True
 try:
@@ -26,9 +53,54 @@ try:
 except ImportError:
     SUDS_AVAILABLE = False
 
-from wader.common.contact import Contact
+from wader.common.contact import Contact, ContactNotifier
 from wader.common.exceptions import PluginInitialisationError
 from wader.common.interfaces import IContactProvider
+from wader.common.phonenumber import (normalize_number, get_number_key,
+                                      numbers_match)
+from wader.common.provider import DBProvider
+
+ZYB_URL = 'https://api.zyb.com/zybservice.asmx?WSDL'
+# seconds between two syncs
+SYNC_INTERVAL = 15 * 60
+
+MIRROR_SCHEMA = """
+create table contact (
+    id text primary key,
+    name text not null,
+    number text not null,
+    email text,
+    -- the lower case name, the name searches compare it with their prefix
+    name_key text,
+    -- the number in E.164 form and its key, see wader.common.phonenumber
+    normalized text,
+    number_key text,
+    -- digest of the vCard, it changes whenever the contact does
+    token text not null);
+
+create index contact_name_key_index on contact(name_key);
+create index contact_number_key_index on contact(number_key);
+
+-- key is the name of the token, like 'contacts' for the contact list
+create table sync_token (
+    name text primary key,
+    token text not null);
+"""
+
+
+def get_change_token(text):
+    """Returns the change token of ``text``"""
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+
+    return hashlib.sha1(text).hexdigest()
+
+
+def get_list_token(tokens):
+    """Returns the change token of a contact list out of ``tokens``"""
+    return get_change_token(''.join(['%s:%s;' % item
+                                     for item in sorted(tokens.items())]))
+
 
 class ZYBContact(Contact):
 
@@ -45,9 +117,122 @@ class ZYBContact(Contact):
         return cls(contact.n.value.given, number, index=c.ID,
                    email=email, contact=contact)
 
+    @classmethod
+    def from_row(cls, row):
+        """Returns a :class:`ZYBContact` out of a mirror ``row``"""
+        return cls(row[1], row[2], index=row[0], email=row[3])
+
+
+class ZYBMirror(DBProvider):
+    """
+    Local copy of the ZYB contacts
+
+    :param mcc: MCC of the SIM, tells which country the national
+        numbers belong to
+    """
 
-class ZYBProvider(object):
-    """ZYB IContactProvider backend"""
+    def __init__(self, path, mcc=None):
+        super(ZYBMirror, self).__init__(path, MIRROR_SCHEMA)
+        self.mcc = mcc
+
+    def _get_row(self, contact, token):
+        normalized = normalize_number(contact.number, self.mcc)
+        return (contact.index, contact.name, contact.number, contact.email,
+                contact.name.lower(), normalized, get_number_key(normalized),
+                token)
+
+    def get_token(self, name):
+        """Returns the change token ``name`` or ``None``"""
+        c = self.conn.cursor()
+        c.execute("select token from sync_token where name=?", (name,))
+        row = c.fetchone()
+        return row and row[0] or None
+
+    def get_contact_tokens(self):
+        """Returns a dict with the change token of every contact"""
+        c = self.conn.cursor()
+        c.execute("select id, token from contact")
+        return dict(c.fetchall())
+
+    def get_contacts(self, indexes):
+        """Returns the contacts whose index is in ``indexes``"""
+        c = self.conn.cursor()
+        contacts = []
+        for index in indexes:
+            c.execute("select * from contact where id=?", (index,))
+            contacts.extend([ZYBContact.from_row(r) for r in c.fetchall()])
+
+        return contacts
+
+    def update(self, changed, removed, tokens=None):
+        """
+        Writes the changes in a single transaction
+
+        :param changed: list of (:class:`ZYBContact`, token) tuples to
+            add or replace
+        :param removed: indexes of the contacts to remove
+        :param tokens: dict with the change tokens to store
+        """
+        c = self.conn.cursor()
+        c.execute("begin immediate")
+        try:
+            c.executemany("insert or replace into contact "
+                          "values (?, ?, ?, ?, ?, ?, ?, ?)",
+                          [self._get_row(contact, token)
+                           for contact, token in changed])
+            c.executemany("delete from contact where id=?",
+                          [(index,) for index in removed])
+            if tokens:
+                c.executemany("insert or replace into sync_token "
+                              "values (?, ?)", tokens.items())
+            c.execute("commit")
+        except:
+            self.conn.rollback()
+            raise
+
+    def list_contacts(self):
+        c = self.conn.cursor()
+        c.execute("select * from contact order by name_key")
+        return [ZYBContact.from_row(r) for r in c.fetchall()]
+
+    def find_contacts_by_name(self, name):
+        key = name.lower()
+        if not key:
+            return self.list_contacts()
+
+        c = self.conn.cursor()
+        c.execute("select * from contact where name_key >= ? "
+                  "and name_key < ? order by name_key",
+                  (key, key[:-1] + unichr(ord(key[-1]) + 1)))
+        return [ZYBContact.from_row(r) for r in c.fetchall()]
+
+    def find_contacts_by_number(self, number):
+        normalized = normalize_number(number, self.mcc)
+        if not normalized:
+            return []
+
+        c = self.conn.cursor()
+        key = get_number_key(normalized)
+        if len(key) < len(normalized.lstrip('+')):
+            # the number is longer than its key, the key must match
+            c.execute("select * from contact where number_key=?", (key,))
+        else:
+            # a few digits, they might be the end of any number
+            c.execute("select * from contact where normalized like ?",
+                      ('%%%s' % normalized,))
+
+        return [ZYBContact.from_row(r) for r in c.fetchall()
+                if numbers_match(r[5], normalized) or
+                r[5].endswith(normalized)]
+
+
+class ZYBProvider(ContactNotifier):
+    """
+    ZYB IContactProvider backend
+
+    The reads are served by the local mirror, the writes are sent to ZYB
+    and return ``Deferred`` objects that fire once the mirror has them.
+    """
     implements(IPlugin, IContactProvider)
 
     name = "SQLite contact backend"
@@ -56,29 +241,92 @@ class ZYBProvider(object):
 
     def __init__(self):
         self.client = None
+        self.url = None
         self.user_id = None
         self.password = None
         self.ptoken = None
         self.utoken = None
+        self.mirror = None
+        self.pool = None
+        self.loop = None
+        self._syncing = None
+        self._written = None
 
     def _get_last_error(self):
         return self.client.service.GetLastErrorInfo(self.ptoken, self.utoken)
 
     def close(self):
+        """
+        Stops syncing and closes the mirror
+
+        :return: a ``Deferred`` that fires once the pool thread is gone,
+            after the SOAP call in progress, if any
+        """
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+        self.loop = None
+
+        d = succeed(None)
+        if self.pool is not None:
+            # stop joins the thread, that would block the reactor until
+            # ZYB answers the SOAP call in progress
+            d = deferToThread(self.pool.stop)
+            self.pool = None
+
+        if self.mirror is not None:
+            self.mirror.close()
+            self.mirror = None
+
         del self.client
         self.client = None
         self.user_id = None
         self.password = None
         self.ptoken = None
         self.utoken = None
+        return d
 
     def initialize(self, init_obj):
+        """
+        Opens the mirror and starts syncing it with ZYB
+
+        The first sync, and the connection to ZYB, start right away in
+        the pool thread unless the syncs are disabled. The reads do not
+        wait for it, they are served by the mirror as it is. ``init_obj``
+        keys:
+
+         - ``username`` and ``password``: the ZYB credentials
+         - ``path``: path of the mirror DB. If omitted the mirror is kept
+           in memory, it is empty and the reads return nothing until the
+           first sync finishes
+         - ``mcc``: MCC of the SIM, optional
+         - ``sync_interval``: seconds between two syncs, 0 disables them
+         - ``url``: URL of the ZYB WSDL
+        """
         if not SUDS_AVAILABLE:
             raise PluginInitialisationError("install python-suds")
 
+        if not VOBJECT_AVAILABLE:
+            raise PluginInitialisationError("install python-vobject")
+
         self.user_id = init_obj['username']
         self.password = init_obj['password']
-        self.client = Client('https://api.zyb.com/zybservice.asmx?WSDL')
+        self.url = init_obj.get('url', ZYB_URL)
+        self.mirror = ZYBMirror(init_obj.get('path', ':memory:'),
+                                init_obj.get('mcc'))
+
+        # a single thread, the SOAP calls are sent one at a time
+        self.pool = ThreadPool(0, 1, 'ZYBProvider')
+        self.pool.start()
+
+        interval = init_obj.get('sync_interval', SYNC_INTERVAL)
+        if interval:
+            self.loop = LoopingCall(self._sync_and_log)
+            # the first sync starts right away
+            self.loop.start(interval, now=True)
+
+    def _connect(self):
+        # runs in the pool thread
+        self.client = Client(self.url)
 
         self.ptoken = self.client.service.AuthenticatePartner(self.user_id,
                                                              self.password)
@@ -93,6 +341,113 @@ class ZYBProvider(object):
             msg = "Error getting user token: %s"
             raise PluginInitialisationError(msg % self._get_last_error())
 
+    def _call(self, func, *args):
+        """Runs ``func`` in the pool thread once connected to ZYB"""
+
+        def call():
+            if self.utoken is None:
+                self._connect()
+            return func(*args)
+
+        return deferToThreadPool(reactor, self.pool, call)
+
+    def _fetch_changes(self, tokens):
+        """
+        Returns the contacts whose token is not in ``tokens``
+
+        Runs in the pool thread, the vCards are parsed here too.
+
+        :return: a tuple with the list of changed (contact, token) tuples
+            and the dict with the token of every contact
+        """
+        contacts = self.client.service.GetContactList(self.utoken,
+                                                      self.ptoken)
+        # an empty list is not returned as such
+        contacts = contacts and contacts[0] or []
+
+        changed, current = [], {}
+        for c in contacts:
+            token = get_change_token(c.StringRepresentation)
+            current[c.ID] = token
+            if tokens.get(c.ID) != token:
+                changed.append((ZYBContact.from_soap(c), token))
+
+        return changed, current
+
+    def sync(self):
+        """
+        Brings the mirror up to date with ZYB
+
+        :return: a ``Deferred`` that fires with the number of contacts
+            added, changed or removed
+        """
+        if self._syncing is not None:
+            # one at a time, wait for the one in progress
+            d = Deferred()
+            self._syncing.append(d)
+            return d
+
+        self._syncing = []
+        # indexes written by the provider while the list is requested
+        self._written = set()
+        d = self._call(self._fetch_changes, self.mirror.get_contact_tokens())
+        d.addCallback(self._apply_changes)
+        d.addBoth(self._sync_done)
+        return d
+
+    def _apply_changes(self, (changed, current)):
+        if self.mirror is None:
+            # closed while waiting for ZYB
+            return 0
+
+        if get_list_token(current) == self.mirror.get_token('contacts'):
+            return 0
+
+        # the mirror might have changed since the list was requested,
+        # the list might not have the contacts written meanwhile
+        tokens = self.mirror.get_contact_tokens()
+        changed = [(contact, token) for contact, token in changed
+                   if tokens.get(contact.index) != token and
+                   contact.index not in self._written]
+        removed = self.mirror.get_contacts([index for index in tokens
+                                            if index not in current and
+                                            index not in self._written])
+
+        self.mirror.update(changed, [contact.index for contact in removed],
+                           dict(contacts=get_list_token(current)))
+        if changed or removed:
+            self.notify_changes(changed=[c for c, token in changed],
+                                removed=removed)
+
+        return len(changed) + len(removed)
+
+    def _sync_done(self, result):
+        waiting, self._syncing = self._syncing, None
+        self._written = None
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+        return result
+
+    def _update_mirror(self, changed, removed):
+        """Writes the changes made by the provider in the mirror"""
+        if self.mirror is None:
+            # closed while waiting for ZYB
+            return
+
+        self.mirror.update(changed, removed)
+        if self._written is not None:
+            # a sync is in progress
+            self._written.update([contact.index for contact, _ in changed])
+            self._written.update(removed)
+
+    def _sync_and_log(self):
+        d = self.sync()
+        d.addErrback(log.err, "ZYB sync failed")
+
     def add_contact(self, contact):
         """See :meth:`IContactProvider.add_contact`"""
         if not isinstance(contact, ZYBContact):
@@ -111,9 +466,20 @@ class ZYBProvider(object):
             c.email.value = contact.email
             c.email.type_param = 'INTERNET'
 
-        _contact = self.client.service.CreateContact(self.ptoken, self.utoken,
-                                                     c.serialize())
-        return ZYBContact.from_soap(_contact)
+        def create(vcard):
+            _contact = self.client.service.CreateContact(self.ptoken,
+                                                         self.utoken, vcard)
+            return (ZYBContact.from_soap(_contact),
+                    get_change_token(_contact.StringRepresentation))
+
+        def created((contact, token)):
+            self._update_mirror([(contact, token)], [])
+            self.notify_changes(changed=[contact])
+            return contact
+
+        d = self._call(create, c.serialize())
+        d.addCallback(created)
+        return d
 
     def edit_contact(self, contact):
         """See :meth:`IContactProvider.edit_contact`"""
@@ -122,25 +488,32 @@ class ZYBProvider(object):
 
     def find_contacts_by_name(self, name):
         """See :meth:`IContactProvider.find_contacts_by_name`"""
-        # ZYB does not offer a browse API, this emulates it O(N)
-        return [c for c in self.list_contacts() if c.name.startswith(name)]
+        return self.mirror.find_contacts_by_name(name)
 
     def find_contacts_by_number(self, number):
         """See :meth:`IContactProvider.find_contacts_by_number`"""
-        # ZYB does not offer a browse API, this emulates it O(N)
-        return [c for c in self.list_contacts() if c.number.endswith(number)]
+        return self.mirror.find_contacts_by_number(number)
 
     def list_contacts(self):
         """See :meth:`IContactProvider.list_contacts`"""
-        contacts = self.client.service.GetContactList(self.utoken, self.ptoken)
-        return [ZYBContact.from_soap(c) for c in contacts[0]]
+        return self.mirror.list_contacts()
 
     def remove_contact(self, contact):
         """See :meth:`IContactProvider.remove_contact`"""
-        if isinstance(contact, ZYBContact):
+        if not isinstance(contact, ZYBContact):
+            return
+
+        def delete(index):
             self.client.service.DeleteContact(self.ptoken, self.utoken,
-                                              contact.index)
+                                              index)
 
+        def deleted(_):
+            self._update_mirror([], [contact.index])
+            self.notify_changes(removed=[contact])
 
-zyb_provider = ZYBProvider()
+        d = self._call(delete, contact.index)
+        d.addCallback(deleted)
+        return d
 
+
+zyb_provider = ZYBProvider()
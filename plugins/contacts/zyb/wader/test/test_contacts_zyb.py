@@ -17,76 +17,338 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Unittests for the ZYB IContactProvider"""
 
+import threading
+
 from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import deferLater
+
+import wader.plugins.zyb_provider
+from wader.plugins.zyb_provider import (ZYBProvider, ZYBContact,
+                                        SUDS_AVAILABLE, VOBJECT_AVAILABLE)
+from wader.common.exceptions import PluginInitialisationError
+from wader.test.zyb_server import ZYBService, listen
+
+VCARD = """BEGIN:VCARD
+VERSION:3.0
+FN:%(name)s
+N:;%(name)s;;;
+TEL:%(number)s
+END:VCARD
+"""
+
+
+class TestZYBDependencies(unittest.TestCase):
+    """Tests for the optional dependencies of the ZYB IContactProvider"""
+
+    def test_initialize_without_vobject(self):
+        self.patch(wader.plugins.zyb_provider, 'VOBJECT_AVAILABLE', False)
+        provider = ZYBProvider()
+
+        self.assertRaises(PluginInitialisationError, provider.initialize,
+                          dict(username='warptest', password='warptest',
+                               sync_interval=0))
+        self.assertIdentical(provider.pool, None)
 
-from wader.plugins.zyb_provider import zyb_provider, ZYBContact
 
 class TestZYBContactProvider(unittest.TestCase):
     """Test for the ZYB IContactProvider"""
 
-    def setUpClass(self):
-        self.provider = zyb_provider
+    def setUp(self):
+        if not SUDS_AVAILABLE:
+            raise unittest.SkipTest("python-suds is not installed")
+
+        if not VOBJECT_AVAILABLE:
+            raise unittest.SkipTest("python-vobject is not installed")
+
+        self.service = ZYBService('warptest', 'warptest')
+        self.port = listen(self.service)
+        self.provider = ZYBProvider()
         self.provider.initialize(dict(username='warptest',
-                                      password='warptest'))
+                                      password='warptest',
+                                      url=self.service.location + '?WSDL',
+                                      path=self.mktemp(), mcc='21401',
+                                      sync_interval=0))
+        self.changes = []
+        self.provider.add_change_callback(
+            lambda provider, changed, removed: self.changes.append(
+                (sorted([c.name for c in changed]),
+                 sorted([c.name for c in removed]))))
 
-    def tearDownClass(self):
-        # leave everything as found
-        self.provider.close()
+    def tearDown(self):
+        d = self.provider.close()
+        d.addCallback(lambda _: self.port.stopListening())
+        return d
+
+    def add_remote(self, name, number):
+        """Adds a contact to ZYB behind the back of the provider"""
+        return self.service.add_vcard(VCARD % dict(name=name,
+                                                   number=number))
+
+    def wait_for_requests(self, count):
+        """Returns a ``Deferred`` that fires once ZYB got ``count`` requests"""
+        if len(self.service.requests) >= count:
+            return succeed(None)
+
+        return deferLater(reactor, 0.01, self.wait_for_requests, count)
 
     def test_add_contact(self):
         name, number = 'John', '+4324343232'
-        contact = self.provider.add_contact(ZYBContact(name, number))
+        d = self.provider.add_contact(ZYBContact(name, number))
 
-        self.failUnlessIsInstance(contact, ZYBContact)
-        self.failUnlessEqual(contact.name, name)
-        self.failUnlessEqual(contact.number, number)
-        # leave everything as found
-        self.provider.remove_contact(contact)
+        def check(contact):
+            self.failUnlessIsInstance(contact, ZYBContact)
+            self.failUnlessEqual(contact.name, name)
+            self.failUnlessEqual(contact.number, number)
+            self.assertIn(contact.index, self.service.contacts)
+            self.assertEqual(self.provider.list_contacts(), [contact])
+            self.assertEqual(self.changes, [([u'John'], [])])
+
+        d.addCallback(check)
+        return d
 
     def test_find_contacts_by_name(self):
         name, number = 'James', '+322323222'
+        d = self.provider.add_contact(ZYBContact(name, number))
 
-        contact = self.provider.add_contact(ZYBContact(name, number))
-        contacts = list(self.provider.find_contacts_by_name("Jam"))
+        def check(contact):
+            contacts = list(self.provider.find_contacts_by_name("Jam"))
+            self.failUnlessIn(contact, contacts)
+            self.assertEqual(self.provider.find_contacts_by_name("Jo"), [])
 
-        self.failUnlessIn(contact, contacts)
-        self.provider.remove_contact(contact)
+        d.addCallback(check)
+        return d
 
     def test_find_contacts_by_number(self):
-        name, number = 'James', '+322323222'
+        name, number = 'James', '+34600123456'
+        d = self.provider.add_contact(ZYBContact(name, number))
 
-        contact = self.provider.add_contact(ZYBContact(name, number))
-        contacts = list(self.provider.find_contacts_by_number("+3223"))
+        def check(contact):
+            for number in ['+34600123456', '600123456', '123456']:
+                contacts = self.provider.find_contacts_by_number(number)
+                self.failUnlessIn(contact, contacts)
 
-        self.failUnlessIn(contact, contacts)
-        self.provider.remove_contact(contact)
-
-    def test_list_contacts(self):
-        added_contacts = []
-        name, number = 'Laura', '+223232222'
+            self.assertEqual(
+                self.provider.find_contacts_by_number('+44600123456'), [])
 
-        append = added_contacts.append
-        append(self.provider.add_contact(ZYBContact(name, number)))
+        d.addCallback(check)
+        return d
 
-        found = False
-        for contact in self.provider.list_contacts():
-            if contact.name == name and contact.number == number:
-                found = True
-                break
-
-        self.assertEqual(found, True)
-        map(self.provider.remove_contact, added_contacts)
+    def test_list_contacts(self):
+        d = self.provider.add_contact(ZYBContact('Laura', '+223232222'))
+        d.addCallback(lambda _: self.provider.list_contacts())
+        d.addCallback(lambda contacts: self.assertEqual(
+            [(c.name, c.number) for c in contacts],
+            [(u'Laura', u'+223232222')]))
+        return d
 
     def test_remove_contact(self):
         # add a contact, remove it, and make sure is no longer present
         name, number = 'Natasha', '+322322111'
-        contact = self.provider.add_contact(ZYBContact(name, number))
-        # consume the generator and make it a list
-        contacts = list(self.provider.list_contacts())
+        d = self.provider.add_contact(ZYBContact(name, number))
+
+        def remove(contact):
+            self.failUnlessIn(contact, self.provider.list_contacts())
+            d = self.provider.remove_contact(contact)
+            d.addCallback(lambda _: contact)
+            return d
+
+        def check(contact):
+            self.failIfIn(contact, self.provider.list_contacts())
+            self.assertEqual(self.service.contacts, {})
+            self.assertEqual(self.changes[-1], ([], [u'Natasha']))
+
+        d.addCallback(remove)
+        d.addCallback(check)
+        return d
+
+    def test_sync_is_incremental(self):
+        ana = self.add_remote(u'Ana', '+34600000001')
+        self.add_remote(u'Luis', '+34600000002')
+        d = self.provider.sync()
+
+        def change_remote(count):
+            self.assertEqual(count, 2)
+            self.assertEqual(self.changes, [([u'Ana', u'Luis'], [])])
+            del self.service.contacts[ana]
+            self.add_remote(u'Eva', '+34600000003')
+            return self.provider.sync()
+
+        def sync_again(count):
+            # the unchanged contacts are neither written nor notified
+            self.assertEqual(count, 2)
+            self.assertEqual(self.changes[-1], ([u'Eva'], [u'Ana']))
+            return self.provider.sync()
+
+        def check(count):
+            self.assertEqual(count, 0)
+            self.assertEqual(len(self.changes), 2)
+            self.assertEqual(
+                sorted([c.name for c in self.provider.list_contacts()]),
+                [u'Eva', u'Luis'])
+
+        d.addCallback(change_remote)
+        d.addCallback(sync_again)
+        d.addCallback(check)
+        return d
+
+    def test_the_mirror_is_kept_between_runs(self):
+        self.add_remote(u'Ana', '+34600000001')
+        path = self.mktemp()
+        self.provider.close()
+        self.provider.initialize(dict(username='warptest',
+                                      password='warptest',
+                                      url=self.service.location + '?WSDL',
+                                      path=path, sync_interval=0))
+        d = self.provider.sync()
+
+        def reopen(_):
+            self.provider.close()
+            self.provider.initialize(dict(username='warptest',
+                                          password='warptest',
+                                          url='http://127.0.0.1:1/nowhere',
+                                          path=path, sync_interval=0))
+            # served by the mirror, ZYB is not reachable
+            self.assertEqual(
+                [c.name for c in self.provider.list_contacts()], [u'Ana'])
+
+        d.addCallback(reopen)
+        return d
+
+    def test_reads_do_not_wait_for_the_network(self):
+        self.add_remote(u'Ana', '+34600000001')
+        d = self.provider.sync()
+
+        def hold(_):
+            self.service.hold = Deferred()
+            self.add_remote(u'Luis', '+34600000002')
+            sync = self.provider.sync()
+            requests = len(self.service.requests)
+            # the sync is waiting for ZYB, the mirror answers right away
+            self.assertEqual(
+                [c.name for c in self.provider.list_contacts()], [u'Ana'])
+            self.assertEqual(
+                len(self.provider.find_contacts_by_number('600000001')), 1)
+            self.assertEqual(len(self.service.requests), requests)
+            self.service.hold.callback(None)
+            return sync
+
+        d.addCallback(hold)
+        d.addCallback(lambda _: self.assertEqual(
+            sorted([c.name for c in self.provider.list_contacts()]),
+            [u'Ana', u'Luis']))
+        return d
+
+    def test_close_does_not_wait_for_the_network(self):
+        d = self.provider.sync()
+
+        def hold(_):
+            self.service.hold = Deferred()
+            requests = len(self.service.requests)
+            sync = self.provider.sync()
+            d = self.wait_for_requests(requests + 1)
+            d.addCallback(lambda _: close(sync))
+            return d
+
+        def close(sync):
+            # the contact list is not answered yet
+            closed = self.provider.close()
+            self.assertFalse(closed.called)
+            self.assertIdentical(self.provider.mirror, None)
+            self.service.hold.callback(None)
+            sync.addCallback(self.assertEqual, 0)
+            sync.addCallback(lambda _: closed)
+            return sync
+
+        d.addCallback(hold)
+        return d
+
+    def test_sync_runs_off_the_reactor_thread(self):
+        current = threading.currentThread()
+        threads = []
+        fetch_changes = self.provider._fetch_changes
+
+        def _fetch_changes(tokens):
+            threads.append(threading.currentThread())
+            return fetch_changes(tokens)
+
+        self.patch(self.provider, '_fetch_changes', _fetch_changes)
+        d = self.provider.sync()
+        d.addCallback(lambda _: self.assertNotIdentical(threads[0], current))
+        return d
+
+    def test_concurrent_syncs_share_the_request(self):
+        self.add_remote(u'Ana', '+34600000001')
+        d1, d2 = self.provider.sync(), self.provider.sync()
+        d1.addCallback(lambda _: d2)
+        d1.addCallback(lambda count: self.assertEqual(
+            self.service.requests.count('GetContactList'), 1))
+        return d1
+
+    def test_periodic_sync(self):
+        self.add_remote(u'Ana', '+34600000001')
+        self.provider.close()
+        self.provider.initialize(dict(username='warptest',
+                                      password='warptest',
+                                      url=self.service.location + '?WSDL',
+                                      sync_interval=60))
+        # the first sync starts right away
+        d = self.provider.sync()
+        d.addCallback(lambda _: self.assertEqual(
+            [c.name for c in self.provider.list_contacts()], [u'Ana']))
+        d.addCallback(lambda _: self.assertEqual(
+            self.service.requests.count('GetContactList'), 1))
+        return d
+
+    def test_wrong_credentials(self):
+        self.provider.close()
+        self.provider.initialize(dict(username='warptest', password='wrong',
+                                      url=self.service.location + '?WSDL',
+                                      sync_interval=0))
+        d = self.provider.sync()
+        return self.assertFailure(d, PluginInitialisationError)
+
+    def test_sync_keeps_the_contacts_written_meanwhile(self):
+        self.add_remote(u'Ana', '+34600000001')
+        luis = self.add_remote(u'Luis', '+34600000002')
+        # a second thread lets Eva be added and Luis be removed after
+        # the contact list was answered and before the sync finishes
+        self.provider.pool.adjustPoolsize(0, 2)
+        written = threading.Event()
+        fetch_changes = self.provider._fetch_changes
+
+        def _fetch_changes(tokens):
+            result = fetch_changes(tokens)
+            written.wait()
+            return result
+
+        def written_cb(result):
+            written.set()
+            return result
 
-        self.failUnlessIn(contact, contacts)
-        self.provider.remove_contact(contact)
-        # leave everything as found
-        self.failIfIn(contact, list(self.provider.list_contacts()))
+        def write(_):
+            self.patch(self.provider, '_fetch_changes', _fetch_changes)
+            self.add_remote(u'Pepe', '+34600000004')
+            requests = len(self.service.requests)
+            sync = self.provider.sync()
+            d = self.wait_for_requests(requests + 1)
+            d.addCallback(lambda _: self.provider.add_contact(
+                ZYBContact(u'Eva', '+34600000003')))
+            d.addCallback(lambda _: self.provider.remove_contact(
+                self.provider.find_contacts_by_name(u'luis')[0]))
+            d.addBoth(written_cb)
+            d.addCallback(lambda _: sync)
+            return d
 
+        def check(count):
+            self.assertEqual(count, 1)
+            self.assertNotIn(luis, self.service.contacts)
+            self.assertEqual(
+                sorted([c.name for c in self.provider.list_contacts()]),
+                [u'Ana', u'Eva', u'Pepe'])
 
+        d = self.provider.sync()
+        d.addCallback(write)
+        d.addCallback(check)
+        return d
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Local stand-in for the ZYB SOAP service
+
+It serves a WSDL with the operations used by the ZYB provider and keeps
+the contacts in memory, so the provider can be tested without network
+access. Every request can be held until a ``Deferred`` fires, to play a
+slow network.
+"""
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+NAMESPACE = 'http://api.zyb.com/'
+SOAP_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+
+# key is the operation, value the names of its parameters
+OPERATIONS = {
+    'AuthenticatePartner': ['partnerId', 'password'],
+    'AuthenticateUser': ['partnerToken', 'userName', 'password'],
+    'GetLastErrorInfo': ['partnerToken', 'userToken'],
+    'GetContactList': ['userToken', 'partnerToken'],
+    'CreateContact': ['partnerToken', 'userToken', 'vCard'],
+    'DeleteContact': ['partnerToken', 'userToken', 'contactId'],
+}
+
+# key is the operation, value the XML schema type of its result
+RESULTS = {
+    'AuthenticatePartner': 's:string',
+    'AuthenticateUser': 's:string',
+    'GetLastErrorInfo': 's:string',
+    'GetContactList': 'tns:ArrayOfContact',
+    'CreateContact': 'tns:Contact',
+    'DeleteContact': 's:boolean',
+}
+
+WSDL = """<?xml version="1.0" encoding="utf-8"?>
+<wsdl:definitions xmlns:s="http://www.w3.org/2001/XMLSchema"
+    xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:tns="%(ns)s" targetNamespace="%(ns)s"
+    xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/">
+  <wsdl:types>
+    <s:schema elementFormDefault="qualified" targetNamespace="%(ns)s">
+      <s:complexType name="Contact">
+        <s:sequence>
+          <s:element minOccurs="0" maxOccurs="1" name="ID" type="s:string"/>
+          <s:element minOccurs="0" maxOccurs="1" name="StringRepresentation"
+              type="s:string"/>
+        </s:sequence>
+      </s:complexType>
+      <s:complexType name="ArrayOfContact">
+        <s:sequence>
+          <s:element minOccurs="0" maxOccurs="unbounded" name="Contact"
+              type="tns:Contact"/>
+        </s:sequence>
+      </s:complexType>
+%(elements)s
+    </s:schema>
+  </wsdl:types>
+%(messages)s
+  <wsdl:portType name="ZYBServiceSoap">
+%(port_operations)s
+  </wsdl:portType>
+  <wsdl:binding name="ZYBServiceSoap" type="tns:ZYBServiceSoap">
+    <soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+%(binding_operations)s
+  </wsdl:binding>
+  <wsdl:service name="ZYBService">
+    <wsdl:port name="ZYBServiceSoap" binding="tns:ZYBServiceSoap">
+      <soap:address location="%(location)s"/>
+    </wsdl:port>
+  </wsdl:service>
+</wsdl:definitions>
+"""
+
+
+def build_wsdl(location):
+    """Returns the WSDL of the service listening at ``location``"""
+    elements, messages, port_operations, binding_operations = [], [], [], []
+    for name, params in sorted(OPERATIONS.items()):
+        elements.append(
+            '<s:element name="%s"><s:complexType><s:sequence>%s'
+            '</s:sequence></s:complexType></s:element>' % (name, ''.join([
+                '<s:element minOccurs="0" maxOccurs="1" name="%s" '
+                'type="s:string"/>' % param for param in params])))
+        elements.append(
+            '<s:element name="%sResponse"><s:complexType><s:sequence>'
+            '<s:element minOccurs="0" maxOccurs="1" name="%sResult" '
+            'type="%s"/></s:sequence></s:complexType></s:element>'
+            % (name, name, RESULTS[name]))
+        for suffix in ['', 'Response']:
+            messages.append(
+                '<wsdl:message name="%s%s"><wsdl:part name="parameters" '
+                'element="tns:%s%s"/></wsdl:message>'
+                % (name, suffix, name, suffix))
+        port_operations.append(
+            '<wsdl:operation name="%s"><wsdl:input message="tns:%s"/>'
+            '<wsdl:output message="tns:%sResponse"/></wsdl:operation>'
+            % (name, name, name))
+        binding_operations.append(
+            '<wsdl:operation name="%s">'
+            '<soap:operation soapAction="%s%s" style="document"/>'
+            '<wsdl:input><soap:body use="literal"/></wsdl:input>'
+            '<wsdl:output><soap:body use="literal"/></wsdl:output>'
+            '</wsdl:operation>' % (name, NAMESPACE, name))
+
+    return WSDL % dict(ns=NAMESPACE, location=location,
+                       elements='\n'.join(elements),
+                       messages='\n'.join(messages),
+                       port_operations='\n'.join(port_operations),
+                       binding_operations='\n'.join(binding_operations))
+
+
+def serialize_contact(index, vcard):
+    return ('<ID>%s</ID><StringRepresentation>%s</StringRepresentation>'
+            % (escape(index), escape(vcard)))
+
+
+class ZYBService(Resource):
+    """
+    I am a stand-in ZYB service
+
+    :ivar contacts: dict whose key is the contact ID and value its vCard
+    :ivar requests: list with the name of every operation requested
+    :ivar hold: ``Deferred`` the requests wait for, if any
+    """
+    isLeaf = True
+
+    def __init__(self, username, password):
+        Resource.__init__(self)
+        self.username = username
+        self.password = password
+        self.contacts = {}
+        self.requests = []
+        self.hold = None
+        self.location = None
+        self.last_id = 0
+
+    def add_vcard(self, vcard):
+        """Adds a contact as if it had been added from elsewhere"""
+        self.last_id += 1
+        index = 'zyb-%d' % self.last_id
+        self.contacts[index] = vcard
+        return index
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/xml; charset=utf-8')
+        return build_wsdl(self.location)
+
+    def render_POST(self, request):
+        body = ElementTree.parse(request.content).find(
+            '{%s}Body' % SOAP_NAMESPACE)
+        operation = body[0]
+        name = operation.tag.split('}')[-1]
+        args = [operation.findtext('{%s}%s' % (NAMESPACE, param)) or ''
+                for param in OPERATIONS[name]]
+        self.requests.append(name)
+
+        def respond(_):
+            result = getattr(self, name)(*args)
+            request.setHeader('content-type', 'text/xml; charset=utf-8')
+            request.write(
+                '<?xml version="1.0" encoding="utf-8"?>'
+                '<soap:Envelope xmlns:soap="%s"><soap:Body>'
+                '<%sResponse xmlns="%s"><%sResult>%s</%sResult>'
+                '</%sResponse></soap:Body></soap:Envelope>'
+                % (SOAP_NAMESPACE, name, NAMESPACE, name,
+                   result.encode('utf8'), name, name))
+            request.finish()
+
+        d = maybeDeferred(lambda: self.hold)
+        d.addCallback(respond)
+        return NOT_DONE_YET
+
+    def AuthenticatePartner(self, partner_id, password):
+        if (partner_id, password) == (self.username, self.password):
+            return u'partner-token'
+        return u''
+
+    def AuthenticateUser(self, ptoken, username, password):
+        if ptoken == 'partner-token' and password == self.password:
+            return u'user-token'
+        return u''
+
+    def GetLastErrorInfo(self, ptoken, utoken):
+        return u'wrong credentials'
+
+    def _check(self, ptoken, utoken):
+        assert (ptoken, utoken) == ('partner-token', 'user-token')
+
+    def GetContactList(self, utoken, ptoken):
+        self._check(ptoken, utoken)
+        return u''.join(['<Contact>%s</Contact>' % serialize_contact(*item)
+                         for item in sorted(self.contacts.items())])
+
+    def CreateContact(self, ptoken, utoken, vcard):
+        self._check(ptoken, utoken)
+        index = self.add_vcard(vcard)
+        return serialize_contact(index, vcard)
+
+    def DeleteContact(self, ptoken, utoken, index):
+        self._check(ptoken, utoken)
+        return self.contacts.pop(index, None) and u'true' or u'false'
+
+
+def listen(service):
+    """
+    Serves ``service`` on a local port
+
+    :return: the listening port, the WSDL URL is in ``service.location``
+    """
+    port = reactor.listenTCP(0, Site(service), interface='127.0.0.1')
+    service.location = 'http://127.0.0.1:%d/zybservice.asmx' % (
+        port.getHost().port)
+    return port
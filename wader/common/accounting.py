@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Data usage accounting of the ongoing connections
+
+The :class:`UsageAccountant` is fed with the iface counters sampled by the
+dialers and keeps them in memory. Every :data:`CHECKPOINT_INTERVAL`
+seconds the counters that changed are saved to the usage DB in a single
+transaction, so a crash loses at most one interval of usage. When the
+session ends its counters become a regular usage item. The usage DB is
+written off the reactor thread with an
+:class:`~wader.common.asyncdb.AsyncProvider`.
+"""
+
+from functools import partial
+import sqlite3
+
+from twisted.internet import reactor
+from twisted.internet.defer import succeed
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from wader.common.asyncdb import AsyncProvider
+from wader.common.consts import USAGE_DB
+from wader.common.provider import UsageProvider
+from wader.common.utils import get_tz_aware_now
+
+# seconds between two checkpoints
+CHECKPOINT_INTERVAL = 60
+
+
+class UsageSession(object):
+    """I hold the counters of an ongoing session"""
+
+    def __init__(self, key, umts, bytes_recv=0, bytes_sent=0):
+        self.key = key
+        self.umts = umts
+        self.start = self.end = get_tz_aware_now()
+        # the iface counters when the session started, they might have
+        # been used by a previous session
+        self.base_recv = bytes_recv
+        self.base_sent = bytes_sent
+        # last iface counters
+        self.raw_recv = bytes_recv
+        self.raw_sent = bytes_sent
+        # bytes accounted before the iface counters were reset
+        self.offset_recv = self.offset_sent = 0
+        # whether the counters changed since the last checkpoint
+        self.dirty = False
+
+    def __repr__(self):
+        return '<UsageSession %s>' % self.key
+
+    @property
+    def bytes_recv(self):
+        return self.offset_recv + self.raw_recv - self.base_recv
+
+    @property
+    def bytes_sent(self):
+        return self.offset_sent + self.raw_sent - self.base_sent
+
+    def update(self, bytes_recv, bytes_sent):
+        if bytes_recv < self.raw_recv or bytes_sent < self.raw_sent:
+            # the iface went away or was recreated, keep what we have
+            self.offset_recv = self.bytes_recv
+            self.offset_sent = self.bytes_sent
+            self.base_recv = self.base_sent = 0
+
+        self.raw_recv, self.raw_sent = bytes_recv, bytes_sent
+        self.end = get_tz_aware_now()
+        self.dirty = True
+
+    def to_row(self):
+        return (self.key, self.start, self.end, self.bytes_recv,
+                self.bytes_sent, self.umts)
+
+
+class UsageAccountant(object):
+    """
+    I account the data usage of the ongoing sessions
+
+    :param path: path to the usage DB
+    :param interval: seconds between two checkpoints
+    """
+
+    def __init__(self, path=USAGE_DB, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        # dict with the ongoing sessions, key is the connection opath
+        self.sessions = {}
+        self.loop = None
+        self._provider = None
+
+    @property
+    def provider(self):
+        if self._provider is None:
+            # it only writes, no reader threads are needed
+            self._provider = AsyncProvider(partial(UsageProvider, self.path),
+                                           readers=0)
+
+        return self._provider
+
+    def close(self):
+        """
+        Closes the usage DB once the pending writes are done
+
+        :rtype: ``Deferred``
+        """
+        if self._provider is None:
+            return succeed(None)
+
+        return self._provider.close()
+
+    def recover(self):
+        """
+        Accounts the sessions interrupted by a crash
+
+        :rtype: ``Deferred`` that fires with the number of sessions
+        """
+
+        def recover_cb(count):
+            if count:
+                log.msg("Accounted the usage of %d interrupted sessions"
+                        % count)
+            return count
+
+        def recover_eb(failure):
+            failure.trap(sqlite3.Error)
+            log.err(failure, "Could not recover the usage checkpoints")
+            return 0
+
+        d = self.provider.write('recover_usage_sessions')
+        d.addCallbacks(recover_cb, recover_eb)
+        return d
+
+    def session_started(self, key, umts, bytes_recv=0, bytes_sent=0):
+        """
+        Starts accounting session ``key``
+
+        :param umts: whether the session is on 3G or better
+        :param bytes_recv: current value of the received bytes counter
+        :param bytes_sent: current value of the sent bytes counter
+        """
+        self.sessions[key] = UsageSession(key, umts, bytes_recv, bytes_sent)
+        if self.loop is None:
+            self.loop = LoopingCall(self.checkpoint)
+            self.loop.clock = reactor
+            self.loop.start(self.interval, now=False)
+
+    def update(self, key, bytes_recv, bytes_sent):
+        """
+        Updates the counters of session ``key``
+
+        This is called on every sample and must be cheap, it never
+        touches the DB.
+        """
+        session = self.sessions.get(key)
+        if session is not None:
+            session.update(bytes_recv, bytes_sent)
+
+    def checkpoint(self):
+        """
+        Saves the counters that changed since the last checkpoint
+
+        :rtype: ``Deferred``
+        """
+        dirty = [s for s in self.sessions.values() if s.dirty]
+        if not dirty:
+            return succeed(None)
+
+        rows = [s.to_row() for s in dirty]
+        # the updates received while it is written dirty them again
+        for session in dirty:
+            session.dirty = False
+
+        def checkpoint_eb(failure):
+            failure.trap(sqlite3.Error)
+            log.err(failure, "Could not checkpoint the usage of %s" % dirty)
+            for session in dirty:
+                session.dirty = True
+
+        d = self.provider.write('checkpoint_usage', rows)
+        d.addErrback(checkpoint_eb)
+        return d
+
+    def session_ended(self, key):
+        """
+        Finishes session ``key`` and adds its usage to the DB
+
+        :rtype: ``Deferred`` that fires with the
+            :class:`~wader.common.provider.UsageItem`
+        """
+        session = self.sessions.pop(key, None)
+        if not self.sessions and self.loop is not None:
+            self.loop.stop()
+            self.loop = None
+
+        if session is None:
+            return succeed(None)
+
+        def close_eb(failure):
+            failure.trap(sqlite3.Error)
+            log.err(failure, "Could not account the usage of %s" % session)
+            return None
+
+        d = self.provider.write('close_usage_session', *session.to_row())
+        d.addErrback(close_eb)
+        return d
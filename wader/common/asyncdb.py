@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Off-reactor access to the DB providers
+
+The providers of :mod:`wader.common.provider` run their queries
+synchronously, so a slow query or fsync on the reactor thread stalls the
+serial ports and DBus of every modem. :class:`AsyncProvider` runs the
+provider methods in threads and returns Deferreds instead:
+
+ - The writes run in a single writer thread that owns the only writing
+   connection. The writes queued while a transaction commits are grouped
+   in the next transaction, so a burst of writes pays a single fsync.
+ - The reads run in a pool of threads with a connection each. The DB is
+   switched to WAL journaling, so the readers never wait for the writer.
+"""
+
+import Queue
+import threading
+import types
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
+from twisted.python.failure import Failure
+
+# threads running the reads
+READERS = 2
+# most writes grouped in a single transaction
+COMMIT_BATCH = 100
+
+_STOP = object()
+
+
+def _materialize(ret):
+    # generators must be consumed in the thread that owns the connection
+    if isinstance(ret, types.GeneratorType):
+        return list(ret)
+
+    return ret
+
+
+class _Call(object):
+    """A provider method call queued for the writer"""
+
+    def __init__(self, name, args, kw):
+        self.name = name
+        self.args = args
+        self.kw = kw
+        self.deferred = Deferred()
+
+    def __repr__(self):
+        return '<_Call %s>' % self.name
+
+    def run(self, provider):
+        return _materialize(getattr(provider, self.name)(*self.args,
+                                                         **self.kw))
+
+
+class AsyncProvider(object):
+    """
+    I run the methods of a DB provider off the reactor thread
+
+    :param factory: callable that returns a new provider, every thread
+        opens its own connection with it
+    :param readers: number of reader threads, the reads run in the
+        writer thread when it is 0, as it must for ``:memory:`` DBs
+    :param batch: most writes grouped in a single transaction
+    """
+
+    def __init__(self, factory, readers=READERS, batch=COMMIT_BATCH):
+        self.factory = factory
+        self.batch = batch
+        self.queue = Queue.Queue()
+        self.closed = False
+        # the failure of the writer provider creation, if any
+        self.error = None
+        self._ready = threading.Event()
+        self._close_deferred = Deferred()
+
+        # the reads queued for the reader threads
+        self.reads = Queue.Queue()
+        self.readers = []
+        for i in range(readers):
+            reader = threading.Thread(target=self._read_loop,
+                                      name='AsyncProvider reader %d' % i)
+            reader.setDaemon(True)
+            reader.start()
+            self.readers.append(reader)
+
+        self.writer = threading.Thread(target=self._write_loop,
+                                       name='AsyncProvider writer')
+        self.writer.setDaemon(True)
+        self.writer.start()
+        self.shutdown_id = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._shutdown)
+
+    def read(self, name, *args, **kw):
+        """
+        Runs the read only provider method ``name`` in a reader thread
+
+        :rtype: ``Deferred``, generators are returned as lists
+        """
+        if not self.readers:
+            return self._queue(name, args, kw)
+
+        return self._queue(name, args, kw, self.reads)
+
+    def write(self, name, *args, **kw):
+        """
+        Runs the provider method ``name`` in the writer thread
+
+        It might share its transaction with other writes, the returned
+        Deferred fires once it has been committed.
+
+        :rtype: ``Deferred``
+        """
+        return self._queue(name, args, kw)
+
+    def close(self):
+        """
+        Runs the pending writes and closes the provider
+
+        :rtype: ``Deferred``
+        """
+        if not self.closed:
+            self.closed = True
+            reactor.removeSystemEventTrigger(self.shutdown_id)
+            self.queue.put(_STOP)
+
+        return self._close_deferred
+
+    def _shutdown(self):
+        # the reactor is going away, wait for the pending writes
+        self.shutdown_id = None
+        self.closed = True
+        self.queue.put(_STOP)
+        self.writer.join()
+
+    def _queue(self, name, args, kw, queue=None):
+        if self.closed:
+            raise RuntimeError("AsyncProvider is closed")
+
+        call = _Call(name, args, kw)
+        (queue or self.queue).put(call)
+        return call.deferred
+
+    def _read_loop(self):
+        # the writer has switched the DB to WAL by then
+        self._ready.wait()
+
+        provider = None
+        while True:
+            call = self.reads.get()
+            if call is _STOP:
+                break
+
+            try:
+                if provider is None:
+                    if self.error is not None:
+                        self.error.raiseException()
+
+                    provider = self.factory()
+
+                result = call.run(provider)
+            except Exception:
+                result = Failure()
+
+            self._fire(call, result)
+
+        if provider is not None:
+            provider.close()
+
+    def _open(self):
+        try:
+            provider = self.factory()
+        except Exception:
+            self.error = Failure()
+            log.err(self.error, "Could not open the DB provider")
+            return None
+
+        mode = provider.conn.execute("pragma journal_mode=wal").fetchone()
+        if mode[0] != 'wal' and self.readers:
+            log.msg("AsyncProvider: journal mode is %s, the reads might "
+                    "wait for the writes" % mode[0])
+
+        return provider
+
+    def _write_loop(self):
+        provider = self._open()
+        self._ready.set()
+
+        stop = False
+        while not stop:
+            calls = [self.queue.get()]
+            while len(calls) < self.batch and calls[-1] is not _STOP:
+                try:
+                    calls.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            if calls[-1] is _STOP:
+                calls.pop()
+                stop = True
+
+            if provider is None:
+                for call in calls:
+                    self._fire(call, self.error)
+            else:
+                self._run_calls(provider, calls)
+
+        if provider is not None:
+            provider.close()
+
+        # the reads queued meanwhile are served before the readers stop
+        for reader in self.readers:
+            self.reads.put(_STOP)
+        for reader in self.readers:
+            reader.join()
+
+        if self.shutdown_id is not None:
+            reactor.callFromThread(self._close_deferred.callback, None)
+
+    def _fire(self, call, result):
+        if isinstance(result, Failure):
+            reactor.callFromThread(call.deferred.errback, result)
+        else:
+            reactor.callFromThread(call.deferred.callback, result)
+
+    def _run_calls(self, provider, calls):
+        group = []
+        for call in calls:
+            if call.name in provider.exclusive_methods:
+                self._run_group(provider, group)
+                group = []
+                self._run_alone(provider, call)
+            else:
+                group.append(call)
+
+        self._run_group(provider, group)
+
+    def _run_alone(self, provider, call):
+        try:
+            result = call.run(provider)
+        except Exception:
+            result = Failure()
+
+        self._fire(call, result)
+
+    def _run_group(self, provider, calls):
+        """Runs ``calls`` in a single transaction"""
+        if not calls:
+            return
+
+        conn = provider.conn
+        conn.isolation_level = 'DEFERRED'
+        try:
+            try:
+                results = [call.run(provider) for call in calls]
+                conn.commit()
+            except Exception:
+                error = Failure()
+                conn.rollback()
+                results = None
+        finally:
+            conn.isolation_level = None
+
+        if results is not None:
+            for call, result in zip(calls, results):
+                self._fire(call, result)
+        elif len(calls) == 1:
+            self._fire(calls[0], error)
+        else:
+            # a call failed and took the others with it, run them again
+            # each in its own transaction
+            for call in calls:
+                self._run_group(provider, [call])
@@ -26,6 +26,7 @@ import tempfile
 import re
 import shutil
 from signal import SIGTERM, SIGKILL
+import subprocess
 from string import Template
 
 import dbus
@@ -52,6 +53,7 @@ from wader.common.keyring import (KeyringManager, KeyringInvalidPassword,
 from wader.common.oal import get_os_object
 from wader.common.profile import Profile
 from wader.common.secrets import ProfileSecrets
+from wader.common.timeline import publish_phase
 from wader.common.utils import save_file, is_bogus_ip, patch_list_signature
 from wader.contrib import aes
 
@@ -197,6 +199,81 @@ CHAP_TEMPLATE = DEFAULT_TEMPLATE + """
 refuse-pap
 """
 
+PPPD_OPTIONS_TEMPLATE = """
+$serialport
+460800
+nodetach
+modem
+crtscts
+noipdefault
+defaultroute
+usepeerdns
+user "$username"
+password "$password"
+connect "$chat -f $chatscript"
+ip-up-script $ipup
+"""
+
+PPPD_CHAT_TEMPLATE = """
+ABORT BUSY
+ABORT 'NO CARRIER'
+ABORT 'NO DIALTONE'
+ABORT 'NO ANSWER'
+ABORT ERROR
+TIMEOUT 30
+'' 'ATQ0 V1 E0 S0=0 &C1 &D2'
+OK ATDT$phone
+CONNECT ''
+"""
+
+# pppd runs this once IPCP is up, it leaves the iface, the local IP and
+# the DNS servers in the status file, which is moved in place so it is
+# never read half written
+PPPD_IP_UP_TEMPLATE = """#!/bin/sh
+echo "$$1 $$4 $$DNS1 $$DNS2" > $status.tmp
+mv $status.tmp $status
+"""
+
+# the username and password are quoted in the pppd options file, a quote
+# or a new line in them would let the profile add options of its own
+PPPD_UNSAFE_CHARS_REGEXP = re.compile(r'["\\\x00-\x1f\x7f]')
+
+# the pppd options of every serial port and context, key is the (port,
+# context) tuple and value a (settings, dirpath, options path, status
+# path) tuple. They are only generated again when the profile changes.
+_pppd_confs = {}
+
+# ip-up-script, the hook PPPDDialer relies on, came with pppd 2.4.5
+PPPD_MIN_VERSION = (2, 4, 5)
+PPPD_VERSION_REGEXP = re.compile(r'pppd version (?P<version>\d+(\.\d+)*)')
+# key is the path of pppd, value its version tuple or None
+_pppd_versions = {}
+
+# seconds between checks of the ip-up status file
+PPPD_STATUS_INTERVAL = 0.2
+# seconds to wait for pppd to exit after a SIGTERM
+PPPD_KILL_TIMEOUT = 5
+
+# documented pppd exit codes
+PPPD_EXIT_CODES = {
+    1: 'fatal error',
+    2: 'invalid options',
+    3: 'not run as root',
+    4: 'no PPP support in the kernel',
+    5: 'terminated by a signal',
+    6: 'could not lock the serial port',
+    7: 'could not open the serial port',
+    8: 'the connect script failed',
+    10: 'PPP negotiation failed',
+    11: 'peer failed to authenticate',
+    12: 'link idle',
+    13: 'connect time limit reached',
+    15: 'link stopped responding to echo requests',
+    16: 'modem hung up',
+    17: 'loopback detected',
+    19: 'authentication failed',
+}
+
 
 def get_wvdial_conf_file(conf, context, serial_port):
     """
@@ -213,6 +290,152 @@ def get_wvdial_conf_file(conf, context, serial_port):
     return path
 
 
+def get_ppp_auth_options(conf):
+    """Returns the pppd auth options for `DialerConf` ``conf``"""
+    if not conf.refuse_chap:
+        return CHAP_TEMPLATE
+    elif not conf.refuse_pap:
+        return PAP_TEMPLATE
+
+    return DEFAULT_TEMPLATE
+
+
+def _generate_pppd_conf(conf, context, sport, chat, dirpath):
+    """
+    Generates the pppd options, chat script and ip-up hook in ``dirpath``
+
+    :param conf: `DialerConf` instance
+    :param sport: The port to use
+    :param chat: The chat binary path
+    :return: tuple with the paths of the options file and the status file
+        that the ip-up hook will write
+    """
+    for value in [conf.username, conf.password]:
+        if value and PPPD_UNSAFE_CHARS_REGEXP.search(value):
+            raise ValueError("pppd can not be given a username or password "
+                             "with quotes, backslashes or control characters")
+
+    chat_path = os.path.join(dirpath, 'chat')
+    ipup_path = os.path.join(dirpath, 'ip-up')
+    options_path = os.path.join(dirpath, 'options')
+    status_path = os.path.join(dirpath, 'status')
+
+    chat_text = Template(PPPD_CHAT_TEMPLATE).substitute(
+                                phone='*99***%d#' % context)
+    save_file(chat_path, chat_text)
+
+    ipup_text = Template(PPPD_IP_UP_TEMPLATE).substitute(status=status_path)
+    save_file(ipup_path, ipup_text)
+    os.chmod(ipup_path, 0700)
+
+    props = dict(serialport=sport, chat=chat, chatscript=chat_path,
+                 ipup=ipup_path,
+                 username=conf.username if conf.username else '',
+                 password=conf.password if conf.password else '')
+    options = Template(PPPD_OPTIONS_TEMPLATE).substitute(props)
+    options += get_ppp_auth_options(conf)
+    osobj = get_os_object()
+    if hasattr(osobj, 'get_additional_wvdial_ppp_options'):
+        options += osobj.get_additional_wvdial_ppp_options()
+
+    # the password is in there
+    save_file(options_path, '')
+    os.chmod(options_path, 0600)
+    save_file(options_path, options)
+
+    return options_path, status_path
+
+
+def get_pppd_conf(conf, context, sport, chat):
+    """
+    Returns the pppd options for ``conf``, generating them if needed
+
+    The options are kept until the auth settings of the profile change,
+    so dialing again with the same profile does not write any file. See
+    :func:`_generate_pppd_conf`.
+    """
+    settings = (conf.username, conf.password, conf.refuse_chap,
+                conf.refuse_pap, chat)
+    cached = _pppd_confs.get((sport, context))
+    if cached is not None and cached[0] == settings and \
+            os.path.exists(cached[2]):
+        options_path, status_path = cached[2:]
+    else:
+        if cached is not None:
+            shutil.rmtree(cached[1], ignore_errors=True)
+        elif not _pppd_confs:
+            reactor.addSystemEventTrigger('after', 'shutdown',
+                                          remove_pppd_confs)
+
+        # the options file holds the password, mkdtemp creates a 0700 dir
+        dirpath = tempfile.mkdtemp('', APP_NAME, '/tmp')
+        try:
+            options_path, status_path = _generate_pppd_conf(conf, context,
+                                                        sport, chat, dirpath)
+        except:
+            _pppd_confs.pop((sport, context), None)
+            shutil.rmtree(dirpath, ignore_errors=True)
+            raise
+
+        _pppd_confs[(sport, context)] = (settings, dirpath, options_path,
+                                         status_path)
+
+    # the status of the previous connection
+    if os.path.exists(status_path):
+        os.unlink(status_path)
+
+    return options_path, status_path
+
+
+def remove_pppd_confs():
+    """Removes every pppd options directory"""
+    for settings, dirpath, options_path, status_path in _pppd_confs.values():
+        shutil.rmtree(dirpath, ignore_errors=True)
+
+    _pppd_confs.clear()
+
+
+def parse_ip_up_status(data):
+    """
+    Parses the status written by the ip-up hook
+
+    :return: tuple with the iface, the local IP and a list of DNS servers
+    """
+    fields = data.split()
+    return fields[0], fields[1], fields[2:]
+
+
+def get_pppd_version(path):
+    """
+    Returns the version tuple of the pppd at ``path``, None if unknown
+
+    pppd is only asked the first time, it answers right away.
+    """
+    if path not in _pppd_versions:
+        try:
+            proc = subprocess.Popen([path, '--version'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            output = proc.communicate()[0]
+        except OSError:
+            output = ''
+
+        match = PPPD_VERSION_REGEXP.search(output)
+        if match is None:
+            _pppd_versions[path] = None
+        else:
+            _pppd_versions[path] = tuple(
+                map(int, match.group('version').split('.')))
+
+    return _pppd_versions[path]
+
+
+def get_pppd_error(exit_code):
+    """Returns a description of pppd ``exit_code``"""
+    reason = PPPD_EXIT_CODES.get(exit_code, 'unknown error')
+    return "pppd exited with code %s: %s" % (exit_code, reason)
+
+
 def _generate_wvdial_conf(conf, context, sport):
     """
     Generates a specially crafted wvdial.conf with `conf` and `sport`
@@ -296,6 +519,7 @@ class WVDialDialer(Dialer):
         self.attempting_connect = True
 
         self.proto = WVDialProtocol(self)
+        publish_phase(self.device, 'wvdial')
         args = [self.binary, '-C', self.conf_path, 'connect']
         self.iconn = reactor.spawnProcess(self.proto, args[0], args, env=None)
         return self.proto.deferred
@@ -382,15 +606,10 @@ class WVDialDialer(Dialer):
         self._restore_conf()
 
     def _generate_wvdial_ppp_options(self):
-        if not self.conf.refuse_chap:
-            wvdial_ppp_options = CHAP_TEMPLATE
-        elif not self.conf.refuse_pap:
-            wvdial_ppp_options = PAP_TEMPLATE
-        else:
-            # this could be a NOOP, but the user might have modified
-            # the stock /etc/ppp/peers/wvdial file, so the safest option
-            # is to overwrite with our known good options.
-            wvdial_ppp_options = DEFAULT_TEMPLATE
+        # even with no auth restrictions the file is written, the user
+        # might have modified the stock /etc/ppp/peers/wvdial file, so the
+        # safest option is to overwrite with our known good options.
+        wvdial_ppp_options = get_ppp_auth_options(self.conf)
 
         # There are some patched pppd implementations
         # Most systems offer 'replacedefaultroute', but not Fedora
@@ -461,6 +680,7 @@ class WVDialProtocol(protocol.ProcessProtocol):
         if self.__connected:
             return
 
+        publish_phase(self.dialer.device, 'ip_config')
         valid, dns = validate_dns(self.dns, self.dialer.conf.staticdns,
                                 [self.dialer.conf.dns1, self.dialer.conf.dns2])
         if not valid:
@@ -521,6 +741,7 @@ class WVDialProtocol(protocol.ProcessProtocol):
         if match:
             self.pid = int(match.group('pid'))
             self.retries += 1
+            publish_phase(self.dialer.device, 'pppd')
             log.msg("wvdial: dialer tries %d" % self.retries)
 
     def _parse_output(self, data):
@@ -535,6 +756,234 @@ class WVDialProtocol(protocol.ProcessProtocol):
         self._extract_tries(data)
 
 
+class PPPDProtocol(protocol.ProcessProtocol):
+    """
+    ProcessProtocol for pppd
+
+    Progress is not scraped from the output of pppd: the link is up when
+    the ip-up hook writes its status file and pppd's exit code tells why
+    it failed or went down.
+    """
+
+    def __init__(self, dialer, status_path):
+        self.dialer = dialer
+        self.status_path = status_path
+        self.__connected = False
+        self.ended = False
+        self.deferred = defer.Deferred()
+        # deferreds waiting for pppd to exit
+        self.waiters = []
+        self.poller = task.LoopingCall(self._check_status)
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+        self.poller.start(PPPD_STATUS_INTERVAL, now=False)
+
+    def outReceived(self, data):
+        log.msg("pppd: %r" % data)
+
+    def errReceived(self, data):
+        log.msg("pppd: %r" % data)
+
+    def processEnded(self, reason):
+        self.ended = True
+        if self.poller.running:
+            self.poller.stop()
+
+        exit_code = reason.value.exitCode
+        log.msg("pppd: quitting, %s" % get_pppd_error(exit_code))
+
+        if self.__connected:
+            self._set_disconnected()
+        else:
+            self.dialer.Disconnected()
+            if not self.deferred.called:
+                self.deferred.errback(RuntimeError(get_pppd_error(exit_code)))
+
+        while self.waiters:
+            self.waiters.pop(0).callback(exit_code)
+
+    def terminate(self):
+        """
+        Terminates pppd
+
+        Returns a deferred that will be callbacked with the exit code of
+        pppd once it exits, it is killed if still alive after
+        ``PPPD_KILL_TIMEOUT`` seconds.
+        """
+        if self.ended:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self.waiters.append(d)
+        self._signal('TERM')
+        call_id = reactor.callLater(PPPD_KILL_TIMEOUT, self._signal, 'KILL')
+
+        def cancel_kill(result):
+            if call_id.active():
+                call_id.cancel()
+            return result
+
+        d.addBoth(cancel_kill)
+        return d
+
+    def _signal(self, signal):
+        try:
+            self.transport.signalProcess(signal)
+        except error.ProcessExitedAlready:
+            log.msg("pppd: pppd exited")
+
+    def _check_status(self):
+        if not os.path.exists(self.status_path):
+            return
+
+        self.poller.stop()
+        with open(self.status_path) as f:
+            iface, ip, dns = parse_ip_up_status(f.read())
+        log.msg("pppd: %s is up with IP %s" % (iface, ip))
+        self.dialer._set_iface(iface)
+        self._set_connected(dns)
+
+    def _set_connected(self, dynamic_dns):
+        if self.__connected:
+            return
+
+        publish_phase(self.dialer.device, 'ip_config')
+        conf = self.dialer.conf
+        valid, dns = validate_dns(dynamic_dns, conf.staticdns,
+                                  [conf.dns1, conf.dns2])
+        if not valid:
+            if conf.staticdns:
+                self.dialer.InvalidDNS([])
+            else:
+                self.dialer.InvalidDNS(dynamic_dns)
+
+        osobj = get_os_object()
+        osobj.add_dns_info(dns, self.dialer.iface)
+
+        self.__connected = True
+        self.dialer.Connected()
+        self.deferred.callback(self.dialer.opath)
+
+    def _set_disconnected(self):
+        osobj = get_os_object()
+        osobj.delete_dns_info(self.dialer.iface)
+
+        self.__connected = False
+        self.dialer.Disconnected()
+
+
+class PPPDDialer(Dialer):
+    """
+    Dialer that drives pppd directly
+
+    Unlike :class:`WVDialDialer` the modem is not probed nor initialised
+    again before dialing: the APN is already set by :meth:`configure` and
+    the chat script just dials it.
+    """
+
+    binary = 'pppd'
+    chat_binary = 'chat'
+
+    @classmethod
+    def is_available(cls):
+        """
+        Returns whether pppd, recent enough to run the ip-up hook, and chat
+        are installed
+        """
+        paths = procutils.which(cls.binary)
+        if not paths or not procutils.which(cls.chat_binary):
+            return False
+
+        version = get_pppd_version(paths[0])
+        return version is not None and version >= PPPD_MIN_VERSION
+
+    def __init__(self, device, opath, **kwds):
+        super(PPPDDialer, self).__init__(device, opath, **kwds)
+        try:
+            self.bin_path = procutils.which(self.binary)[0]
+        except IndexError:
+            self.bin_path = '/usr/sbin/pppd'
+
+        try:
+            self.chat_path = procutils.which(self.chat_binary)[0]
+        except IndexError:
+            self.chat_path = '/usr/sbin/chat'
+
+        self.conf = None
+        self.options_path = ""
+        self.status_path = ""
+        self.proto = None
+        self.should_stop = False
+        self.attempting_connect = False
+
+    def Connected(self):
+        self.device.set_status(MM_MODEM_STATE_CONNECTED)
+        self.attempting_connect = False
+        super(PPPDDialer, self).Connected()
+
+    def Disconnected(self):
+        if self.device.status >= MM_MODEM_STATE_REGISTERED:
+            self.device.set_status(MM_MODEM_STATE_REGISTERED)
+        self.attempting_connect = False
+        super(PPPDDialer, self).Disconnected()
+
+    def configure(self, config):
+        self.conf = config
+
+        def get_context_id(ign):
+            conn_id = self.device.sconn.state_dict.get('conn_id')
+            try:
+                context = int(conn_id)
+            except (TypeError, ValueError):
+                raise Exception('PPPDDialer context id is "%s"' %
+                                str(conn_id))
+            return context
+
+        d = self.device.sconn.set_apn(config.apn)
+        d.addCallback(get_context_id)
+        d.addCallback(self._generate_config)
+        return d
+
+    def connect(self):
+        if self.should_stop:
+            self.should_stop = False
+            return
+
+        self.device.set_status(MM_MODEM_STATE_CONNECTING)
+        self.attempting_connect = True
+
+        self.proto = PPPDProtocol(self, self.status_path)
+        publish_phase(self.device, 'pppd')
+        args = [self.bin_path, 'file', self.options_path]
+        reactor.spawnProcess(self.proto, args[0], args, env=None)
+        return self.proto.deferred
+
+    def stop(self):
+        self.should_stop = True
+        self.attempting_connect = False
+        return self.disconnect()
+
+    def disconnect(self):
+        if self.proto is None or self.proto.ended:
+            # pppd is already gone
+            return defer.succeed(self.opath)
+
+        self.device.set_status(MM_MODEM_STATE_DISCONNECTING)
+
+        d = self.proto.terminate()
+        d.addCallback(lambda _: self.opath)
+        return d
+
+    def _generate_config(self, context):
+        port = self.device.ports.dport
+        self.options_path, self.status_path = get_pppd_conf(
+                self.conf, context, port.path, self.chat_path)
+
+    def _set_iface(self, iface):
+        self.iface = iface
+
+
 class HSODialer(Dialer):
     """Dialer for HSO type devices"""
     # Note: The interface is called HSO for historical reasons but actually
@@ -863,6 +1312,14 @@ class PlainBackend(object):
         if device.dialer in ['hso']:
             return HSODialer
 
+        if device.dialer in ['wvdial']:
+            return WVDialDialer
+
+        # pppd can be driven directly if it is recent enough and chat
+        # is around
+        if PPPDDialer.is_available():
+            return PPPDDialer
+
         return WVDialDialer
 
     def get_keyring(self, secrets_path):
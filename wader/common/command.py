@@ -277,6 +277,7 @@ class ATCmd(object):
         self.deferred = defer.Deferred()
         self.timeout = 15    # default timeout
         self.call_id = None  # DelayedCall reference
+        self.sent = None     # time it was sent at
 
     def __repr__(self):
         args = (self.name, self.get_cmd(), self.timeout)
@@ -200,6 +200,8 @@ EXTRA_DIR = join(RESOURCES_DIR, 'extra')
 MBPI = '/usr/share/mobile-broadband-provider-info/serviceproviders.xml'
 NETWORKS_DB = join(DATA_DIR, 'networks.db')
 USAGE_DB = join(DATA_DIR, 'usage.db')
+TIMELINES_PATH = join(DATA_DIR, 'timelines.pickle')
+OPERATOR_NAMES_PATH = join(DATA_DIR, 'operators.pickle')
 
 # plugins consts
 PLUGINS_DIR = join(DATA_DIR, 'plugins')
@@ -17,10 +17,19 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Contact related classes and utilities"""
 
+from twisted.internet import reactor
+from twisted.internet.defer import (Deferred, DeferredList, maybeDeferred,
+                                    succeed)
+from twisted.python import log
 from zope.interface import implements
 
 from wader.common.encoding import to_u
 from wader.common.interfaces import IContact
+from wader.common.phonenumber import (normalize_number, get_number_key,
+                                      numbers_match)
+
+# seconds a provider has to answer before the store skips it
+PROVIDER_TIMEOUT = 5
 
 
 class Contact(object):
@@ -59,52 +68,301 @@ class Contact(object):
         return [name, number]
 
 
+class ContactNotifier(object):
+    """
+    I notify the contact changes of a provider to its subscribers
+
+    Contact providers that inherit from me and call :meth:`notify_changes`
+    on every change are served from the
+    :class:`~wader.common.contact.ContactIndex` of the
+    :class:`ContactStore` when looking up numbers. Only providers that
+    own their contacts should: those that can be changed from outside,
+    like the SIM contacts other DBus clients edit, would go stale.
+    """
+
+    _change_callbacks = None
+
+    def add_change_callback(self, callback):
+        """
+        Calls ``callback`` with the provider and the changed and removed
+        contacts on every change
+        """
+        if self._change_callbacks is None:
+            self._change_callbacks = []
+
+        self._change_callbacks.append(callback)
+
+    def remove_change_callback(self, callback):
+        """Stops calling ``callback``, it is safe to call it twice"""
+        if self._change_callbacks and callback in self._change_callbacks:
+            self._change_callbacks.remove(callback)
+
+    def notify_changes(self, changed=(), removed=()):
+        """
+        Notifies the subscribers that ``changed`` contacts were added or
+        edited and that ``removed`` contacts were removed
+        """
+        for callback in list(self._change_callbacks or []):
+            try:
+                callback(self, changed, removed)
+            except:
+                log.err(None, "%r failed handling the changes of %r"
+                        % (callback, self))
+
+
+class ContactIndex(object):
+    """
+    I map the numbers of the contacts of several providers to the contacts
+
+    The numbers are indexed by their
+    :func:`~wader.common.phonenumber.get_number_key`, so ``+4473333223``
+    finds the contact saved as ``073333223`` with a single dict lookup.
+    """
+
+    def __init__(self):
+        # key is the number key, value a dict whose key is the
+        # (provider, contact index) tuple and value the (normalized
+        # number, contact) tuple
+        self.keys = {}
+        # key is the (provider, contact index) tuple, value the number key
+        self.contacts = {}
+
+    def __len__(self):
+        return len(self.contacts)
+
+    def add(self, provider, contacts):
+        """Adds or updates ``contacts`` of ``provider``"""
+        for contact in contacts:
+            ref = (provider, contact.index)
+            self._remove(ref)
+
+            normalized = normalize_number(contact.number)
+            key = get_number_key(normalized)
+            self.keys.setdefault(key, {})[ref] = (normalized, contact)
+            self.contacts[ref] = key
+
+    def remove(self, provider, contacts):
+        """Removes ``contacts`` of ``provider``"""
+        for contact in contacts:
+            self._remove((provider, contact.index))
+
+    def remove_provider(self, provider):
+        """Removes all the contacts of ``provider``"""
+        for ref in [ref for ref in self.contacts if ref[0] is provider]:
+            self._remove(ref)
+
+    def _remove(self, ref):
+        key = self.contacts.pop(ref, None)
+        if key is None:
+            return
+
+        refs = self.keys[key]
+        del refs[ref]
+        if not refs:
+            del self.keys[key]
+
+    def changed(self, provider, changed, removed):
+        """Callback for :meth:`ContactNotifier.add_change_callback`"""
+        self.remove(provider, removed)
+        self.add(provider, changed)
+
+    def lookup(self, number):
+        """
+        Returns the contacts whose number might be ``number``
+
+        :rtype: list
+        """
+        normalized = normalize_number(number)
+        refs = self.keys.get(get_number_key(normalized), {})
+        return [contact for _normalized, contact in refs.values()
+                if numbers_match(_normalized, normalized)]
+
+
 class ContactStore(object):
     """
     I am a contact store
 
     A central point to perform operations on the different contact
-    backends (see :class:`~wader.common.interfaces.IContactProvider`)
+    backends (see :class:`~wader.common.interfaces.IContactProvider`).
+    Every operation is sent to all the providers at the same time and
+    returns a ``Deferred``, the providers that fail or take longer than
+    ``timeout`` seconds are left out of the result.
+
+    The timeout only applies to the providers that answer with a
+    ``Deferred``: a provider that answers synchronously runs in the
+    reactor thread and blocks it until it returns, so it cannot be
+    skipped. Providers that do slow I/O, like the network ones, must do
+    it in a thread and return a ``Deferred``.
+
+    The numbers of the contacts of the providers that notify their changes,
+    see :class:`ContactNotifier`, are looked up in a :class:`ContactIndex`
+    that is filled the first time a number is looked up.
+
+    :param timeout: seconds a provider has to answer
     """
 
-    def __init__(self):
+    def __init__(self, timeout=PROVIDER_TIMEOUT):
         super(ContactStore, self).__init__()
         self._providers = []
+        self.timeout = timeout
+        self.index = ContactIndex()
+        # the notifying providers whose contacts are not indexed yet
+        self._unindexed = []
+        # the contacts removed while listing the contacts to index, key
+        # is the provider and value the set of removed contact indexes
+        self._removed = {}
+
+    def _is_indexed(self, provider):
+        return isinstance(provider, ContactNotifier)
 
     def add_provider(self, provider):
         """Adds ``provider`` to the list of registered providers"""
         self._providers.append(provider)
+        if self._is_indexed(provider):
+            provider.add_change_callback(self._changed_cb)
+            self._unindexed.append(provider)
 
     def remove_provider(self, provider):
         """Removes ``provider`` to the list of registered providers"""
         self._providers.remove(provider)
+        if self._is_indexed(provider):
+            provider.remove_change_callback(self._changed_cb)
+            self.index.remove_provider(provider)
+            self._removed.pop(provider, None)
+            if provider in self._unindexed:
+                self._unindexed.remove(provider)
+
+    def _changed_cb(self, provider, changed, removed):
+        """Callback for :meth:`ContactNotifier.add_change_callback`"""
+        if provider in self._removed:
+            # the listing being indexed might still have them
+            self._removed[provider].update([c.index for c in removed])
+
+        self.index.changed(provider, changed, removed)
 
     def close(self):
         """Frees resources"""
         while self._providers:
-            provider = self._providers.pop()
+            provider = self._providers[-1]
+            self.remove_provider(provider)
             provider.close()
 
-    def _call_method(self, name, *args):
+    def _call_provider(self, provider, name, args):
         """
-        Executes method ``name`` using ``args`` in all the registered providers
+        Executes method ``name`` of ``provider`` using ``args``
+
+        The providers can answer synchronously or with a ``Deferred``, only
+        the latter can time out.
+
+        :rtype: ``Deferred`` that fires with the list of contacts once
+            ``provider`` answered, or with None if it failed or timed out
         """
-        ret = []
-        for prov in self._providers:
-            result = getattr(prov, name)(*args)
-            if isinstance(result, list):
-                ret.extend(getattr(prov, name)(*args))
+        d = Deferred()
+
+        def timed_out():
+            log.msg("ContactStore: %r did not answer %s in %d seconds"
+                    % (provider, name, self.timeout))
+            d.callback(None)
+
+        def answered(result):
+            if not call_id.active():
+                # too late, it has been skipped already
+                return
+
+            if result is None:
+                contacts = []
+            elif isinstance(result, Contact):
+                contacts = [result]
             else:
-                ret.append(result)
-        return ret
+                # lists, generators and iterators of contacts, the latter
+                # might fail while consumed and are handled by failed
+                contacts = list(result)
+
+            call_id.cancel()
+            d.callback(contacts)
+
+        def failed(failure):
+            log.err(failure, "ContactStore: %r failed %s" % (provider, name))
+            if call_id.active():
+                call_id.cancel()
+                d.callback(None)
+
+        call_id = reactor.callLater(self.timeout, timed_out)
+        method = maybeDeferred(getattr(provider, name), *args)
+        method.addCallback(answered)
+        method.addErrback(failed)
+        return d
+
+    def _call_method(self, name, *args, **kw):
+        """
+        Executes method ``name`` using ``args`` in all the registered providers
+
+        :param providers: the providers to use instead of all of them
+        :rtype: ``Deferred`` that fires with the results of the providers
+            in the order they were registered
+        """
+
+        def merge(results):
+            ret = []
+            for _, contacts in results:
+                if contacts:
+                    ret.extend(contacts)
+
+            return ret
+
+        ds = [self._call_provider(provider, name, args)
+              for provider in kw.get('providers', self._providers)]
+        d = DeferredList(ds)
+        d.addCallback(merge)
+        return d
+
+    def _fill_index(self):
+        """
+        Indexes the contacts of the notifying providers not indexed yet
+
+        The providers that fail or time out are tried again next time.
+
+        :rtype: ``Deferred``
+        """
+
+        def fill(contacts, provider):
+            removed = self._removed.pop(provider, ())
+            if contacts is None or provider not in self._unindexed:
+                return
+
+            self._unindexed.remove(provider)
+            # the changes notified meanwhile are newer than the listing
+            self.index.add(provider, [c for c in contacts if
+                                      (provider, c.index) not in
+                                      self.index.contacts and
+                                      c.index not in removed])
+
+        ds = []
+        for provider in self._unindexed:
+            self._removed.setdefault(provider, set())
+            d = self._call_provider(provider, 'list_contacts', ())
+            d.addCallback(fill, provider)
+            ds.append(d)
+
+        return DeferredList(ds)
+
+    def _get_first(self, contacts):
+        if contacts:
+            return contacts[0]
+
+        return None
 
     def add_contact(self, data):
         """:meth:`~wader.common.interfaces.IContactProvider.add_contact`"""
-        return self._call_method('add_contact', data)[0]
+        d = self._call_method('add_contact', data)
+        d.addCallback(self._get_first)
+        return d
 
     def edit_contact(self, data):
         """:meth:`~wader.common.interfaces.IContactProvider.edit_contact`"""
-        return self._call_method('edit_contact', data)[0]
+        d = self._call_method('edit_contact', data)
+        d.addCallback(self._get_first)
+        return d
 
     def find_contacts_by_name(self, name):
         """
@@ -115,24 +373,48 @@ class ContactStore(object):
     def find_contacts_by_number(self, number):
         """
         see `IContactProvider.find_contacts_by_number`
+
+        The contacts of the notifying providers are looked up in the index,
+        the rest of providers are asked.
         """
+        others = [p for p in self._providers if not self._is_indexed(p)]
+
+        def lookup(_):
+            matches = self.index.lookup(number)
+            if not others:
+                return matches
+
+            d = self._find_contacts_by_number(number, others)
+            d.addCallback(lambda found: matches + found)
+            return d
+
+        if self._unindexed:
+            d = self._fill_index()
+        else:
+            d = succeed(None)
+
+        d.addCallback(lookup)
+        return d
+
+    def _find_contacts_by_number(self, number, providers):
         # first try a full match, if succeeds return result
         # otherwise try to remove 3 chars and if succeeds return result
         # i.e. match '723123112' instead of '+44723123112' (UK, ES)
         # otherwise try to remove 4 chars and if succeeds return result
         # i.e. match '821372121' instead of '+353821372121' (IE)
         # otherwise we failed
-        for n in [0, 3, 4]:
-            # finding out if a generator returns None is a bit cumbersome
-            # so we just consume the generator and create a list
-            match = list(self._find_contacts_by_number(number[n:]))
-            if match:
-                return match
+        def find(matches, n):
+            if matches:
+                return matches
 
-        return []
+            return self._call_method('find_contacts_by_number', number[n:],
+                                     providers=providers)
+
+        d = succeed(None)
+        for n in [0, 3, 4]:
+            d.addCallback(find, n)
 
-    def _find_contacts_by_number(self, number):
-        return self._call_method('find_contacts_by_number', number)
+        return d
 
     def list_contacts(self):
         """:meth:`~wader.common.interfaces.IContactProvider.list_contacts`"""
@@ -140,4 +422,6 @@ class ContactStore(object):
 
     def remove_contact(self, contact):
         """:meth:`~wader.common.interfaces.IContactProvider.remove_contact`"""
-        self._call_method('remove_contact', contact)
+        d = self._call_method('remove_contact', contact)
+        d.addCallback(lambda _: None)
+        return d
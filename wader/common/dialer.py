@@ -18,8 +18,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Dialer module abstracts the differences between dialers on different OSes"""
 
+from functools import partial
 from math import floor
-from time import time
 
 from gobject import timeout_add_seconds, source_remove
 import dbus
@@ -30,15 +30,22 @@ from twisted.internet import reactor, task
 from twisted.internet import defer
 
 from wader.common._dbus import DBusExporterHelper
-from wader.common.aterrors import CallIndexError
+from wader.common.accounting import UsageAccountant
+from wader.common.aterrors import CallIndexError, NoNetwork
 import wader.common.consts as consts
 from wader.common.interfaces import IDialer
-from wader.common.oal import get_os_object
+from wader.common.signals import SIG_DIAL_STATS, SIG_DISCONNECTED
+from wader.common.stats import TrafficSeries, get_stats_collector
+from wader.common.supervisor import ReconnectionSupervisor
+from wader.common.timeline import (ConnectionTimeline, get_timeline_store,
+                                   publish_phase)
 from wader.common.utils import convert_int_to_ip
 
 
 CONFIG_DELAY = RECONNECTION_DELAY = 3
 SECRETS_TIMEOUT = 3
+# counters are sampled at this rate when nobody listens to DialStats
+STATS_BASE_INTERVAL = 30
 
 
 class DialerConf(object):
@@ -151,24 +158,70 @@ class Dialer(Object):
         self.ctrl = ctrl
         # iface name
         self.iface = None
-        # timeout_add_seconds task ID
         self.__time = 0
         self.__rx_bytes = 0
         self.__tx_bytes = 0
+        # timeout_add_seconds task ID
         self.stats_id = None
+        # DialStats emission interval, 0 means nobody is listening
+        self.stats_interval = 0
+        # seconds between two samples of the counters
+        self.stats_period = 0
+        # rx/tx rates history
+        self.series = TrafficSeries()
+
+    def sample_stats(self):
+        """
+        Samples the counters for the internal consumers and the series
 
-    def _emit_dial_stats(self):
+        :return: the stats, see :meth:`get_stats`
+        """
         stats = self.get_stats()
-        self.device.exporter.DialStats(stats)
+        if stats is not None:
+            self.series.add(get_stats_collector().timestamp, stats[2],
+                            stats[3])
+            self.device.events.publish(SIG_DIAL_STATS, stats)
+
+        return stats
+
+    def _emit_dial_stats(self):
+        stats = self.sample_stats()
+        if stats is not None and self.stats_interval:
+            # the rates of the whole interval, not just of the last sample
+            rates = self.series.get_rate(self.stats_interval)
+            self.device.exporter.DialStats(stats[:2] + rates)
 
         # make sure this is repeatedly called
         return True
 
+    def set_stats_interval(self, interval):
+        """
+        Emits DialStats every ``interval`` seconds
+
+        The counters are sampled at that rate, or every
+        ``STATS_BASE_INTERVAL`` seconds for the internal consumers and the
+        traffic series if ``interval`` is 0, in which case no DialStats
+        signal will be emitted.
+        """
+        self.stats_interval = interval
+        period = interval or STATS_BASE_INTERVAL
+        if self.stats_id is not None:
+            if period == self.stats_period:
+                return
+
+            source_remove(self.stats_id)
+
+        self.stats_period = period
+        self.stats_id = timeout_add_seconds(period, self._emit_dial_stats)
+
     def close(self, path=None):
         # remove the emit stats task
         if self.stats_id is not None:
             source_remove(self.stats_id)
             self.stats_id = None
+
+        if self.iface is not None:
+            get_stats_collector().remove_iface(self.iface)
         # remove from DBus bus
         try:
             self.remove_from_connection()
@@ -199,12 +252,15 @@ class Dialer(Object):
         :return: (in_bytes, out_bytes)
         """
         if self.iface is not None:
-            now = time()
-            rx_bytes, tx_bytes = get_os_object().get_iface_stats(self.iface)
+            collector = get_stats_collector()
+            rx_bytes, tx_bytes = collector.get_iface_stats(self.iface)
+            now = collector.timestamp
             # if any of these three are not 0, it means that this is at
             # least the second time this method is executed, thus we
-            # should have cached meaningful data
-            if self.__rx_bytes or self.__tx_bytes or self.__time:
+            # should have cached meaningful data. The shared sample might
+            # not have been refreshed since our last call though
+            if (self.__rx_bytes or self.__tx_bytes or self.__time) and \
+                    now > self.__time:
                 rx_delta = rx_bytes - self.__rx_bytes
                 tx_delta = tx_bytes - self.__tx_bytes
                 interval = now - self.__time
@@ -235,6 +291,7 @@ class Dialer(Object):
     @signal(dbus_interface=consts.WADER_DIALUP_INTFACE, signature='')
     def Disconnected(self):
         log.msg("emitting Disconnected signal")
+        self.device.events.publish(SIG_DISCONNECTED, self.opath)
 
     @signal(dbus_interface=consts.WADER_DIALUP_INTFACE, signature='as')
     def InvalidDNS(self, dns):
@@ -269,11 +326,33 @@ class DialerManager(Object, DBusExporterHelper):
         # value is the used configuration. This is used to save the state
         # of previous connections interrupted by a MMS connection.
         self.connection_state = {}
+        # dict with the DialStats subscriptions, key is the device path and
+        # the value is a dict mapping the subscriber bus name to the
+        # interval it asked for.
+        self.stats_subscriptions = {}
+        # dict with the name owner watches of the DialStats subscribers
+        self.stats_watches = {}
+        # dict with the link loss subscriptions, key is the connection
+        # opath and the value the Subscription
+        self.link_matchs = {}
+        # dict with the dropped connections waiting to be reconnected, key
+        # is the connection opath and the value the device path
+        self.lost_connections = {}
+        self.supervisor = ReconnectionSupervisor(self.reconnect)
+        # dict with the DialStats subscriptions that feed the usage
+        # accounting, key is the connection opath
+        self.usage_matchs = {}
+        self.accountant = UsageAccountant()
+        # account the sessions interrupted by a crash
+        d = self.accountant.recover()
+        d.addErrback(log.err, "Could not recover the interrupted sessions")
         self.ctrl = ctrl
         self._connect_to_signals()
 
     def _device_removed_cb(self, opath):
         """Executed when a device goes away"""
+        self.forget_lost_connections(opath)
+        self.supervisor.cancel(opath)
         if opath in self.connections:
             log.msg("Device %s removed! deleting dialer instance" % opath)
             try:
@@ -286,6 +365,205 @@ class DialerManager(Object, DBusExporterHelper):
                                      "DeviceRemoved",
                                      consts.WADER_INTFACE)
 
+    def _stats_subscriber_cb(self, sender, owner):
+        """Executed when the owner of ``sender`` changes"""
+        if owner:
+            return
+
+        # the subscriber has left the bus without unsubscribing
+        for device_opath in self.stats_subscriptions.keys():
+            self.unsubscribe_dial_stats(device_opath, sender)
+
+    def _update_stats_interval(self, device_opath):
+        interval = self.get_stats_interval(device_opath)
+        for dialer, _ in self.connections.values():
+            if dialer.device.opath == device_opath:
+                dialer.set_stats_interval(interval)
+
+    def _link_lost_cb(self, conn_opath, dialer_opath):
+        """Executed when a dialer reports that its link is down"""
+        if conn_opath not in self.connections:
+            # deactivate_connection already took care of it
+            return
+
+        dialer, _ = self.connections[conn_opath]
+        if dialer.opath != dialer_opath:
+            # another dialer of the same device
+            return
+
+        del self.connections[conn_opath]
+        self.link_matchs.pop(conn_opath).remove()
+        self.lost_connections[conn_opath] = dialer.device.opath
+        # the iface is gone, the last sample will have to do
+        self.stop_accounting(conn_opath)
+        log.msg("Connection %s lost" % conn_opath)
+        self.ConnectionChanged(conn_opath, False)
+        # release whatever the dialer left behind
+        d = dialer.disconnect()
+        d.addCallback(dialer.close)
+        self.supervisor.link_down(dialer.device.opath)
+
+    def _usage_stats_cb(self, conn_opath, stats):
+        self.accountant.update(conn_opath, stats[0], stats[1])
+
+    def start_accounting(self, conn_opath, dialer):
+        """Starts accounting the data usage of ``conn_opath``"""
+        device = dialer.device
+        try:
+            tech = device.get_property(consts.NET_INTFACE,
+                                       'AccessTechnology')
+        except KeyError:
+            tech = consts.MM_GSM_ACCESS_TECH_UNKNOWN
+
+        umts = tech >= consts.MM_GSM_ACCESS_TECH_UMTS
+        stats = dialer.get_stats() or (0, 0)
+        self.accountant.session_started(conn_opath, umts, stats[0], stats[1])
+        self.usage_matchs[conn_opath] = device.events.subscribe(
+                SIG_DIAL_STATS, partial(self._usage_stats_cb, conn_opath))
+
+    def stop_accounting(self, conn_opath, dialer=None):
+        """
+        Adds the data usage of ``conn_opath`` to the usage DB
+
+        :param dialer: if given, its counters are sampled one last time
+        """
+        match = self.usage_matchs.pop(conn_opath, None)
+        if match is None:
+            return
+
+        match.remove()
+        stats = dialer.get_stats() if dialer is not None else None
+        if stats is not None:
+            self.accountant.update(conn_opath, stats[0], stats[1])
+
+        self.accountant.session_ended(conn_opath)
+
+    def stop_supervising(self, conn_opath, device_opath):
+        """The connection ``conn_opath`` will not be reconnected"""
+        if conn_opath in self.link_matchs:
+            self.link_matchs.pop(conn_opath).remove()
+        self.forget_lost_connections(device_opath)
+        self.supervisor.cancel(device_opath)
+
+    def forget_lost_connections(self, device_opath):
+        """Forgets the dropped connections of ``device_opath``"""
+        for conn_opath, opath in self.lost_connections.items():
+            if opath == device_opath:
+                del self.lost_connections[conn_opath]
+
+    def reconnect(self, device_opath, conf):
+        """
+        Reconnects ``device_opath`` using ``conf``
+
+        Used by the :class:`~wader.common.supervisor.ReconnectionSupervisor`,
+        the device is not registered again: if it is not attached to the
+        network anymore this attempt fails and the next one will check it
+        again.
+        """
+        device = self.ctrl.hm.clients.get(device_opath)
+        if device is None:
+            return defer.fail(KeyError("Device %s not found" % device_opath))
+
+        def get_netreg_status_cb(info):
+            if info[1] not in [consts.STATUS_HOME, consts.STATUS_ROAMING]:
+                raise NoNetwork("Not registered")
+
+            dialer = self.get_dialer(device_opath, self.get_next_opath())
+            d = self.do_activate_connection(conf, dialer)
+            d.addErrback(reconnect_eb, dialer)
+            return d
+
+        def reconnect_eb(failure, dialer):
+            attempt = self.connection_attempts.get(device_opath)
+            if attempt is not None and attempt[0] is dialer:
+                self.connection_attempts.pop(device_opath)
+            dialer.close()
+            return failure
+
+        d = device.sconn.get_netreg_status()
+        d.addCallback(get_netreg_status_cb)
+        return d
+
+    def get_stats_interval(self, device_opath):
+        """
+        Returns the DialStats emission interval for ``device_opath``
+
+        It is the shortest interval requested by its subscribers, or 0 if
+        there are none.
+        """
+        intervals = self.stats_subscriptions.get(device_opath, {}).values()
+        return min(intervals) if intervals else 0
+
+    def subscribe_dial_stats(self, device_opath, interval, sender=None):
+        """
+        Subscribes ``sender`` to the DialStats of ``device_opath``
+
+        :param interval: seconds between two consecutive DialStats
+        """
+        if interval < 1:
+            raise ValueError("Invalid DialStats interval %d" % interval)
+
+        subscribers = self.stats_subscriptions.setdefault(device_opath, {})
+        subscribers[sender] = interval
+
+        if sender is not None and sender not in self.stats_watches:
+            callback = partial(self._stats_subscriber_cb, sender)
+            watch = self.bus.watch_name_owner(sender, callback)
+            self.stats_watches[sender] = watch
+
+        self._update_stats_interval(device_opath)
+
+    def unsubscribe_dial_stats(self, device_opath, sender=None):
+        """Unsubscribes ``sender`` from the DialStats of ``device_opath``"""
+        subscribers = self.stats_subscriptions.get(device_opath, {})
+        subscribers.pop(sender, None)
+        if not subscribers:
+            self.stats_subscriptions.pop(device_opath, None)
+
+        subscribed = [s for s in self.stats_subscriptions.values()
+                        if sender in s]
+        if not subscribed and sender in self.stats_watches:
+            self.stats_watches.pop(sender).cancel()
+
+        self._update_stats_interval(device_opath)
+
+    def get_traffic_series(self, conn_opath, resolution, seconds=0):
+        """
+        Returns the rx/tx rates of ``conn_opath`` in the last ``seconds``
+
+        :param resolution: seconds per value, 1, 60 or 3600
+        :param seconds: length of the window, 0 returns every value kept
+        :return: list of (timestamp, rx_rate, tx_rate) structs, oldest first
+        """
+        if conn_opath not in self.connections:
+            raise KeyError("Dialup %s not handled" % conn_opath)
+
+        dialer, _ = self.connections[conn_opath]
+        # the series is only sampled every few seconds when idle
+        dialer.sample_stats()
+        values = dialer.series.get_window(resolution, seconds)
+        return dbus.Array(values, signature='(uuu)')
+
+    def get_connection_timelines(self):
+        """
+        Returns the timelines of the last connection attempts, oldest first
+
+        Each timeline is a dict with the keys 'device', 'start', 'end' and
+        'result' plus 'phases', a list of (name, start, end) structs, and
+        'commands', a list of (name, sent, done, ok) structs with the AT
+        commands sent during the attempt.
+        """
+        ret = []
+        for timeline in get_timeline_store().get_timelines():
+            timeline = timeline.copy()
+            timeline['phases'] = dbus.Array(timeline['phases'],
+                                            signature='(sdd)')
+            timeline['commands'] = dbus.Array(timeline['commands'],
+                                              signature='(sddb)')
+            ret.append(timeline)
+
+        return ret
+
     def get_dialer(self, dev_opath, opath, plain=False):
         """
         Returns an instance of the dialer that will be used to connect
@@ -321,6 +599,8 @@ class DialerManager(Object, DBusExporterHelper):
         device_opath = dialer.device.opath
         self.connection_attempts[device_opath] = dialer, conf
         device = self.ctrl.hm.clients[device_opath]
+        timeline = ConnectionTimeline(device)
+        timeline.start_recording()
 
         def get_conn_id(ign):
             conn_id = device.sconn.state_dict.get('conn_id')
@@ -332,20 +612,39 @@ class DialerManager(Object, DBusExporterHelper):
             return conn_id
 
         def start_traffic_monitoring(conn_opath):
-            dialer.stats_id = timeout_add_seconds(1, dialer._emit_dial_stats)
+            dialer.set_stats_interval(self.get_stats_interval(device_opath))
             # transfer the dialer from connection_attempts to connections dict
             self.connections[conn_opath] = dialer, conf
             if device_opath in self.connection_attempts:
                 self.connection_attempts.pop(device_opath)
+            # the dropped connection it replaces, if any, is gone for good
+            self.forget_lost_connections(device_opath)
+
+            # reconnect it if the link drops
+            self.link_matchs[conn_opath] = device.events.subscribe(
+                    SIG_DISCONNECTED, partial(self._link_lost_cb, conn_opath))
+            self.supervisor.link_up(device_opath, conf)
+            self.start_accounting(conn_opath, dialer)
 
             # announce that a new connection is active
             self.ConnectionChanged(conn_opath, True)
+            timeline.finish('connected')
             return conn_opath
 
+        def connect(ign):
+            publish_phase(device, 'dial')
+            return dialer.connect()
+
+        def timeline_eb(failure):
+            timeline.finish(failure.getErrorMessage())
+            return failure
+
+        publish_phase(device, 'configure')
         d = dialer.configure(conf)
         d.addCallback(get_conn_id)
-        d.addCallback(lambda ign: dialer.connect())
+        d.addCallback(connect)
         d.addCallback(start_traffic_monitoring)
+        d.addErrback(timeline_eb)
         return d
 
     def activate_mms_connection(self, settings, device_opath):
@@ -363,6 +662,8 @@ class DialerManager(Object, DBusExporterHelper):
         for conn_opath, (dialer, conf) in self.connections.items():
             if dialer.device.opath == device_opath:
                 self.connection_state[device_opath] = dialer, conf
+                self.stop_supervising(conn_opath, device_opath)
+                self.stop_accounting(conn_opath, dialer)
                 d = dialer.disconnect()
                 d.addCallback(dialer.close)
                 break
@@ -390,10 +691,21 @@ class DialerManager(Object, DBusExporterHelper):
 
     def deactivate_connection(self, conn_opath):
         """Stops connection of device ``device_opath``"""
+        if conn_opath in self.lost_connections:
+            # the link dropped and it is being reconnected, give up
+            device_opath = self.lost_connections[conn_opath]
+            self.stop_supervising(conn_opath, device_opath)
+            if device_opath in self.connection_attempts:
+                return self.stop_connection_attempt(device_opath)
+
+            return defer.succeed(True)
+
         if conn_opath not in self.connections:
             raise KeyError("Dialup %s not handled" % conn_opath)
 
         dialer, _ = self.connections.pop(conn_opath)
+        self.stop_supervising(conn_opath, dialer.device.opath)
+        self.stop_accounting(conn_opath, dialer)
 
         def on_disconnect(opath):
             self.ConnectionChanged(conn_opath, False)
@@ -413,6 +725,17 @@ class DialerManager(Object, DBusExporterHelper):
 
     def stop_connection(self, device_opath):
         """Stops connection attempt of device ``device_opath``"""
+        reconnecting = device_opath in self.lost_connections.values()
+        self.forget_lost_connections(device_opath)
+        self.supervisor.cancel(device_opath)
+        if reconnecting and device_opath not in self.connection_attempts:
+            # waiting for the next reconnection attempt
+            return defer.succeed(True)
+
+        return self.stop_connection_attempt(device_opath)
+
+    def stop_connection_attempt(self, device_opath):
+        """Stops the ongoing connection attempt of ``device_opath``"""
         dialer, _ = self.connection_attempts.pop(device_opath)
         d = dialer.stop()
         d.addCallback(dialer.close)
@@ -447,6 +770,36 @@ class DialerManager(Object, DBusExporterHelper):
         d = self.stop_connection(device_opath)
         return self.add_callbacks_and_swallow(d, async_cb, async_eb)
 
+    @method(consts.WADER_DIALUP_INTFACE, in_signature='ou', out_signature='',
+            sender_keyword='sender')
+    def SubscribeDialStats(self, device_opath, interval, sender=None):
+        """See :meth:`DialerManager.subscribe_dial_stats`"""
+        self.subscribe_dial_stats(device_opath, interval, sender)
+
+    @method(consts.WADER_DIALUP_INTFACE, in_signature='o', out_signature='',
+            sender_keyword='sender')
+    def UnsubscribeDialStats(self, device_opath, sender=None):
+        """See :meth:`DialerManager.unsubscribe_dial_stats`"""
+        self.unsubscribe_dial_stats(device_opath, sender)
+
+    @method(consts.WADER_DIALUP_INTFACE, in_signature='o',
+            out_signature='a{sv}')
+    def GetReconnectionStats(self, device_opath):
+        """See :meth:`ReconnectionSupervisor.get_stats`"""
+        return self.supervisor.get_stats(device_opath)
+
+    @method(consts.WADER_DIALUP_INTFACE, in_signature='ouu',
+            out_signature='a(uuu)')
+    def GetTrafficSeries(self, conn_opath, resolution, seconds):
+        """See :meth:`DialerManager.get_traffic_series`"""
+        return self.get_traffic_series(conn_opath, resolution, seconds)
+
+    @method(consts.WADER_DIALUP_INTFACE, in_signature='',
+            out_signature='aa{sv}')
+    def GetConnectionTimelines(self):
+        """See :meth:`DialerManager.get_connection_timelines`"""
+        return self.get_connection_timelines()
+
     @signal(consts.WADER_DIALUP_INTFACE, signature='ob')
     def ConnectionChanged(self, conn_opath, active):
         log.msg("ConnectionChanged(%s, %s)" % (conn_opath, active))
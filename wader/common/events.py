@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+In-process event bus
+
+Signals emitted by a device are delivered to internal consumers through
+an :class:`EventBus` rather than via a round trip through dbus-daemon.
+DBus emission is kept for external clients only.
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class Subscription(object):
+    """
+    I represent a callback subscribed to an :class:`EventBus`
+
+    I mimic the interface of a ``dbus.connection.SignalMatch`` so
+    consumers can keep a list of matches and ``remove()`` them.
+    """
+
+    def __init__(self, bus, signal, callback):
+        self.bus = bus
+        self.signal = signal
+        self.callback = callback
+
+    def __repr__(self):
+        return '<Subscription %s -> %r>' % (self.signal, self.callback)
+
+    def remove(self):
+        """Stops receiving events"""
+        self.bus.unsubscribe(self)
+
+
+class EventBus(object):
+    """I dispatch signals to in-process subscribers"""
+
+    def __init__(self):
+        self.subscriptions = {}
+
+    def subscribe(self, signal, callback):
+        """
+        Subscribes ``callback`` to ``signal``
+
+        :rtype: :class:`Subscription`
+        """
+        sub = Subscription(self, signal, callback)
+        self.subscriptions.setdefault(signal, []).append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        """Removes subscription ``sub``, it is safe to call it twice"""
+        subs = self.subscriptions.get(sub.signal, [])
+        if sub in subs:
+            subs.remove(sub)
+
+        if not subs:
+            self.subscriptions.pop(sub.signal, None)
+
+    def has_subscribers(self, signal):
+        """Returns True if anyone is subscribed to ``signal``"""
+        return bool(self.subscriptions.get(signal))
+
+    def publish(self, signal, *args):
+        """
+        Publishes ``signal`` with ``args`` to all its subscribers
+
+        Delivery happens on the next reactor iteration, just as it did when
+        the signal came back from the bus, so subscribers can safely send
+        AT commands from their callbacks.
+        """
+        for sub in list(self.subscriptions.get(signal, [])):
+            reactor.callLater(0, self._deliver, sub, args)
+
+    def _deliver(self, sub, args):
+        # the subscription might have been removed in the meantime
+        if sub not in self.subscriptions.get(sub.signal, []):
+            return
+
+        try:
+            sub.callback(*args)
+        except:
+            log.err(None, "%r failed handling %s%r" % (sub, sub.signal, args))
@@ -146,7 +146,13 @@ class ModemExporter(Object, DBusExporterHelper):
 
     @signal(dbus_interface=MDM_INTFACE, signature='(uuuu)')
     def DialStats(self, (rx_bytes, tx_bytes, rx_rate, tx_rate)):
-        pass
+        """
+        Traffic statistics of the active connection
+
+        Only emitted while a client is subscribed to the device with
+        :meth:`~wader.common.dialer.DialerManager.SubscribeDialStats`,
+        at the shortest interval requested.
+        """
 
     @signal(dbus_interface=MDM_INTFACE, signature='uuu')
     def StateChanged(self, old, new, reason):
@@ -759,6 +765,21 @@ class SmsExporter(MmsExporter):
         d = self.sconn.list_sms()
         return self.add_callbacks(d, async_cb, async_eb)
 
+    @method(SMS_INTFACE, in_signature='su', out_signature='(aa{sv}s)',
+            async_callbacks=('async_cb', 'async_eb'))
+    def ListPage(self, cursor, limit, async_cb, async_eb):
+        """
+        Returns a page of at most ``limit`` SMS stored in SIM, newest first
+
+        :param cursor: the cursor returned with the previous page, empty
+            for the first one
+        :param limit: maximum number of SMS, 0 for all of them
+        :rtype: tuple with the SMS and the cursor of the next page, empty
+            if this is the last one
+        """
+        d = self.sconn.list_sms_page(cursor, limit)
+        return self.add_callbacks(d, async_cb, async_eb)
+
     @method(SMS_INTFACE, in_signature='a{sv}', out_signature='au',
             async_callbacks=('async_cb', 'async_eb'))
     def Save(self, sms, async_cb, async_eb):
@@ -202,6 +202,13 @@ class IOSPlugin(IWaderPlugin):
     def get_iface_stats(iface):
         """Returns ``iface`` network statistics"""
 
+    def get_ifaces_stats(ifaces):
+        """
+        Returns the network statistics of every iface in ``ifaces``
+
+        :rtype: dict
+        """
+
     def get_timezone():
         """
         Returns the timezone of the OS
@@ -17,6 +17,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Message Assembly Layer for Wader"""
 
+from bisect import bisect_left, insort
 from time import mktime
 
 from twisted.internet import reactor
@@ -28,7 +29,7 @@ from messaging.sms.wap import (extract_push_notification,
                                is_a_wap_push_notification, is_mms_notification)
 
 from wader.common.aterrors import (CMSError314, SimBusy, SimNotStarted,
-                                   SimFailure)
+                                   SimFailure, InputValueError)
 from wader.common.encoding import pack_dbus_safe_string
 from wader.common.signals import SIG_MMS, SIG_SMS, SIG_SMS_COMP, SIG_SMS_DELV
 from wader.common.sms import Message
@@ -117,6 +118,8 @@ class MessageAssemblyLayer(object):
         self.last_sms_index = 0
         self.last_wap_index = 0
         self.sms_map = {}
+        # sorted list with the (timestamp, logical index) keys of sms_map
+        self.sms_keys = []
         self.wap_map = {}
         self.sms_pending = []
         self.cached = False
@@ -129,6 +132,7 @@ class MessageAssemblyLayer(object):
         # revert to initial state
         self.last_sms_index = self.last_wap_index = 0
         self.sms_map = {}
+        self.sms_keys = []
         self.sms_pending = []
         self.cached = False
         # populate sms cache
@@ -175,8 +179,19 @@ class MessageAssemblyLayer(object):
         sms.index = self.last_sms_index
         # reference the sms by this logical index
         self.sms_map[self.last_sms_index] = sms
+        insort(self.sms_keys, self._get_sms_key(sms))
         return self.last_sms_index
 
+    def _pop_sms(self, index):
+        """Removes the sms with logical index ``index`` from the cache"""
+        sms = self.sms_map.pop(index)
+        key = self._get_sms_key(sms)
+        i = bisect_left(self.sms_keys, key)
+        if i < len(self.sms_keys) and self.sms_keys[i] == key:
+            del self.sms_keys[i]
+
+        return sms
+
     def _add_sms(self, sms, emit=False):
         """
         Adds ``sms`` to the cache
@@ -264,7 +279,7 @@ class MessageAssemblyLayer(object):
         """Deletes sms identified by ``index``"""
         debug("MAL::delete_sms: %d" % index)
         if index in self.sms_map:
-            sms = self.sms_map.pop(index)
+            sms = self._pop_sms(index)
             ret = map(self.wrappee.do_delete_sms, sms.real_indexes)
             debug("MAL::delete_sms deleting %s" % sms.real_indexes)
             return gatherResults(ret)
@@ -295,22 +310,57 @@ class MessageAssemblyLayer(object):
 
         return succeed(ret)
 
+    def _sms_to_dict(self, sms):
+        if sms.fmt != 0x04:
+            return sms.to_dict()
+
+        # WAP Pushes are binary and may not be valid DBus strings
+        _sms = sms.to_dict()
+        _sms['text'] = pack_dbus_safe_string(_sms['text'])
+        return _sms
+
     def _list_sms(self):
-        ret = []
-        for sms in self.sms_map.values():
-            if sms.fmt != 0x04:
-                ret.append(sms.to_dict())
-            else:
-                # WAP Pushes are binary and may not be valid DBus strings
-                _sms = sms.to_dict()
-                _sms['text'] = pack_dbus_safe_string(_sms['text'])
-                ret.append(_sms)
+        return map(self._sms_to_dict, self.sms_map.values())
 
-        return ret
+    def _get_sms_key(self, sms):
+        """Returns the ``(timestamp, index)`` key that sorts ``sms``"""
+        timestamp = 0
+        if sms.datetime is not None:
+            timestamp = int(mktime(sms.datetime.timetuple()))
 
-    def list_sms(self):
-        """Returns all the sms"""
-        debug("MAL::list_sms")
+        return timestamp, sms.index
+
+    def _parse_sms_cursor(self, cursor):
+        """Returns the ``(timestamp, index)`` key of ``cursor``"""
+        try:
+            timestamp, index = map(int, cursor.split(':'))
+        except ValueError:
+            raise InputValueError("Invalid SMS cursor: %r" % cursor)
+
+        return timestamp, index
+
+    def _list_sms_page(self, cursor, limit):
+        # sms_keys is sorted oldest first, the page is read backwards
+        end = len(self.sms_keys)
+        if cursor:
+            end = bisect_left(self.sms_keys, self._parse_sms_cursor(cursor))
+
+        start = max(end - limit, 0) if limit else 0
+        keys = self.sms_keys[start:end]
+        keys.reverse()
+
+        next_cursor = ''
+        if start > 0:
+            next_cursor = '%d:%d' % keys[-1]
+
+        return [self._sms_to_dict(self.sms_map[index])
+                for _, index in keys], next_cursor
+
+    def _populate_cache(self):
+        """Returns a deferred that fires once the SMS cache is filled"""
+        if self.cached:
+            debug("MAL::list_sms::cached path")
+            return succeed(None)
 
         def gen_cache(messages):
             debug("MAL::list_sms::gen_cache")
@@ -318,16 +368,36 @@ class MessageAssemblyLayer(object):
                 self._add_sms(sms)
 
             self.cached = True
-            return self._list_sms()
-
-        if self.cached:
-            debug("MAL::list_sms::cached path")
-            return succeed(self._list_sms())
 
         d = self.wrappee.do_list_sms()
         d.addCallback(gen_cache)
         return d
 
+    def list_sms(self):
+        """Returns all the sms"""
+        debug("MAL::list_sms")
+        d = self._populate_cache()
+        d.addCallback(lambda _: self._list_sms())
+        return d
+
+    def list_sms_page(self, cursor='', limit=0):
+        """
+        Returns a page of at most ``limit`` sms, the newest first
+
+        The sms are sorted by date and logical index, so the pages stay
+        stable while new sms arrive.
+
+        :param cursor: the cursor returned with the previous page, empty
+            for the first one
+        :param limit: maximum number of sms, 0 for all of them
+        :return: a ``(messages, cursor)`` tuple, the cursor of the next
+            page is empty if this is the last one
+        """
+        debug("MAL::list_sms_page: %r %d" % (cursor, limit))
+        d = self._populate_cache()
+        d.addCallback(lambda _: self._list_sms_page(cursor, limit))
+        return d
+
     def list_sms_raw(self):
         """Returns all the raw sms, not assembled via the mal"""
         debug("MAL::list_sms_raw")
@@ -350,7 +420,7 @@ class MessageAssemblyLayer(object):
     def send_sms_from_storage(self, index):
         debug("MAL::send_sms_from_storage: %d" % index)
         if index in self.sms_map:
-            sms = self.sms_map.pop(index)
+            sms = self._pop_sms(index)
             indexes = sorted(sms.real_indexes)
             debug("MAL::send_sms_from_storage sending %s" % indexes)
             ret = map(self.wrappee.do_send_sms_from_storage, indexes)
@@ -420,7 +490,7 @@ class MessageAssemblyLayer(object):
             debug("MAL::_process_wap_push_notification: is not for MMS")
             return False
 
-        wap_push = self.sms_map.pop(index)
+        wap_push = self._pop_sms(index)
 
         index = None
         new = False
@@ -32,8 +32,8 @@ from twisted.python import log
 from twisted.internet import defer, reactor, task
 
 import wader.common.aterrors as E
-from wader.common.consts import (WADER_SERVICE, MDM_INTFACE, CRD_INTFACE,
-                                 NET_INTFACE, USD_INTFACE,
+from wader.common.consts import (MDM_INTFACE, CRD_INTFACE, NET_INTFACE,
+                                 USD_INTFACE,
                                  MM_NETWORK_BAND_ANY, MM_NETWORK_MODE_ANY,
                                  MM_MODEM_STATE_DISABLED,
                                  MM_MODEM_STATE_ENABLING,
@@ -62,11 +62,13 @@ import wader.common.exceptions as ex
 from wader.common.mal import MessageAssemblyLayer
 from wader.common.mms import (send_m_send_req, send_m_notifyresp_ind,
                               get_payload)
+from wader.common.operators import get_operator_names
 from wader.common.protocol import WCDMAProtocol
 from wader.common.signals import SIG_CREG
 from wader.common.sim import (COM_READ_BINARY, EF_AD, EF_SPN, EF_ICCID, SW_OK,
                               RETRY_ATTEMPTS, RETRY_TIMEOUT)
 from wader.common.sms import Message
+from wader.common.timeline import ConnectionTimeline
 from wader.common.utils import rssi_to_percentage
 
 CACHETIME = 5
@@ -92,9 +94,7 @@ class WCDMAWrapper(WCDMAProtocol):
         self.cached_registration = (0, (0, '', ''))
 
     def connect_to_signals(self):
-        bus = dbus.SystemBus()
-        device = bus.get_object(WADER_SERVICE, self.device.sconn.device.opath)
-        sm = device.connect_to_signal(SIG_CREG, self.on_creg_cb)
+        sm = self.device.events.subscribe(SIG_CREG, self.on_creg_cb)
         self.signal_matchs.append(sm)
 
     def clean_signals(self):
@@ -447,13 +447,43 @@ class WCDMAWrapper(WCDMAProtocol):
             failure.trap(E.NoNetwork)
             resp.append('')
 
+        def get_name_cb(_):
+            netid = resp[-1]
+            if not netid:
+                # no network, no name
+                return resp.append('')
+
+            names = get_operator_names()
+            name = names.get_name(netid)
+            if name is not None:
+                return resp.append(name)
+
+            def db_name_cb(name):
+                if name is not None:
+                    resp[-1] = name
+
+            def check_name_cb(_):
+                name = resp[-1]
+                if name and not name.isdigit():
+                    return names.add(netid, name)
+
+                # the modem does not know its name either
+                d = names.get_db_name(netid)
+                d.addCallback(db_name_cb)
+                return d
+
+            # unknown locally, ask the modem and remember its answer
+            d = self.get_network_info('name')
+            d.addCallback(get_netinfo_cb)
+            d.addCallback(check_name_cb)
+            d.addErrback(get_netinfo_eb)
+            return d
+
         d = self.get_network_info('numeric')
         d.addCallback(get_netinfo_cb)
         d.addErrback(get_netinfo_eb)
 
-        d.addCallback(lambda _: self.get_network_info('name'))
-        d.addCallback(get_netinfo_cb)
-        d.addErrback(get_netinfo_eb)
+        d.addCallback(get_name_cb)
 
         d.addCallback(lambda _: tuple(resp))
         return d
@@ -892,6 +922,9 @@ class WCDMAWrapper(WCDMAProtocol):
     def list_sms(self):
         return self.mal.list_sms()
 
+    def list_sms_page(self, cursor, limit):
+        return self.mal.list_sms_page(cursor, limit)
+
     def do_list_sms(self):
         """
         Returns all the SMS in the SIM card
@@ -1196,10 +1229,19 @@ class WCDMAWrapper(WCDMAProtocol):
                 self.device.set_status(MM_MODEM_STATE_REGISTERED)
             failure.raiseException()  # re-raise
 
+        timeline = ConnectionTimeline(self.device)
+        timeline.start_recording()
+
+        def timeline_eb(failure):
+            timeline.finish(failure.getErrorMessage())
+            return failure
+
         simplesm = self.device.custom.simp_klass(self.device, settings)
         d = simplesm.start_simple()
         d.addCallback(lambda _:
                         self.device.set_status(MM_MODEM_STATE_CONNECTED))
+        d.addCallback(lambda _: timeline.finish('connected'))
+        d.addErrback(timeline_eb)
         d.addErrback(connect_eb)
         return d
 
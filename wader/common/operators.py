@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Local resolution of network ids to operator names
+
+Asking the modem for the operator name costs an extra AT+COPS round trip
+on every registration poll. :class:`OperatorNames` remembers on disk the
+names the modems have reported, so only the network ids never seen
+before need to be asked to the modem. The networks DB only names the
+networks the modem gives no name for, or just its numeric id.
+"""
+
+import os
+import pickle
+
+from twisted.internet import threads
+from twisted.python import log
+
+from wader.common.consts import NETWORKS_DB, OPERATOR_NAMES_PATH
+from wader.common.provider import get_network_trie
+
+_names = None
+
+
+class OperatorNames(object):
+    """
+    I map network ids to operator names
+
+    :param path: path to the file with the names reported by the modems
+    :param networks_db: path to the networks DB
+    """
+
+    def __init__(self, path=OPERATOR_NAMES_PATH, networks_db=NETWORKS_DB):
+        self.path = path
+        self.networks_db = networks_db
+        # dict with the names reported by the modems, key is the netid
+        self.names = self.load()
+
+    def load(self):
+        try:
+            fobj = open(self.path)
+        except IOError:
+            return {}
+
+        try:
+            try:
+                names = pickle.load(fobj)
+            except Exception, e:
+                # unpickling garbage can raise almost anything
+                log.msg("Discarding operator names in %s: %r"
+                        % (self.path, e))
+                return {}
+        finally:
+            fobj.close()
+
+        return names
+
+    def save(self):
+        # write to a temp file first so a crash never leaves a truncated file
+        tmp_path = self.path + '.tmp'
+        try:
+            fobj = open(tmp_path, 'w')
+            pickle.dump(self.names, fobj, pickle.HIGHEST_PROTOCOL)
+            fobj.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            log.msg("Could not save operator names: %s" % e)
+
+    def get_name(self, netid):
+        """
+        Returns the name the modems reported for network ``netid``
+
+        :return: the name, None if it is not known locally
+        """
+        return self.names.get(netid)
+
+    def get_db_name(self, netid):
+        """
+        Returns the operator name of network ``netid`` in the networks DB
+
+        The networks DB is loaded in a thread the first time, as it takes
+        too long to do it in the reactor.
+
+        :rtype: ``Deferred`` that fires with the name, None if not found
+        """
+
+        def lookup(trie):
+            match = trie.lookup(netid)
+            # the MCC/MNC must match exactly, not just a prefix
+            if match is None or match[0] != netid:
+                return None
+
+            return match[1][0][0] or None
+
+        def lookup_eb(failure):
+            log.msg("Could not look up %s in the networks DB: %s"
+                    % (netid, failure.getErrorMessage()))
+            return None
+
+        d = threads.deferToThread(get_network_trie, self.networks_db)
+        d.addCallback(lookup)
+        d.addErrback(lookup_eb)
+        return d
+
+    def add(self, netid, name):
+        """Remembers that the modem reported network ``netid`` as ``name``"""
+        if not name or name.isdigit() or self.names.get(netid) == name:
+            return
+
+        self.names[netid] = name
+        self.save()
+
+
+def get_operator_names():
+    """Returns the process-wide :class:`OperatorNames`"""
+    global _names
+    if _names is None:
+        _names = OperatorNames()
+
+    return _names
@@ -45,6 +45,33 @@ SUBSYSTEMS = ["tty", "usb", "net"]
 REQUIRED_PROPS = [VENDOR, MODEL, DRIVER, "ID_BUS", "DEVNAME"]
 BAD_DEVFILE = re.compile('^/dev/(tty\d*?|console|ptmx)$')
 
+NET_DEV = '/proc/net/dev'
+
+
+def parse_net_dev(data):
+    """
+    Parses the contents of /proc/net/dev
+
+    :return: dict with the iface name as key and a (rx_bytes, tx_bytes)
+             tuple as value
+    """
+    stats = {}
+    # the first two lines are the header
+    for line in data.splitlines()[2:]:
+        if ':' not in line:
+            continue
+
+        iface, counters = line.split(':', 1)
+        counters = counters.split()
+        # rx_bytes is the first receive field and tx_bytes the first
+        # transmit one, there are eight receive fields
+        try:
+            stats[iface.strip()] = (int(counters[0]), int(counters[8]))
+        except (IndexError, ValueError):
+            log.err("Could not parse %s line: %r" % (NET_DEV, line))
+
+    return stats
+
 
 class HardwareManager(object):
     """
@@ -427,6 +454,7 @@ class LinuxPlugin(UnixPlugin):
 
     dialer = None
     hw_manager = get_hw_manager()
+    net_dev_path = NET_DEV
 
     def __init__(self):
         super(LinuxPlugin, self).__init__()
@@ -466,5 +494,16 @@ class LinuxPlugin(UnixPlugin):
         except (IOError, OSError):
             return 0, 0
 
+    def get_ifaces_stats(self, ifaces):
+        """See :meth:`wader.common.interfaces.IOSPlugin.get_ifaces_stats`"""
+        # a single read of /proc/net/dev gets the counters of all the
+        # ifaces, instead of opening two sysfs files per iface
+        try:
+            stats = parse_net_dev(get_file_data(self.net_dev_path))
+        except (IOError, OSError):
+            stats = {}
+
+        return dict((iface, stats.get(iface, (0, 0))) for iface in ifaces)
+
     def get_additional_wvdial_ppp_options(self):
         return ""
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Phone number normalization
+
+The same person can write to us as ``+34 600 123 456``, ``0034600123456``
+or ``600123456``. :func:`normalize_number` brings all of them to the
+E.164 form ``+34600123456``, using the MCC of the SIM to tell which
+country a national number belongs to. :func:`get_number_key` returns the
+last :data:`KEY_LENGTH` digits of a number, an index friendly key that
+is equal for the numbers that might be the same one.
+"""
+
+import re
+
+# digits of a number used as its lookup key
+KEY_LENGTH = 8
+# shorter numbers are short codes, they have no country
+MIN_NATIONAL_LENGTH = 7
+# the prefix to dial abroad, unless the country has its own
+INTERNATIONAL_PREFIX = '00'
+
+# key is the MCC, value a (country calling code, trunk prefix) tuple
+CALLING_CODES = {
+    '202': ('30', ''),      # Greece
+    '204': ('31', '0'),     # Netherlands
+    '206': ('32', '0'),     # Belgium
+    '208': ('33', '0'),     # France
+    '212': ('377', ''),     # Monaco
+    '213': ('376', ''),     # Andorra
+    '214': ('34', ''),      # Spain
+    '216': ('36', '06'),    # Hungary
+    '218': ('387', '0'),    # Bosnia and Herzegovina
+    '219': ('385', '0'),    # Croatia
+    '220': ('381', '0'),    # Serbia
+    '222': ('39', ''),      # Italy
+    '226': ('40', '0'),     # Romania
+    '228': ('41', '0'),     # Switzerland
+    '230': ('420', ''),     # Czech Republic
+    '231': ('421', '0'),    # Slovakia
+    '232': ('43', '0'),     # Austria
+    '234': ('44', '0'),     # United Kingdom
+    '235': ('44', '0'),     # United Kingdom
+    '238': ('45', ''),      # Denmark
+    '240': ('46', '0'),     # Sweden
+    '242': ('47', ''),      # Norway
+    '244': ('358', '0'),    # Finland
+    '246': ('370', '8'),    # Lithuania
+    '247': ('371', ''),     # Latvia
+    '248': ('372', ''),     # Estonia
+    '250': ('7', '8'),      # Russia
+    '255': ('380', '0'),    # Ukraine
+    '257': ('375', '8'),    # Belarus
+    '259': ('373', '0'),    # Moldova
+    '260': ('48', ''),      # Poland
+    '262': ('49', '0'),     # Germany
+    '266': ('350', ''),     # Gibraltar
+    '268': ('351', ''),     # Portugal
+    '270': ('352', ''),     # Luxembourg
+    '272': ('353', '0'),    # Ireland
+    '274': ('354', ''),     # Iceland
+    '276': ('355', '0'),    # Albania
+    '278': ('356', ''),     # Malta
+    '280': ('357', ''),     # Cyprus
+    '282': ('995', '0'),    # Georgia
+    '283': ('374', '0'),    # Armenia
+    '284': ('359', '0'),    # Bulgaria
+    '286': ('90', '0'),     # Turkey
+    '293': ('386', '0'),    # Slovenia
+    '294': ('389', '0'),    # Macedonia
+    '297': ('382', '0'),    # Montenegro
+    '302': ('1', '1'),      # Canada
+    '310': ('1', '1'),      # United States
+    '311': ('1', '1'),      # United States
+    '312': ('1', '1'),      # United States
+    '313': ('1', '1'),      # United States
+    '314': ('1', '1'),      # United States
+    '315': ('1', '1'),      # United States
+    '316': ('1', '1'),      # United States
+    '334': ('52', ''),      # Mexico
+    '404': ('91', '0'),     # India
+    '405': ('91', '0'),     # India
+    '410': ('92', '0'),     # Pakistan
+    '420': ('966', '0'),    # Saudi Arabia
+    '424': ('971', '0'),    # United Arab Emirates
+    '425': ('972', '0'),    # Israel
+    '432': ('98', '0'),     # Iran
+    '440': ('81', '0'),     # Japan
+    '441': ('81', '0'),     # Japan
+    '450': ('82', '0'),     # South Korea
+    '452': ('84', '0'),     # Vietnam
+    '454': ('852', ''),     # Hong Kong
+    '460': ('86', '0'),     # China
+    '466': ('886', '0'),    # Taiwan
+    '502': ('60', '0'),     # Malaysia
+    '505': ('61', '0'),     # Australia
+    '510': ('62', '0'),     # Indonesia
+    '515': ('63', '0'),     # Philippines
+    '520': ('66', '0'),     # Thailand
+    '525': ('65', ''),      # Singapore
+    '530': ('64', '0'),     # New Zealand
+    '602': ('20', '0'),     # Egypt
+    '604': ('212', '0'),    # Morocco
+    '621': ('234', '0'),    # Nigeria
+    '639': ('254', '0'),    # Kenya
+    '655': ('27', '0'),     # South Africa
+    '716': ('51', '0'),     # Peru
+    '722': ('54', '0'),     # Argentina
+    '724': ('55', '0'),     # Brazil
+    '730': ('56', ''),      # Chile
+    '732': ('57', ''),      # Colombia
+    '734': ('58', '0'),     # Venezuela
+    '748': ('598', '0'),    # Uruguay
+}
+
+# countries that do not dial abroad with INTERNATIONAL_PREFIX, key is
+# the country calling code
+INTERNATIONAL_PREFIXES = {
+    '1': '011',
+    '61': '0011',
+    '81': '010',
+}
+
+# the trunk prefixes a national number might start with
+TRUNK_PREFIXES = sorted(set([trunk for code, trunk in CALLING_CODES.values()
+                             if trunk]))
+
+SEPARATORS_REGEXP = re.compile(r'[\s\-\.\(\)/]')
+NUMBER_REGEXP = re.compile(r'^\+?\d+$')
+
+
+def normalize_number(number, mcc=None):
+    """
+    Returns ``number`` in E.164 form if possible
+
+    :param mcc: MCC of the SIM, used to turn national numbers into
+        international ones
+    :return: the normalized number, numbers that are not made of digits,
+        like alphanumeric senders, are returned unchanged
+    """
+    if not number:
+        return number
+
+    digits = SEPARATORS_REGEXP.sub('', number)
+    if not NUMBER_REGEXP.match(digits):
+        return number
+
+    if digits.startswith('+'):
+        return digits
+
+    code, trunk = CALLING_CODES.get(mcc and mcc[:3], (None, None))
+    prefix = INTERNATIONAL_PREFIXES.get(code, INTERNATIONAL_PREFIX)
+    if digits.startswith(prefix):
+        return '+' + digits[len(prefix):]
+
+    if code is None or len(digits) < MIN_NATIONAL_LENGTH:
+        # unknown country or short code
+        return digits
+
+    if trunk:
+        if digits.startswith(trunk):
+            return '+' + code + digits[len(trunk):]
+        # a national number missing its trunk prefix, leave it alone
+        return digits
+
+    return '+' + code + digits
+
+
+def get_number_key(normalized):
+    """Returns the lookup key of the ``normalized`` number"""
+    if not normalized or not NUMBER_REGEXP.match(normalized):
+        return normalized
+
+    return normalized.lstrip('+')[-KEY_LENGTH:]
+
+
+def numbers_match(a, b):
+    """
+    Returns whether the normalized numbers ``a`` and ``b`` are the same
+
+    A number whose country is unknown matches the numbers that end with
+    all its digits, at least :data:`MIN_NATIONAL_LENGTH` of them. Those
+    of an international number might follow a trunk prefix, so
+    ``07700900123`` matches ``+447700900123``. Sharing the key is not
+    enough, ``600123456`` does not match ``500123456``.
+    """
+    if a == b:
+        return True
+
+    if not NUMBER_REGEXP.match(a) or not NUMBER_REGEXP.match(b):
+        return False
+
+    # the national one, or the shorter one, must be the end of the other
+    short, other = sorted([a, b], key=lambda n: (n.startswith('+'), len(n)))
+    if short.startswith('+'):
+        # two international numbers
+        return False
+
+    trunks = ['']
+    if other.startswith('+'):
+        trunks += [trunk for trunk in TRUNK_PREFIXES
+                   if short.startswith(trunk)]
+
+    for trunk in trunks:
+        digits = short[len(trunk):]
+        if len(digits) >= MIN_NATIONAL_LENGTH and other.endswith(digits):
+            return True
+
+    return False
@@ -34,6 +34,7 @@ from wader.common.consts import (MDM_INTFACE, HSO_INTFACE, CRD_INTFACE,
                                  MM_MODEM_STATE_DISABLED,
                                  MM_MODEM_STATE_ENABLED)
 from wader.common.daemon import build_daemon_collection
+from wader.common.events import EventBus
 import wader.common.exceptions as ex
 import wader.common.interfaces as interfaces
 from wader.common.utils import flatten_list
@@ -86,6 +87,8 @@ class DevicePlugin(object):
         self.props = {MDM_INTFACE: {}, HSO_INTFACE: {}, CRD_INTFACE: {},
                       NET_INTFACE: {}, USD_INTFACE: {}}
         self.ports = None
+        # in-process bus for signals consumed by the core itself
+        self.events = EventBus()
 
     def __repr__(self):
         args = (self.__class__.__name__, self.ports)
@@ -275,6 +278,16 @@ class OSPlugin(object):
         """
         raise NotImplementedError()
 
+    def get_ifaces_stats(self, ifaces):
+        """
+        Returns the network statistics of every iface in ``ifaces``
+
+        Override me if the OS can read them all at once
+
+        :rtype: dict
+        """
+        return dict((iface, self.get_iface_stats(iface)) for iface in ifaces)
+
     def is_valid(self):
         """Returns True if we are on the given OS/Distro"""
         raise NotImplementedError()
@@ -22,9 +22,6 @@ A profile, also known as a connection in NM-lingo, is a group of
 settings to be used to dial up. This group of classes should be used
 from the user session, that is why they are defined and not instantiated.
 """
-from __future__ import with_statement
-
-from contextlib import closing
 import socket
 import time
 from uuid import uuid1
@@ -41,7 +38,7 @@ from wader.common.consts import (WADER_PROFILES_SERVICE,
                                  MM_NETWORK_BAND_ANY,
                                  MM_ALLOWED_MODE_ANY)
 import wader.common.exceptions as ex
-from wader.common.provider import NetworkProvider
+from wader.common.provider import get_network_trie
 from wader.common.utils import convert_ip_to_int
 
 
@@ -203,14 +200,13 @@ class ProfileManager(object):
         """Generates a new :class:`Profile` from ``imsi``"""
         log.msg("INFO profile.py: (wader.common) - "
                 "get_profile_options_from_imsi")
-        with closing(NetworkProvider()) as provider:
-            network = provider.get_network_by_id(imsi)
-            if network:
-                # XXX: use the first NetworkOperator object for now
-                network = network[0]
-                return self.get_profile_options_from_network(network)
-
-            raise ex.ProfileNotFoundError("No profile for IMSI %s" % imsi)
+        network = get_network_trie().get_network_by_id(imsi)
+        if network:
+            # XXX: use the first NetworkOperator object for now
+            network = network[0]
+            return self.get_profile_options_from_network(network)
+
+        raise ex.ProfileNotFoundError("No profile for IMSI %s" % imsi)
 
     def get_profile_options_from_network(self, network):
         """Generates a new :class:`Profile` from ``network``"""
@@ -85,6 +85,7 @@ class BufferingStateMachine(object, protocol.Protocol):
         Notify success to current :class:`~wader.common.command.ATCmd`
         """
         self.cancel_current_delayed_call()
+        self.publish_cmd_timing(True)
         try:
             self.cmd.deferred.callback(result)
         except Exception, e:
@@ -94,8 +95,19 @@ class BufferingStateMachine(object, protocol.Protocol):
     def notify_failure(self, failure):
         """Notify failure to current :class:`~wader.common.command.ATCmd`"""
         self.cancel_current_delayed_call()
+        self.publish_cmd_timing(False)
         self.cmd.deferred.errback(failure)
 
+    def publish_cmd_timing(self, ok):
+        """Publishes how long the current command took, if anyone cares"""
+        events = getattr(self.device, 'events', None)
+        if events is None or not events.has_subscribers(S.SIG_AT_CMD):
+            return
+
+        name = self.cmd.name if self.cmd.name else self.cmd.cmd
+        events.publish(S.SIG_AT_CMD, name, self.cmd.sent, reactor.seconds(),
+                       ok)
+
     def set_cmd(self, cmd):
         """
         Sets ``cmd`` as the next command to process
@@ -103,6 +115,7 @@ class BufferingStateMachine(object, protocol.Protocol):
         It also sets an initial timeout and transitions to waiting state
         """
         self.cmd = cmd
+        self.cmd.sent = reactor.seconds()
         # set the timeout for this command
         self.cmd.call_id = reactor.callLater(cmd.timeout, self._timeout_eb)
         self.set_state('waiting')
@@ -132,10 +145,18 @@ class BufferingStateMachine(object, protocol.Protocol):
         """
         Emits ``signal``
 
+        Internal subscribers are notified through the device's
+        :class:`~wader.common.events.EventBus`, the DBus signal is only
+        emitted for the benefit of external clients.
+
         :param signal: The name of the signal to emit
         :param args: The arguments for the signal ``signal``
         :param kwds: The keywords for the signal ``signal``
         """
+        events = getattr(self.device, 'events', None)
+        if events is not None:
+            events.publish(signal, *args)
+
         method = getattr(self.device.exporter, signal, None)
         if method:
             method(*args, **kwds)
@@ -19,16 +19,26 @@
 from __future__ import with_statement
 
 import datetime
+import hashlib
+import shutil
 import sqlite3
 import os
+import struct
 import sys
+from bisect import bisect_left
 from time import mktime
 from calendar import timegm
 
 from pytz import timezone, country_names
-from xml.dom.minidom import parse
+from twisted.python import log
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 from wader.common.consts import EXTRA_DIR, MBPI, NETWORKS_DB
+from wader.common.phonenumber import (normalize_number, get_number_key,
+                                      numbers_match)
 from wader.common.sms import Message as _Message
 from wader.common.utils import (get_value_and_pop, get_tz_aware_now,
                                 get_tz_aware_mtime)
@@ -164,6 +174,95 @@ begin
 end;
 """
 
+SMS_NUMBER_SCHEMA = """
+-- normalized number of every thread, see wader.common.phonenumber
+create table thread_number (
+    thread_id integer primary key,
+    normalized text,
+    number_key text);
+
+create index thread_number_key_index on thread_number(number_key);
+
+create trigger fki_thread_number after insert on "thread"
+begin
+    insert into thread_number
+    values (new."id", normalize_number(new."number"),
+            number_key(normalize_number(new."number")));
+end;
+
+create trigger fku_thread_number after update of number on "thread"
+begin
+    update thread_number
+    set
+        normalized = normalize_number(new."number"),
+        number_key = number_key(normalize_number(new."number"))
+    where thread_id = new."id";
+end;
+
+create trigger fkd_thread_number after delete on "thread"
+begin
+    delete from thread_number where thread_id = old."id";
+end;
+
+-- existing threads
+insert into thread_number
+select id, normalize_number(number), number_key(normalize_number(number))
+from thread;
+"""
+
+# the listings are paginated newest first, these indexes spare the sorts
+SMS_DATE_SCHEMA = """
+create index if not exists message_date_index on message(date, id);
+create index if not exists message_thread_date_index
+    on message(thread_id, date, id);
+create index if not exists thread_date_index on thread(date, id);
+create index if not exists thread_folder_date_index
+    on thread(folder_id, date, id);
+"""
+
+# %(module)s is the best full-text module the sqlite library offers
+SMS_FTS_SCHEMA = """
+create virtual table message_fts using %(module)s;
+
+create trigger fki_message_fts after insert on "message"
+begin
+    insert into message_fts(docid, text) values (new."id", new."text");
+end;
+
+create trigger fku_message_fts after update of text on "message"
+begin
+    update message_fts set text = new."text" where docid = old."id";
+end;
+
+create trigger fkd_message_fts after delete on "message"
+begin
+    delete from message_fts where docid = old."id";
+end;
+
+-- existing messages
+insert into message_fts(docid, text) select id, text from message;
+"""
+
+# full-text modules tried, best first
+FTS_MODULES = ['fts4(text, tokenize=unicode61)', 'fts4(text)', 'fts3(text)']
+
+# messages inserted at once by a bulk import
+IMPORT_BATCH_SIZE = 1000
+
+# messages returned per page of search results
+SEARCH_PAGE_SIZE = 50
+# newest matches ranked by a search, ranking every match of a very
+# common word would take too long
+SEARCH_CANDIDATES = 1000
+
+# MCC/MNC prefixes tried on an IMSI, longest first
+IMSI_PREFIX_LENGTHS = [7, 6, 5]
+
+NETWORK_OPERATOR_QUERY = """select n.id, n.name, n.country, a.apn,
+a.username, a.password, a.dns1, a.dns2, a.type, a.smsc, a.mmsc, a.wap1,
+a.wap2, a.wap_apn, a.wap_username, a.wap_password, a.auth, a.wap_auth
+from network_info n inner join apn a on n.id = a.network_id"""
+
 NETWORKS_SCHEMA = """
 create table network_info(
     id text primary key,
@@ -245,6 +344,105 @@ create table version (
 insert into version values (%(version)d);
 """
 
+# daily and monthly rollups of the usage table, days and months are in
+# local time and a session is accounted to the day it started
+USAGE_ROLLUP_SCHEMA = """
+create table usage_day(
+    day text not null,
+    umts boolean not null,
+    bytes_recv integer default 0,
+    bytes_sent integer default 0,
+    items integer default 0,
+    primary key (day, umts));
+
+create table usage_month(
+    month text not null,
+    umts boolean not null,
+    bytes_recv integer default 0,
+    bytes_sent integer default 0,
+    items integer default 0,
+    primary key (month, umts));
+
+create index usage_start_time_index on usage(start_time);
+
+-- add new usage to the rollups
+create trigger fki_usage_rollup after insert on "usage"
+begin
+    insert or ignore into usage_day(day, umts)
+        values (date(new."start_time", 'unixepoch', 'localtime'),
+                coalesce(new."umts", 0));
+    update usage_day
+    set
+        bytes_recv = bytes_recv + new."bytes_recv",
+        bytes_sent = bytes_sent + new."bytes_sent",
+        items = items + 1
+    where day = date(new."start_time", 'unixepoch', 'localtime')
+        and umts = coalesce(new."umts", 0);
+    insert or ignore into usage_month(month, umts)
+        values (strftime('%%Y-%%m', new."start_time", 'unixepoch', 'localtime'),
+                coalesce(new."umts", 0));
+    update usage_month
+    set
+        bytes_recv = bytes_recv + new."bytes_recv",
+        bytes_sent = bytes_sent + new."bytes_sent",
+        items = items + 1
+    where month = strftime('%%Y-%%m', new."start_time", 'unixepoch', 'localtime')
+        and umts = coalesce(new."umts", 0);
+end;
+
+-- remove deleted usage from the rollups
+create trigger fkd_usage_rollup after delete on "usage"
+begin
+    update usage_day
+    set
+        bytes_recv = bytes_recv - old."bytes_recv",
+        bytes_sent = bytes_sent - old."bytes_sent",
+        items = items - 1
+    where day = date(old."start_time", 'unixepoch', 'localtime')
+        and umts = coalesce(old."umts", 0);
+    delete from usage_day
+    where day = date(old."start_time", 'unixepoch', 'localtime')
+        and umts = coalesce(old."umts", 0) and items <= 0;
+    update usage_month
+    set
+        bytes_recv = bytes_recv - old."bytes_recv",
+        bytes_sent = bytes_sent - old."bytes_sent",
+        items = items - 1
+    where month = strftime('%%Y-%%m', old."start_time", 'unixepoch', 'localtime')
+        and umts = coalesce(old."umts", 0);
+    delete from usage_month
+    where month = strftime('%%Y-%%m', old."start_time", 'unixepoch', 'localtime')
+        and umts = coalesce(old."umts", 0) and items <= 0;
+end;
+
+-- build the rollups of the existing usage
+insert into usage_day(day, umts, bytes_recv, bytes_sent, items)
+    select date(start_time, 'unixepoch', 'localtime'), coalesce(umts, 0),
+           sum(bytes_recv), sum(bytes_sent), count(*)
+    from usage group by 1, 2;
+
+insert into usage_month(month, umts, bytes_recv, bytes_sent, items)
+    select strftime('%%Y-%%m', start_time, 'unixepoch', 'localtime'),
+           coalesce(umts, 0), sum(bytes_recv), sum(bytes_sent), count(*)
+    from usage group by 1, 2;
+
+update version set version = %(version)d;
+"""
+
+# counters of the ongoing sessions, merged into the usage table when the
+# session ends or, after a crash, the next time the DB is opened
+USAGE_CHECKPOINT_SCHEMA = """
+create table usage_checkpoint(
+    session text primary key,
+    start_time datetime not null,
+    end_time datetime not null,
+    bytes_recv integer not null,
+    bytes_sent integer not null,
+    umts boolean);
+
+update version set version = %(version)d;
+"""
+
 # constants
 INBOX, OUTBOX, DRAFTS = 1, 2, 3
 UNREAD, READ = 0x01, 0x02
@@ -278,6 +476,73 @@ def message_read(flags):
     return (int(flags) & READ) >> 1
 
 
+def rank_sms(matchinfo):
+    """
+    Returns the relevance of a full-text match
+
+    Every phrase of the query scores the ratio of its hits in the message
+    to its hits in all the messages, so rare words weigh more.
+
+    :param matchinfo: blob returned by matchinfo() in its default format
+    """
+    data = str(matchinfo)
+    info = struct.unpack('=%dI' % (len(data) / 4), data)
+    phrases, columns = info[0], info[1]
+    score = 0.0
+    for i in range(phrases * columns):
+        hits, total = info[2 + 3 * i], info[3 + 3 * i]
+        if hits:
+            score += float(hits) / total
+
+    return score
+
+
+def build_fts_query(text):
+    """
+    Returns a full-text query that matches the messages with every word
+    of ``text``, the last one being a prefix
+    """
+    words = text.replace('"', ' ').split()
+    if not words:
+        return None
+
+    phrases = ['"%s"' % word for word in words]
+    phrases[-1] = '"%s*"' % words[-1]
+    return ' '.join(phrases)
+
+
+def escape_like(text):
+    """
+    Returns ``text`` escaped to be matched literally by LIKE
+
+    The pattern must be followed by ``ESCAPE '\\'``
+    """
+    for char in '\\%_':
+        text = text.replace(char, '\\' + char)
+
+    return text
+
+
+def execute_script(cursor, script):
+    """
+    Runs ``script`` with ``cursor`` in a transaction
+
+    The connection must be in autocommit mode. If any statement fails the
+    transaction is rolled back and the error raised.
+    """
+    try:
+        cursor.executescript("begin;\n%s\ncommit;" % script)
+    except sqlite3.Error:
+        # conn.rollback() does not know about a transaction begun by
+        # executescript, it would stay open
+        try:
+            cursor.execute("rollback")
+        except sqlite3.OperationalError:
+            # the script failed before begin
+            pass
+        raise
+
+
 def adapt_datetime(_datetime):
     if _datetime.tzinfo is None:
         # Naive object - Force to UTC, previous behaviour was to use mktime to
@@ -311,6 +576,10 @@ class DBError(Exception):
 class DBProvider(object):
     """Base class for the DB providers"""
 
+    # methods that open and commit their own transactions, the
+    # AsyncProvider never groups them with other writes
+    exclusive_methods = ()
+
     def __init__(self, path, schema, **kw):
         self.conn = sqlite3.connect(path, isolation_level=None, **kw)
         c = self.conn.cursor()
@@ -368,15 +637,167 @@ class UsageItem(object):
                    umts=bool(row[5]))
 
 
+class UsageSummary(object):
+    """I represent the aggregated data usage of a period"""
+
+    def __init__(self, period=None, bytes_recv=0, bytes_sent=0, items=0):
+        self.period = period
+        self.bytes_recv = bytes_recv
+        self.bytes_sent = bytes_sent
+        self.items = items
+
+    def __repr__(self):
+        args = (self.period, self.bytes_recv, self.bytes_sent, self.items)
+        return ("<UsageSummary period: %s bytes_recv: %d  bytes_sent: %d "
+                "items: %d>" % args)
+
+    def total(self):
+        return self.bytes_recv + self.bytes_sent
+
+    @classmethod
+    def from_row(cls, row, period=None):
+        return cls(period=period, bytes_recv=int(row[0] or 0),
+                   bytes_sent=int(row[1] or 0), items=int(row[2] or 0))
+
+
+def _first_day_of_next_month(month):
+    if month.month < 12:
+        return month.replace(day=1, month=month.month + 1)
+
+    return month.replace(day=1, month=1, year=month.year + 1)
+
+
 class UsageProvider(DBProvider):
     """DB usage provider"""
 
-    version = 1
+    version = 3
 
     def __init__(self, path):
         args = dict(version=self.version)
         super(UsageProvider, self).__init__(path, USAGE_SCHEMA % args,
                                         detect_types=sqlite3.PARSE_DECLTYPES)
+        self._upgrade()
+
+    def _upgrade(self):
+        # new DBs and the ones created by older versions lack these tables
+        for table, schema in [('usage_day', USAGE_ROLLUP_SCHEMA),
+                              ('usage_checkpoint', USAGE_CHECKPOINT_SCHEMA)]:
+            c = self.conn.cursor()
+            c.execute("select 1 from sqlite_master where type='table' "
+                      "and name=?", (table,))
+            if c.fetchone() is not None:
+                continue
+
+            execute_script(c, schema % dict(version=self.version))
+
+    def _run_in_transaction(self, func, *args):
+        # join the ongoing transaction, if any
+        if self.conn.isolation_level is not None:
+            return func(self.conn.cursor(), *args)
+
+        self.conn.isolation_level = 'DEFERRED'
+        try:
+            try:
+                ret = func(self.conn.cursor(), *args)
+                self.conn.commit()
+                return ret
+            except:
+                self.conn.rollback()
+                raise
+        finally:
+            self.conn.isolation_level = None
+
+    def _get_summary(self, period, table, column, start, end, umts):
+        sql = ("select sum(bytes_recv), sum(bytes_sent), sum(items) "
+               "from %s where %s >= ?" % (table, column))
+        args = [start]
+        if end is not None:
+            sql += " and %s < ?" % column
+            args.append(end)
+        if umts is not None:
+            sql += " and umts = ?"
+            args.append(bool(umts))
+
+        c = self.conn.cursor()
+        c.execute(sql, args)
+        return UsageSummary.from_row(c.fetchone(), period)
+
+    def get_usage_summary_for_day(self, day, umts=None):
+        """
+        Returns a `UsageSummary` with the usage of ``day``
+
+        :type day: ``datetime.date``
+        :param umts: only account 3G (True) or GPRS (False) usage
+        """
+        if not isinstance(day, datetime.date):
+            raise ValueError("Don't know what to do with %s" % day)
+
+        tomorrow = day + datetime.timedelta(days=1)
+        return self._get_summary(day, 'usage_day', 'day', day.isoformat(),
+                                 tomorrow.isoformat(), umts)
+
+    def get_usage_summary_for_month(self, month, umts=None):
+        """
+        Returns a `UsageSummary` with the usage of ``month``
+
+        :type month: ``datetime.date``
+        :param umts: only account 3G (True) or GPRS (False) usage
+        """
+        if not isinstance(month, datetime.date):
+            raise ValueError("Don't know what to do with %s" % month)
+
+        next_month = _first_day_of_next_month(month)
+        return self._get_summary(month, 'usage_month', 'month',
+                                 month.strftime('%Y-%m'),
+                                 next_month.strftime('%Y-%m'), umts)
+
+    def get_total_usage_summary(self, day=None, umts=None):
+        """
+        Returns a `UsageSummary` with all the usage since ``day``
+
+        :type day: ``datetime.date``
+        :param umts: only account 3G (True) or GPRS (False) usage
+        """
+        if day is None:
+            return self._get_summary(None, 'usage_month', 'month', '', None,
+                                     umts)
+
+        if not isinstance(day, datetime.date):
+            raise ValueError("Don't know what to do with %s" % day)
+
+        if day.day == 1:
+            # whole months, use the smaller table
+            return self._get_summary(day, 'usage_month', 'month',
+                                     day.strftime('%Y-%m'), None, umts)
+
+        return self._get_summary(day, 'usage_day', 'day', day.isoformat(),
+                                 None, umts)
+
+    def get_daily_usage(self, start, end, umts=None):
+        """
+        Returns a `UsageSummary` per day with usage in [``start``, ``end``)
+
+        :type start: ``datetime.date``
+        :type end: ``datetime.date``
+        :param umts: only account 3G (True) or GPRS (False) usage
+        :rtype: list
+        """
+        sql = ("select day, sum(bytes_recv), sum(bytes_sent), sum(items) "
+               "from usage_day where day >= ? and day < ?")
+        args = [start.isoformat(), end.isoformat()]
+        if umts is not None:
+            sql += " and umts = ?"
+            args.append(bool(umts))
+        sql += " group by day order by day"
+
+        c = self.conn.cursor()
+        c.execute(sql, args)
+        ret = []
+        for row in c.fetchall():
+            day = datetime.date(*map(int, row[0].split('-')))
+            ret.append(UsageSummary.from_row(row[1:], day))
+
+        return ret
 
     def add_usage_item(self, start, end, bytes_recv, bytes_sent, umts):
         c = self.conn.cursor()
@@ -392,6 +813,59 @@ class UsageProvider(DBProvider):
         c = self.conn.cursor()
         c.execute("delete from usage where id=?", (item.index,))
 
+    def checkpoint_usage(self, sessions):
+        """
+        Saves the counters of the ongoing ``sessions`` in one transaction
+
+        :param sessions: list of (session, start, end, bytes_recv,
+            bytes_sent, umts) tuples, ``session`` identifies the session
+            and a newer checkpoint replaces the previous one
+        """
+        def checkpoint(c):
+            c.executemany("insert or replace into usage_checkpoint(session, "
+                          "start_time, end_time, bytes_recv, bytes_sent, "
+                          "umts) values (?,?,?,?,?,?)", sessions)
+
+        self._run_in_transaction(checkpoint)
+
+    def close_usage_session(self, session, start, end, bytes_recv,
+                            bytes_sent, umts):
+        """
+        Adds the usage of the finished ``session`` and drops its checkpoint
+
+        :rtype: `UsageItem`
+        """
+        def close(c):
+            c.execute("delete from usage_checkpoint where session=?",
+                      (session,))
+            c.execute("insert into usage(start_time, end_time, bytes_recv,"
+                      "bytes_sent, umts) values (?,?,?,?,?)",
+                      (start, end, bytes_recv, bytes_sent, umts))
+            return c.lastrowid
+
+        index = self._run_in_transaction(close)
+        return UsageItem(umts=umts, start_time=start, end_time=end,
+                         bytes_recv=bytes_recv, bytes_sent=bytes_sent,
+                         index=index)
+
+    def recover_usage_sessions(self):
+        """
+        Adds the usage of the sessions interrupted by a crash
+
+        Their usage is accounted up to their last checkpoint.
+
+        :return: the number of recovered sessions
+        """
+        def recover(c):
+            c.execute("insert into usage(start_time, end_time, bytes_recv,"
+                      "bytes_sent, umts) select start_time, end_time, "
+                      "bytes_recv, bytes_sent, umts from usage_checkpoint")
+            count = c.rowcount
+            c.execute("delete from usage_checkpoint")
+            return count
+
+        return self._run_in_transaction(recover)
+
     def get_usage_for_day(self, day):
         """
         Returns all `UsageItem` for ``day``
@@ -422,14 +896,7 @@ class UsageProvider(DBProvider):
             raise ValueError("Don't know what to do with %s" % month)
 
         first_current_month_day = month.replace(day=1)
-        if month.month < 12:
-            _month = month.month + 1
-            _year = month.year
-        else:
-            _month = 1
-            _year = month.year + 1
-
-        first_next_month_day = month.replace(day=1, month=_month, year=_year)
+        first_next_month_day = _first_day_of_next_month(month)
 
         args = (date_to_datetime(first_current_month_day),
                 date_to_datetime(first_next_month_day))
@@ -499,26 +966,40 @@ class NetworkOperator(object):
                      wap_auth=row[16])
 
 
+def check_imsi(imsi):
+    """Raises an exception if ``imsi`` is not a whole IMSI"""
+    if not isinstance(imsi, basestring):
+        raise TypeError("argument must be a string subclass")
+
+    if len(imsi) < 14:
+        raise ValueError("Pass the whole imsi")
+
+
 class NetworkProvider(DBProvider):
     """DB network provider"""
 
     version = 2
+    exclusive_methods = ('update_networks', 'populate_networks')
 
     def __init__(self, path=NETWORKS_DB):
         args = dict(version=self.version)
         super(NetworkProvider, self).__init__(path, NETWORKS_SCHEMA % args)
 
-    def is_current(self):
+    def get_version(self):
+        """Returns the version of the DB schema, 0 if unknown"""
         c = self.conn.cursor()
         try:
             c.execute("select version from version")
-            version = c.fetchone()[0]
-            if version < self.version:
-                return False
+            return c.fetchone()[0]
         except (TypeError, sqlite3.OperationalError):
             # version table wasn't populated in old DB
+            return 0
+
+    def is_current(self):
+        if self.get_version() < self.version:
             return False
 
+        c = self.conn.cursor()
         try:
             c.execute("select * from sources_info")
             row = c.fetchone()
@@ -535,36 +1016,119 @@ class NetworkProvider(DBProvider):
 
         return True
 
+    def get_network_hashes(self):
+        """
+        Returns a hash of the contents of every network
+
+        :return: dict, key is the network id and the value the hash of its
+            info and APNs
+        """
+        c = self.conn.cursor()
+        contents = {}
+        c.execute("select id, name, country from network_info")
+        for row in c.fetchall():
+            contents[row[0]] = (row[1:], [])
+
+        # every apn column but the ids
+        c.execute("select n.id, a.apn, a.username, a.password, a.dns1, "
+                  "a.dns2, a.type, a.auth, a.smsc, a.mmsc, a.wap1, a.wap2, "
+                  "a.wap_apn, a.wap_username, a.wap_password, a.wap_auth "
+                  "from network_info n inner join apn a on "
+                  "n.id = a.network_id")
+        for row in c.fetchall():
+            contents[row[0]][1].append(row[1:])
+
+        hashes = {}
+        for netid, (info, apns) in contents.iteritems():
+            apns.sort()
+            hashes[netid] = hashlib.md5(repr((info, apns))).hexdigest()
+
+        return hashes
+
+    def update_networks(self, source):
+        """
+        Makes the networks of this DB equal to those of ``source``
+
+        Only the networks whose contents changed are rewritten, all in a
+        single transaction. The sources info is copied too.
+
+        :param source: an up to date :class:`NetworkProvider`
+        :return: the number of networks added, changed or removed
+        """
+        mine = self.get_network_hashes()
+        theirs = source.get_network_hashes()
+        changed = [netid for netid, _hash in theirs.iteritems()
+                   if mine.get(netid) != _hash]
+        removed = [netid for netid in mine if netid not in theirs]
+
+        src = source.conn.cursor()
+        networks = []
+        apns = []
+        for netid in changed:
+            src.execute("select * from network_info where id=?", (netid,))
+            networks.append(src.fetchone())
+            src.execute("select a.* from network_info n inner join apn a on "
+                        "n.id = a.network_id where n.id=?", (netid,))
+            apns.extend([(None,) + row[1:] for row in src.fetchall()])
+
+        src.execute("select * from sources_info")
+        sources = src.fetchall()
+
+        self.conn.isolation_level = 'DEFERRED'
+        try:
+            try:
+                c = self.conn.cursor()
+                # the apns go away with their network
+                c.executemany("delete from network_info where id=?",
+                              [(netid,) for netid in changed + removed])
+                c.executemany("insert into network_info values (?,?,?)",
+                              networks)
+                c.executemany("insert into apn values (?,?,?,?,?,?,?,?,"
+                              "?,?,?,?,?,?,?,?,?)", apns)
+                c.execute("delete from sources_info")
+                c.executemany("insert into sources_info values (?,?)",
+                              sources)
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+        finally:
+            self.conn.isolation_level = None
+
+        return len(changed) + len(removed)
+
     def get_network_by_id(self, imsi):
         """
         Returns all the :class:`NetworkOperator` registered for ``imsi``
 
         :rtype: list
         """
-        if not isinstance(imsi, basestring):
-            raise TypeError("argument must be a string subclass")
+        check_imsi(imsi)
 
-        if len(imsi) < 14:
-            raise ValueError("Pass the whole imsi")
+        # all the candidate prefixes in one go, the longest one wins
+        prefixes = [imsi[:n] for n in IMSI_PREFIX_LENGTHS]
+        c = self.conn.cursor()
+        c.execute(NETWORK_OPERATOR_QUERY + " where n.id in (?,?,?) "
+                  "order by length(n.id) desc, a.id", prefixes)
 
-        for n in [7, 6, 5]:
-            result = self._get_network_by_id(imsi[:n])
-            if result:
-                return result
+        ret = []
+        for row in c.fetchall():
+            if ret and row[0] != ret[0].netid[0]:
+                break
+            ret.append(NetworkOperator.from_row(row[1:], row[0]))
 
-        return []
+        return ret
 
-    def _get_network_by_id(self, netid):
-        c = self.conn.cursor()
-        c.execute("select n.name, n.country, a.apn, a.username,"
-                  "a.password, a.dns1, a.dns2, a.type, a.smsc, "
-                  "a.mmsc, a.wap1, a.wap2, a.wap_apn, "
-                  "a.wap_username, a.wap_password, a.auth, a.wap_auth "
-                  "from network_info n inner join apn a on "
-                  "n.id = a.network_id where n.id=?", (netid,))
+    def get_network_rows(self):
+        """
+        Returns the operator rows of every network
 
-        ret = [NetworkOperator.from_row(row, netid) for row in c.fetchall()]
-        return ret
+        :return: list of (netid, row) tuples, ``row`` is suitable for
+            :meth:`NetworkOperator.from_row`
+        """
+        c = self.conn.cursor()
+        c.execute(NETWORK_OPERATOR_QUERY + " order by n.id, a.id")
+        return [(row[0], row[1:]) for row in c.fetchall()]
 
     def populate_networks(self):
         """
@@ -660,118 +1224,276 @@ class NetworkProvider(DBProvider):
         """
         Populate the network database with info from``xmlfile``
 
+        The file is parsed incrementally and every provider is discarded
+        as soon as it has been processed. All the rows are inserted in a
+        single transaction.
+
         :param xmlfile: the path to the mobile-broadband-provider-info xml file
         """
         nick_debug("provider.py - populate_networks_from_mdpi")
         nick_debug("provider.py - populate_networks_from_mdpi: xmlfile for  "
                    "mbpi is: %s" % repr(xmlfile))
 
-        def getAttributeValue(element, name):
-            if element is None or not hasattr(element, 'attributes'):
-                return ''
-            attr = element.attributes[name]
-            if not attr:
+        def get_text(element):
+            if element is None or not element.text:
                 return ''
-            return attr.value.strip()
-
-        def getElementsByTagNameNoDescend(parent, name):
-            ret = []
-            for node in parent.childNodes:
-                if node.nodeType == node.ELEMENT_NODE and \
-                    (name == "*" or node.tagName == name):
-                    ret.append(node)
-            return ret
-
-        def getValue(elementlist, index=0):
-            if elementlist is None or index >= len(elementlist):
-                return ''
-            if not elementlist[index].firstChild:
-                return ''
-            return elementlist[index].firstChild.data.strip()
-
-        root = parse(xmlfile)
-        svcs = getElementsByTagNameNoDescend(root, "serviceproviders")[0]
+            return element.text.strip()
 
-        version = getAttributeValue(svcs, "format")
-        if version != '2.0':
-            raise(TypeError)
+        def as_network_id(netid):
+            # apn.network_id has integer affinity, compare like sqlite does
+            if netid.isdigit():
+                return int(netid)
+            return netid
 
         c = self.conn.cursor()
 
-        for gsm in svcs.getElementsByTagName("gsm"):
+        # we are authoritative for the networks we ship APNs for
+        c.execute("select distinct network_id from apn "
+                  "where not type like 'MBPI%'")
+        preloaded = set([row[0] for row in c.fetchall()])
+        # and we don't want duplicates of the others either
+        c.execute("select network_id, apn, username, password, dns1, dns2, "
+                  "type from apn where type like 'MBPI%'")
+        apns = set(c.fetchall())
+
+        networks = []
+        new_apns = []
+        country = None
+
+        events = iterparse(xmlfile, events=('start', 'end'))
+        for event, element in events:
+            if event == 'start':
+                if element.tag == 'serviceproviders':
+                    if element.get('format') != '2.0':
+                        raise TypeError("Unsupported MBPI format")
+                elif element.tag == 'country':
+                    country = element.get('code', '').strip()
+                continue
 
-            provider = gsm.parentNode
-            country = provider.parentNode
+            if element.tag == 'country':
+                element.clear()
+                continue
+            elif element.tag != 'provider':
+                continue
 
-            countrycode = getAttributeValue(country, "code")
-            if countrycode == '':
+            if country == '':
+                element.clear()
                 continue
-            elif countrycode == 'gb':  # TZ DB is just plain wrong
+            elif country == 'gb':  # TZ DB is just plain wrong
                 countryname = 'United Kingdom'
             else:
-                countryname = country_names[countrycode]
-
-            # we need to be more specific about path to 'provider/name'
-            # as apn also has a subtag called 'name'
-            tag = getElementsByTagNameNoDescend(provider, "name")
-            provname = getValue(tag)
+                countryname = country_names[country]
 
-            for networkid in getElementsByTagNameNoDescend(gsm, "network-id"):
-                mcc = getAttributeValue(networkid, "mcc")
-                mnc = getAttributeValue(networkid, "mnc")
-                netid = mcc + mnc
+            # 'provider/name', apn also has a subtag called 'name'
+            provname = get_text(element.find('name'))
 
-                # check if this network object exists in the database
-                c.execute("select 1 from network_info where id=?", (netid,))
-                try:
-                    c.fetchone()[0]
-                except TypeError:
-                    # it does not exist
-                    args = (netid, provname, countryname)
-                    c.execute("insert into network_info values (?,?,?)", args)
+            for gsm in element.findall('gsm'):
+                for networkid in gsm.findall('network-id'):
+                    netid = (networkid.get('mcc', '').strip() +
+                             networkid.get('mnc', '').strip())
+                    networks.append((netid, provname, countryname))
 
-                for apn in getElementsByTagNameNoDescend(gsm, "apn"):
-                    apnname = getAttributeValue(apn, "value")
-                    if apnname == '':
+                    network_id = as_network_id(netid)
+                    if network_id in preloaded:
                         continue
 
-                    tag = getElementsByTagNameNoDescend(apn, "name")
-                    _type = getValue(tag)
-                    if len(_type):
-                        typename = u'MBPI - ' + _type
-                    else:
-                        typename = u'MBPI - ' + provname
-
-                    tag = getElementsByTagNameNoDescend(apn, "username")
-                    username = getValue(tag)
-
-                    tag = getElementsByTagNameNoDescend(apn, "password")
-                    password = getValue(tag)
-
-                    tag = getElementsByTagNameNoDescend(apn, "dns")
-                    dns1 = getValue(tag, 0)
-                    dns2 = getValue(tag, 1)
-
-                    # check if info exists in the database for this network,
-                    # we are authorititive for VF Networks, and we don't want
-                    # duplicates of the others either
-                    args = (netid, apnname, username, password, dns1, dns2, typename)
-                    c.execute("select id from apn where network_id=? and "
-                              "("
-                                   "(not type like 'MBPI%')"
-                                   " or "
-                                   "(apn=? and username=? and password=? and"
-                                   " dns1=? and dns2=? and type=?)"
-                              ")", args)
-                    try:
-                        c.fetchone()[0]
-                    except TypeError:
-                        # it does not exist
-                        args = (None, apnname, username, password, dns1, dns2,
-                                typename, None, None, None, None, None, None,
-                                None, None, None, netid)
-                        c.execute("insert into apn values (?,?,?,?,?,?,?,?,"
-                                  "?,?,?,?,?,?,?,?,?)", args)
+                    for apn in gsm.findall('apn'):
+                        apnname = apn.get('value', '').strip()
+                        if apnname == '':
+                            continue
+
+                        _type = get_text(apn.find('name'))
+                        typename = u'MBPI - ' + (_type or provname)
+                        dns = apn.findall('dns') + [None, None]
+
+                        key = (network_id, apnname,
+                               get_text(apn.find('username')),
+                               get_text(apn.find('password')),
+                               get_text(dns[0]), get_text(dns[1]), typename)
+                        if key in apns:
+                            continue
+
+                        apns.add(key)
+                        new_apns.append((None,) + key[1:] +
+                                        (None,) * 9 + (netid,))
+
+            # the provider is done, release it
+            element.clear()
+
+        autocommit = self.conn.isolation_level is None
+        if autocommit:
+            self.conn.isolation_level = 'DEFERRED'
+
+        try:
+            try:
+                # the first entry for a network wins
+                c.executemany("insert or ignore into network_info "
+                              "values (?,?,?)", networks)
+                c.executemany("insert into apn values (?,?,?,?,?,?,?,?,"
+                              "?,?,?,?,?,?,?,?,?)", new_apns)
+                if autocommit:
+                    self.conn.commit()
+            except:
+                if autocommit:
+                    self.conn.rollback()
+                raise
+        finally:
+            if autocommit:
+                self.conn.isolation_level = None
+
+
+def rebuild_networks_db(path=NETWORKS_DB, source=None):
+    """
+    Brings the networks DB at ``path`` up to date
+
+    The DB is updated in a copy that replaces it atomically once done, so
+    it can serve lookups meanwhile. Only the networks that changed are
+    rewritten.
+
+    :param source: an up to date :class:`NetworkProvider`, by default one
+        is populated from the current sources
+    :return: the number of networks added, changed or removed
+    """
+    if source is None:
+        source = NetworkProvider(':memory:')
+        try:
+            source.populate_networks()
+        except:
+            source.close()
+            raise
+
+    tmp_path = path + '.new'
+    if os.path.exists(tmp_path):
+        # leftover of an interrupted rebuild
+        os.unlink(tmp_path)
+
+    if os.path.exists(path):
+        old = NetworkProvider(path)
+        compatible = old.get_version() == NetworkProvider.version
+        old.close()
+        if compatible:
+            shutil.copyfile(path, tmp_path)
+
+    provider = NetworkProvider(tmp_path)
+    try:
+        count = provider.update_networks(source)
+    finally:
+        provider.close()
+        source.close()
+
+    os.rename(tmp_path, path)
+    invalidate_network_trie(path)
+    return count
+
+
+class NetworkTrie(object):
+    """
+    I map IMSI prefixes to their network operators
+
+    I am an in-memory copy of a networks DB that answers the longest
+    MCC/MNC prefix match of an IMSI without touching the DB. The network
+    ids are kept in a sorted list with their operator rows in a parallel
+    one, so a lookup is a bisection per MCC/MNC length (three at most).
+    """
+
+    def __init__(self):
+        self.netids = []
+        self.rows = []
+        self.size = 0
+
+    @classmethod
+    def from_provider(cls, provider):
+        """Returns a :class:`NetworkTrie` with the networks of ``provider``"""
+        networks = {}
+        for netid, row in provider.get_network_rows():
+            networks.setdefault(netid, []).append(row)
+
+        trie = cls()
+        trie.netids = sorted(networks)
+        trie.rows = [tuple(networks[netid]) for netid in trie.netids]
+        trie.size = len(trie.netids)
+        return trie
+
+    def lookup(self, imsi):
+        """
+        Returns the network with the longest prefix of ``imsi``
+
+        :return: a (netid, rows) tuple, None if there is no match
+        """
+        for length in IMSI_PREFIX_LENGTHS:
+            prefix = imsi[:length]
+            i = bisect_left(self.netids, prefix)
+            if i < self.size and self.netids[i] == prefix:
+                return prefix, self.rows[i]
+
+        return None
+
+    def get_network_by_id(self, imsi):
+        """
+        Returns all the :class:`NetworkOperator` registered for ``imsi``
+
+        :rtype: list
+        """
+        check_imsi(imsi)
+
+        match = self.lookup(imsi)
+        if match is None:
+            return []
+
+        netid, rows = match
+        return [NetworkOperator.from_row(row, netid) for row in rows]
+
+
+# process-wide tries, key is the path of the networks DB and value is a
+# ((st_ino, st_mtime), trie) tuple
+_network_tries = {}
+# bumped on every invalidation, so a trie built from a DB that has been
+# replaced meanwhile is not cached
+_network_tries_generation = 0
+
+
+def _get_db_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return st.st_ino, st.st_mtime
+
+
+def get_network_trie(path=NETWORKS_DB):
+    """
+    Returns the :class:`NetworkTrie` of the networks DB at ``path``
+
+    It is built on first use and shared by the whole process until the
+    DB file changes: it is stat'ed on every call, so processes that did
+    not rebuild the DB themselves pick up the new one too.
+    """
+    stamp = _get_db_stamp(path)
+    cached = _network_tries.get(path)
+    if cached is not None and stamp is not None and cached[0] == stamp:
+        return cached[1]
+
+    generation = _network_tries_generation
+    provider = NetworkProvider(path)
+    try:
+        trie = NetworkTrie.from_provider(provider)
+    finally:
+        provider.close()
+
+    if generation == _network_tries_generation and stamp is not None:
+        # a DB replaced while building has another stamp, so it will
+        # be picked up on next call
+        _network_tries[path] = (stamp, trie)
+
+    return trie
+
+
+def invalidate_network_trie(path=NETWORKS_DB):
+    """Discards the :class:`NetworkTrie` of the networks DB at ``path``"""
+    global _network_tries_generation
+    _network_tries_generation += 1
+    _network_tries.pop(path, None)
 
 
 # SMS
@@ -872,9 +1594,47 @@ class Thread(object):
 class SmsProvider(DBProvider):
     """DB Sms provider"""
 
+    exclusive_methods = ('import_sms',)
+
     def __init__(self, path):
         super(SmsProvider, self).__init__(path, SMS_SCHEMA)
         self.conn.create_function('msg_is_read', 1, message_read)
+        self.conn.create_function('normalize_number', 1, normalize_number)
+        self.conn.create_function('number_key', 1, get_number_key)
+        self.conn.create_function('rank_sms', 1, rank_sms)
+        self._upgrade()
+
+    def _has_table(self, name):
+        c = self.conn.cursor()
+        c.execute("select 1 from sqlite_master where type='table' "
+                  "and name=?", (name,))
+        return c.fetchone() is not None
+
+    def _upgrade(self):
+        # new DBs and the ones created by older versions lack these tables
+        c = self.conn.cursor()
+        if not self._has_table('thread_number'):
+            execute_script(c, SMS_NUMBER_SCHEMA)
+
+        c.executescript(SMS_DATE_SCHEMA)
+
+        if self._has_table('message_fts'):
+            self.fts = True
+            return
+
+        self.fts = False
+        for module in FTS_MODULES:
+            try:
+                execute_script(c, SMS_FTS_SCHEMA % dict(module=module))
+            except sqlite3.OperationalError:
+                # module not available in this sqlite
+                continue
+
+            self.fts = True
+            break
+        else:
+            log.msg("No full-text search in sqlite %s, searching SMS "
+                    "will be slow" % sqlite3.sqlite_version)
 
     def add_folder(self, folder):
         """
@@ -951,26 +1711,46 @@ class SmsProvider(DBProvider):
         except TypeError:
             raise DBError("Thread %d does not exist" % index)
 
+    def _find_thread_by_number(self, number, folder):
+        """
+        Returns the row of the thread of ``number`` under ``folder``
+
+        :return: the row, None if there is no such thread
+        """
+        normalized = normalize_number(number)
+        c = self.conn.cursor()
+        c.execute("select t.*, n.normalized from thread_number n "
+                  "inner join thread t on n.thread_id = t.id "
+                  "where n.number_key=? and t.folder_id=?",
+                  (get_number_key(normalized), folder.index))
+        rows = [row for row in c.fetchall()
+                if numbers_match(normalized, row[7])]
+        if len(rows) > 1:
+            # several candidates, an exact match still wins
+            rows = [row for row in rows if row[7] == normalized]
+
+        if len(rows) > 1:
+            raise DBError("Too many threads associated to number %s" % number)
+
+        return rows and rows[0] or None
+
     def get_thread_by_number(self, number, folder=inbox_folder):
         """
         Returns the :class:`Thread` that belongs to ``number`` under ``folder``
 
+        Numbers are compared in their normalized form, so ``number`` can
+        be written in any format.
+
         :rtype: :class:`Thread`
         """
-        c = self.conn.cursor()
-        sql = "select * from thread where number like ? and folder_id=?"
-        c.execute(sql, ("%%%s%%" % number, folder.index))
-        if c.rowcount == 1:
+        row = self._find_thread_by_number(number, folder)
+        if row is not None:
             # there already exists a thread for this number under folder
-            return Thread.from_row(c.fetchone())
-        elif c.rowcount < 1:
-            # create thread for this number
-            thread = Thread(get_tz_aware_now(), number, folder=folder)
-            return self.add_thread(thread)
-        elif c.rowcount > 1:
-            raise DBError("Too many threads associated to number %s" % number)
+            return Thread.from_row(row, folder=folder)
 
-        raise DBError("No thread found for number %s" % number)
+        # create thread for this number
+        thread = Thread(get_tz_aware_now(), number, folder=folder)
+        return self.add_thread(thread)
 
     def list_folders(self):
         """
@@ -982,51 +1762,257 @@ class SmsProvider(DBProvider):
         c.execute("select * from folder")
         return (Folder.from_row(row) for row in c.fetchall())
 
-    def list_from_folder(self, folder):
+    def _paginate(self, sql, args, alias, before, limit):
+        """
+        Returns ``sql`` and ``args`` completed with keyset pagination
+
+        The rows are sorted newest first by the date and id columns of
+        table ``alias``. Rows inserted meanwhile never shift the pages
+        that follow ``before``.
+
+        :param sql: the listing query, ending with its where clause
+        :param before: the last object of the previous page, if any
+        :param limit: maximum number of rows, None for all of them
+        """
+        args = list(args)
+        if before is not None:
+            sql += (" and %(t)s.date <= ? and (%(t)s.date < ? or "
+                    "%(t)s.id < ?)" % dict(t=alias))
+            args.extend([before.datetime, before.datetime, before.index])
+
+        sql += " order by %(t)s.date desc, %(t)s.id desc" % dict(t=alias)
+        if limit is not None:
+            sql += " limit ?"
+            args.append(limit)
+
+        return sql, args
+
+    def list_from_folder(self, folder, before=None, limit=None):
         """
         List all the :class:`Thread` objects that belong to ``folder``
 
+        :param before: only list the threads after this :class:`Thread`,
+            the last one of the previous page
+        :param limit: maximum number of threads to list
         :rtype: iter
         """
         c = self.conn.cursor()
-        sql = "select * from thread where folder_id=? order by date desc"
-        c.execute(sql, (folder.index,))
-        return (Thread.from_row(row, folder=folder) for row in c.fetchall())
+        sql, args = self._paginate("select * from thread t where "
+                                   "t.folder_id=?", [folder.index], 't',
+                                   before, limit)
+        c.execute(sql, args)
+        return (Thread.from_row(row, folder=folder) for row in c)
 
-    def list_from_thread(self, thread):
+    def list_from_thread(self, thread, before=None, limit=None):
         """
         List all the :class:`Message` objects that belong to ``thread``
 
+        :param before: only list the messages after this :class:`Message`,
+            the last one of the previous page
+        :param limit: maximum number of messages to list
         :rtype: iter
         """
         c = self.conn.cursor()
-        sql = "select * from message where thread_id=? order by date desc"
-        c.execute(sql, (thread.index,))
-        return (Message.from_row(row, thread=thread) for row in c.fetchall())
+        sql, args = self._paginate("select * from message m where "
+                                   "m.thread_id=?", [thread.index], 'm',
+                                   before, limit)
+        c.execute(sql, args)
+        return (Message.from_row(row, thread=thread) for row in c)
 
-    def list_threads(self):
+    def list_threads(self, before=None, limit=None):
         """
         List all the :class:`Thread` objects in the DB
 
+        :param before: only list the threads after this :class:`Thread`,
+            the last one of the previous page
+        :param limit: maximum number of threads to list
         :rtype: iter
         """
         c = self.conn.cursor()
-        c.execute("select * from thread order by date desc")
+        sql, args = self._paginate("select t.*, f.* from thread t "
+                                   "inner join folder f on "
+                                   "t.folder_id = f.id where 1", [], 't',
+                                   before, limit)
+        c.execute(sql, args)
+        # every folder is built once and shared by its threads
+        folders = {}
         for row in c:
-            folder = self._get_folder_by_id(row[6])
+            folder = folders.get(row[6])
+            if folder is None:
+                folder = folders[row[6]] = Folder.from_row(row[7:])
+
             yield Thread.from_row(row, folder=folder)
 
-    def list_sms(self):
+    def _iter_messages(self, c):
+        """
+        Yields the :class:`Message` of the message, thread and folder rows
+        in cursor ``c``
+        """
+        # every thread and folder is built once and shared by its messages
+        threads = {}
+        folders = {}
+        for row in c:
+            thread = threads.get(row[5])
+            if thread is None:
+                folder = folders.get(row[12])
+                if folder is None:
+                    folder = folders[row[12]] = Folder.from_row(row[13:])
+
+                thread = threads[row[5]] = Thread.from_row(row[6:],
+                                                           folder=folder)
+
+            yield Message.from_row(row, thread=thread)
+
+    def list_sms(self, before=None, limit=None):
         """
         List all the :class:`Message` objects in the DB
 
+        :param before: only list the messages after this :class:`Message`,
+            the last one of the previous page
+        :param limit: maximum number of messages to list
         :rtype: iter
         """
         c = self.conn.cursor()
-        c.execute("select * from message order by date desc")
-        for row in c:
-            thread = self._get_thread_by_id(row[5])
-            yield Message.from_row(row, thread=thread)
+        sql, args = self._paginate("select m.*, t.*, f.* from message m "
+                                   "inner join thread t on "
+                                   "m.thread_id = t.id "
+                                   "inner join folder f on "
+                                   "t.folder_id = f.id where 1", [], 'm',
+                                   before, limit)
+        c.execute(sql, args)
+        return self._iter_messages(c)
+
+    def search_sms(self, text, offset=0, limit=SEARCH_PAGE_SIZE):
+        """
+        Returns the :class:`Message` objects that contain ``text``
+
+        Messages must contain every word of ``text``, the last one can be
+        the beginning of a word. The most relevant messages come first,
+        the newest first among equally relevant ones. Only the newest
+        :data:`SEARCH_CANDIDATES` matches are ranked.
+
+        :param offset: number of results to skip
+        :param limit: maximum number of results to return
+        :rtype: list
+        """
+        query = build_fts_query(text)
+        if query is None:
+            return []
+
+        c = self.conn.cursor()
+        if self.fts:
+            candidates = max(SEARCH_CANDIDATES, offset + limit)
+            c.execute("select m.*, t.*, f.* from "
+                      "(select docid, rank_sms(matchinfo(message_fts)) rank "
+                      "from message_fts where message_fts match ? "
+                      "order by docid desc limit ?) s "
+                      "inner join message m on m.id = s.docid "
+                      "inner join thread t on m.thread_id = t.id "
+                      "inner join folder f on t.folder_id = f.id "
+                      "order by s.rank desc, m.date desc limit ? offset ?",
+                      (query, candidates, limit, offset))
+        else:
+            sql = ("select m.*, t.*, f.* from message m "
+                   "inner join thread t on m.thread_id = t.id "
+                   "inner join folder f on t.folder_id = f.id where ")
+            words = text.split()
+            sql += " and ".join(["m.text like ? escape '\\'"] * len(words))
+            sql += " order by m.date desc limit ? offset ?"
+            args = ["%%%s%%" % escape_like(word) for word in words]
+            args += [limit, offset]
+            c.execute(sql, args)
+
+        return list(self._iter_messages(c))
+
+    def export_sms(self):
+        """
+        Streams all the :class:`Message` objects in the DB, oldest first
+
+        The messages are read in storage order, so the mailbox is never
+        sorted nor held in memory. Feeding them to :meth:`import_sms`
+        restores them.
+
+        :rtype: iter
+        """
+        c = self.conn.cursor()
+        c.execute("select m.*, t.*, f.* from message m "
+                  "inner join thread t on m.thread_id = t.id "
+                  "inner join folder f on t.folder_id = f.id "
+                  "order by m.id")
+        return self._iter_messages(c)
+
+    def import_sms(self, messages, folder=inbox_folder):
+        """
+        Adds ``messages`` to the DB in a single transaction
+
+        Every message is filed under the thread of its number in the
+        folder of its thread if it has one, or in ``folder`` otherwise.
+        The thread counters are updated once at the end instead of once
+        per message. Either all the messages are added or none is.
+
+        :param messages: iterable of :class:`Message`, it is consumed in
+            batches of :data:`IMPORT_BATCH_SIZE`
+        :return: the number of messages added
+        """
+        # (number, folder index) -> thread
+        threads = {}
+        # thread index -> [messages, read messages, last text]
+        counters = {}
+
+        def get_row(sms):
+            _folder = folder
+            if sms.thread is not None and sms.thread.folder is not None:
+                _folder = sms.thread.folder
+
+            key = (sms.number, _folder.index)
+            thread = threads.get(key)
+            if thread is None:
+                thread = self.get_thread_by_number(sms.number, _folder)
+                threads[key] = thread
+
+            counter = counters.setdefault(thread.index, [0, 0, None])
+            counter[0] += 1
+            counter[1] += message_read(sms.flags)
+            counter[2] = sms.text
+            return (None, sms.datetime, sms.number, sms.text, sms.flags,
+                    thread.index)
+
+        c = self.conn.cursor()
+        c.execute("begin immediate")
+        try:
+            # fki_update_thread_values would update a thread per message
+            c.execute("select sql from sqlite_master where type='trigger' "
+                      "and name='fki_update_thread_values'")
+            trigger = c.fetchone()[0]
+            c.execute("drop trigger fki_update_thread_values")
+
+            count = 0
+            batch = []
+            for sms in messages:
+                batch.append(get_row(sms))
+                if len(batch) == IMPORT_BATCH_SIZE:
+                    c.executemany("insert into message values "
+                                  "(?, ?, ?, ?, ?, ?)", batch)
+                    count += len(batch)
+                    batch = []
+
+            c.executemany("insert into message values (?, ?, ?, ?, ?, ?)",
+                          batch)
+            count += len(batch)
+
+            # what the trigger would have done
+            c.executemany("update thread set snippet=substr(?, 0, 100), "
+                          "message_count=message_count + ?, read=read + ?, "
+                          "date=strftime('%s', 'now') where id=?",
+                          [(text, added, read, index) for index,
+                              (added, read, text) in counters.iteritems()])
+            c.execute(trigger)
+            c.execute("commit")
+        except:
+            self.conn.rollback()
+            raise
+
+        return count
 
     def move_to_folder(self, src, dst):
         """
@@ -1052,27 +2038,20 @@ class SmsProvider(DBProvider):
         return sms
 
     def _move_sms_to_folder(self, sms, folder):
-        c = self.conn.cursor()
-        sql = "select id from thread where number like ? and folder_id=?"
-        c.execute(sql, ("%%%s%%" % sms.number, folder.index))
-        if c.rowcount == 1:
+        row = self._find_thread_by_number(sms.number, folder)
+        if row is not None:
             # there already exists a thread for that number in folder
-            thread = self._get_thread_by_id(c.fetchone()[0])
-            c.execute("update message set thread_id=? where id=?",
-                      (thread.index, sms.index))
-            sms.thread = thread
-            return sms
-        elif c.rowcount < 1:
+            thread = Thread.from_row(row, folder=folder)
+        else:
             # create thread for this number
             thread = self.add_thread(
                     Thread(sms.datetime, sms.number, folder=folder))
-            c.execute("update message set thread_id=? where id=?",
-                      (thread.index, sms.index))
-            sms.thread = thread
-            return sms
-        else:
-            msg = "Too many threads associated to number %s"
-            raise DBError(msg % sms.number)
+
+        c = self.conn.cursor()
+        c.execute("update message set thread_id=? where id=?",
+                  (thread.index, sms.index))
+        sms.thread = thread
+        return sms
 
     def _move_thread_to_folder(self, thread, folder):
         c = self.conn.cursor()
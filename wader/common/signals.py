@@ -40,3 +40,7 @@ SIG_SMS_COMP = 'Completed'
 SIG_SMS_DELV = 'Delivered'
 SIG_SMS_NOTIFY_ONLINE = 'SmsNotifyOnline'
 SIG_TIMEOUT = 'Timeout'
+
+# internal only, delivered through the device EventBus
+SIG_AT_CMD = 'ATCommandCompleted'
+SIG_CONN_PHASE = 'ConnectionPhase'
@@ -26,7 +26,7 @@ from dbus.service import Object, BusName, method, signal
 gloop = DBusGMainLoop(set_as_default=True)
 
 from twisted.application.service import Application, Service
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
 from twisted.plugin import IPlugin, getPlugins
 from twisted.python import log
 
@@ -39,7 +39,8 @@ from twisted.python.logfile import BaseLogFile, LogReader
 
 import wader.common.consts as consts
 from wader.common._dbus import DBusExporterHelper
-from wader.common.provider import NetworkProvider, nick_debug
+from wader.common.provider import (NetworkProvider, nick_debug,
+                                   rebuild_networks_db, get_network_trie)
 from wader.common.serialport import SerialPort
 
 DELAY = 10
@@ -193,6 +194,7 @@ class WaderService(Service):
         from wader.common.dialer import DialerManager
         self.ctrl = StartupController()
         self.dial = DialerManager(self.ctrl)
+        _load_network_trie()
 
     def get_clients(self):
         """
@@ -295,6 +297,23 @@ def setup_and_export_device(device):
     return device
 
 
+def _rebuild_networks_db():
+    log.msg("Rebuilding the networks DB in the background")
+    d = threads.deferToThread(rebuild_networks_db)
+    d.addCallback(lambda count: log.msg("Networks DB rebuilt, %d networks "
+                                        "updated" % count))
+    d.addCallback(lambda _: _load_network_trie())
+    d.addErrback(log.err, "Could not rebuild the networks DB")
+    return d
+
+
+def _load_network_trie():
+    # so the first operator name lookup does not wait for it
+    d = threads.deferToThread(get_network_trie)
+    d.addErrback(log.err, "Could not load the networks DB")
+    return d
+
+
 def create_skeleton_and_do_initial_setup():
     """I perform the operations needed for the initial user setup"""
     set_logger()
@@ -303,6 +322,8 @@ def create_skeleton_and_do_initial_setup():
         # old way to signal that the setup is complete
         os.unlink(OLDLOCK)
 
+    # whether the current DB can serve lookups while it is rebuilt
+    usable = False
     if os.path.exists(consts.NETWORKS_DB):
         # new way to signal that the setup is complete
         provider = NetworkProvider()
@@ -315,23 +336,23 @@ def create_skeleton_and_do_initial_setup():
             nick_debug("Networks DB was built from current sources")
             return
 
+        usable = provider.get_version() == provider.version
         provider.close()
         log.msg("Networks DB requires rebuild")
         nick_debug("startup.py - create_skeleton_and_do_initial_setup: Networks DB requires rebuild")
-        os.remove(consts.NETWORKS_DB)
 
     # regenerate plugin cache
     import wader.plugins
     list(getPlugins(IPlugin, package=wader.plugins))
 
-    # create new DB
-    provider = NetworkProvider()
+    if usable:
+        # the old DB serves the lookups until the new one is ready
+        reactor.callWhenRunning(_rebuild_networks_db)
+        return
+
+    # create new DB, there is nothing to serve the lookups meanwhile
     try:
-        nick_debug("startup.py - create_skeleton_and_do_initial_setup - create new DB and provider is the object:" +  repr(provider))
-        provider.populate_networks()
+        rebuild_networks_db()
         nick_debug("startup.py - create_skeleton_and_do_initial_setup - populate_networks complete.")
-
     except:
         log.err()
-    finally:
-        provider.close()
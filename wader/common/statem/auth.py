@@ -22,6 +22,7 @@ from twisted.internet import reactor, defer
 from twisted.python import log
 
 import wader.common.aterrors as E
+from wader.common.timeline import publish_phase
 from wader.contrib.modal import mode, Modal
 
 SIM_FAIL_DELAY = 15
@@ -135,6 +136,7 @@ class AuthStateMachine(Modal):
         :raise SimNotInserted: SIM not inserted
         :raise DeviceLockedError: Device is locked
         """
+        publish_phase(self.device, 'auth')
         self.do_next()
         return self.deferred
 
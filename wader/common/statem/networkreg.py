@@ -18,16 +18,16 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Network registration state machine"""
 
-import dbus
 from twisted.python import log
 from twisted.internet import defer, reactor
 
 #import wader.common.exceptions as ex
 import wader.common.aterrors as E
 from wader.common.signals import SIG_CREG
-from wader.common.consts import (WADER_SERVICE, STATUS_IDLE, STATUS_HOME,
-                                 STATUS_SEARCHING, STATUS_DENIED,
-                                 STATUS_UNKNOWN, STATUS_ROAMING)
+from wader.common.consts import (STATUS_IDLE, STATUS_HOME, STATUS_SEARCHING,
+                                 STATUS_DENIED, STATUS_UNKNOWN,
+                                 STATUS_ROAMING)
+from wader.common.timeline import publish_phase
 from wader.contrib.modal import mode, Modal
 
 REGISTER_TIMEOUT = 15
@@ -58,9 +58,8 @@ class NetworkRegistrationStateMachine(Modal):
         return "network_sm"
 
     def connect_to_signals(self):
-        bus = dbus.SystemBus()
-        device = bus.get_object(WADER_SERVICE, self.sconn.device.opath)
-        sm = device.connect_to_signal(SIG_CREG, self.on_netreg_cb)
+        events = self.sconn.device.events
+        sm = events.subscribe(SIG_CREG, self.on_netreg_cb)
         self.signal_matchs.append(sm)
 
     def clean_signals(self):
@@ -75,6 +74,7 @@ class NetworkRegistrationStateMachine(Modal):
         Returns a deferred that will be callbacked upon success and
         errbacked with a CMEError30 or a NetworkRegistrationError if fails
         """
+        publish_phase(self.sconn.device, 'netreg')
         self.do_next()
         return self.deferred
 
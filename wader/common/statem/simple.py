@@ -23,11 +23,17 @@ from twisted.python import log
 import wader.common.aterrors as E
 from wader.contrib.modal import mode, Modal
 from wader.common.consts import STATUS_HOME, STATUS_ROAMING
+from wader.common.signals import SIG_CREG
+from wader.common.timeline import publish_phase
 from wader.common.utils import convert_network_mode_to_allowed_mode
 
-# poll at 'n' second intervals for 'm' tries
+# registration is driven by +CREG notifications, in case they do
+# not arrive poll at 'n' second intervals for 'm' tries
 INTERVAL = 3
 TRIES = 30
+# max seconds to wait for the device to act upon an allowed mode
+# change before trusting its registration status again
+SWITCH_TIMEOUT = 5
 
 
 class SimpleStateMachine(Modal):
@@ -50,22 +56,133 @@ class SimpleStateMachine(Modal):
         self.settings = settings
 
         self.deferred = defer.Deferred()
+        # registration poll delayed call
+        self.call_id = None
+        # set while a registration status request is in flight
+        self.netreg_pending = False
+        # set after an allowed mode change until the device either sends
+        # a +CREG notification or SWITCH_TIMEOUT expires
+        self.switching_mode = False
+        self.switch_id = None
+        self.signal_matchs = []
+        # list of [name, start, end, skipped] lists, one per phase
+        self.phases = []
 
     def transition_to(self, state):
+        self.start_phase(state)
         self.transitionTo(state)
         self.do_next()
 
+    def start_phase(self, name):
+        """Records the beginning of phase ``name``"""
+        self.end_phase()
+        self.phases.append([name, reactor.seconds(), None, False])
+        publish_phase(self.device, name)
+
+    def end_phase(self):
+        if self.phases and self.phases[-1][2] is None:
+            self.phases[-1][2] = reactor.seconds()
+
+    def skip_phase(self):
+        """
+        Flags the current phase as skipped
+
+        The device was already configured as requested and nothing
+        had to be written to it
+        """
+        if self.phases:
+            self.phases[-1][3] = True
+
+    def get_phase_timings(self):
+        """
+        Returns the time spent in every phase
+
+        :return: list of (name, seconds, skipped) tuples
+        """
+        return [(name, (end if end is not None else reactor.seconds()) - start,
+                 skipped) for name, start, end, skipped in self.phases]
+
+    def log_phase_timings(self):
+        timings = []
+        for name, seconds, skipped in self.get_phase_timings():
+            timings.append("%s %.2fs%s" % (name, seconds,
+                                           " (skipped)" if skipped else ""))
+        log.msg("Simple SM: phase timings: %s" % ", ".join(timings))
+
+    def connect_to_signals(self):
+        sm = self.device.events.subscribe(SIG_CREG, self.on_creg_cb)
+        self.signal_matchs.append(sm)
+
+    def clean_signals(self):
+        while self.signal_matchs:
+            sm = self.signal_matchs.pop()
+            sm.remove()
+
+    def cancel_poll(self):
+        if self.call_id is not None and self.call_id.active():
+            self.call_id.cancel()
+        self.call_id = None
+
+    def start_switching_mode(self):
+        """
+        Flags that the allowed mode has just been changed
+
+        The device might still report its old registration for a while,
+        so it will not be trusted until it sends a +CREG notification or
+        ``SWITCH_TIMEOUT`` seconds elapse.
+        """
+        self.switching_mode = True
+        self.switch_id = reactor.callLater(SWITCH_TIMEOUT,
+                                           self.stop_switching_mode)
+
+    def stop_switching_mode(self):
+        if self.switch_id is not None and self.switch_id.active():
+            self.switch_id.cancel()
+        self.switch_id = None
+
+        if not self.switching_mode:
+            return
+
+        self.switching_mode = False
+        if self.mode == 'wait_for_registration':
+            # check right away rather than waiting for the next poll
+            self.cancel_poll()
+            self.do_next()
+
+    def on_creg_cb(self, status):
+        """Callback for +CREG notifications"""
+        # the device has acted upon the allowed mode change
+        self.switching_mode = False
+        self.stop_switching_mode()
+
+        if self.mode == 'wait_for_registration':
+            if status in [STATUS_HOME, STATUS_ROAMING]:
+                self.cancel_poll()
+                self.transition_to('connect')
+
+    def cleanup(self):
+        self.cancel_poll()
+        self.switching_mode = False
+        self.stop_switching_mode()
+        self.clean_signals()
+        self.end_phase()
+        self.log_phase_timings()
+
     def start_simple(self):
         """Starts the whole process"""
+        self.connect_to_signals()
+        self.start_phase(self.mode)
         self.do_next()
         return self.deferred
 
     def notify_success(self, ignored=True):
         """Notifies the caller that we have succeed"""
+        self.cleanup()
         self.deferred.callback(ignored)
 
     def notify_failure(self, failure):
         """Notifies the caller that we have failed"""
+        self.cleanup()
         self.deferred.errback(failure)
 
     class begin(mode):
@@ -125,12 +242,27 @@ class SimpleStateMachine(Modal):
             log.msg("Simple SM: register exited")
 
         def do_next(self):
-            if 'network_id' in self.settings:
-                netid = self.settings['network_id']
-                d = self.sconn.register_with_netid(netid)
-                d.addCallback(lambda _: self.transition_to('set_apn'))
-            else:
+            if 'network_id' not in self.settings:
                 self.transition_to('set_apn')
+                return
+
+            netid = self.settings['network_id']
+
+            def get_netreg_info_cb(info):
+                status, current_netid, _ = info
+                if status in [STATUS_HOME, STATUS_ROAMING] and \
+                        current_netid == netid:
+                    log.msg("Simple SM: register is current")
+                    self.skip_phase()
+                    return
+
+                return self.sconn.register_with_netid(netid)
+
+            d = self.sconn.get_netreg_info()
+            # if we cannot tell, register anyway
+            d.addErrback(lambda _: (None, None, None))
+            d.addCallback(get_netreg_info_cb)
+            d.addCallback(lambda _: self.transition_to('set_apn'))
 
     class set_apn(mode):
 
@@ -141,11 +273,25 @@ class SimpleStateMachine(Modal):
             log.msg("Simple SM: set_apn exited")
 
         def do_next(self):
-            if 'apn' in self.settings:
-                d = self.sconn.set_apn(self.settings['apn'])
-                d.addCallback(lambda _: self.transition_to('set_band'))
-            else:
+            if 'apn' not in self.settings:
                 self.transition_to('set_band')
+                return
+
+            apn = self.settings['apn']
+
+            def get_apns_cb(apns):
+                for index, _apn in apns:
+                    if _apn == apn:
+                        log.msg("Simple SM: set_apn is current")
+                        self.sconn.state_dict['conn_id'] = index
+                        self.skip_phase()
+                        return
+
+                return self.sconn.set_apn(apn)
+
+            d = self.sconn.get_apns()
+            d.addCallback(get_apns_cb)
+            d.addCallback(lambda _: self.transition_to('set_band'))
 
     class set_band(mode):
 
@@ -156,13 +302,25 @@ class SimpleStateMachine(Modal):
             log.msg("Simple SM: set_band exited")
 
         def do_next(self):
-            if 'band' in self.settings:
-                d = self.sconn.set_band(self.settings['band'])
-                d.addCallback(lambda _:
-                        reactor.callLater(1,
-                                       self.transition_to, 'set_allowed_mode'))
-            else:
+            if 'band' not in self.settings:
                 self.transition_to('set_allowed_mode')
+                return
+
+            band = self.settings['band']
+
+            def get_band_cb(current):
+                if current == band:
+                    log.msg("Simple SM: set_band is current")
+                    self.skip_phase()
+                    return
+
+                return self.sconn.set_band(band)
+
+            d = defer.maybeDeferred(self.sconn.get_band)
+            # not every device can tell its band, set it anyway
+            d.addErrback(lambda _: None)
+            d.addCallback(get_band_cb)
+            d.addCallback(lambda _: self.transition_to('set_allowed_mode'))
 
     class set_allowed_mode(mode):
 
@@ -179,15 +337,17 @@ class SimpleStateMachine(Modal):
 
                 if allowed == self.settings['allowed_mode']:
                     log.msg("Simple SM: set_allowed_mode is current")
+                    self.skip_phase()
                     self.transition_to('wait_for_registration')
                 else:
                     log.msg("Simple SM: set_allowed_mode change required")
                     d2 = self.sconn.set_allowed_mode(
                             self.settings['allowed_mode'])
-                    # We need to wait long enough for the device to start
-                    # switching and lose the current registration
-                    d2.addCallback(lambda _: reactor.callLater(5,
-                            self.transition_to, 'wait_for_registration'))
+                    # The device will take a while to start switching and
+                    # lose the current registration
+                    d2.addCallback(lambda _: self.start_switching_mode())
+                    d2.addCallback(lambda _:
+                            self.transition_to('wait_for_registration'))
 
             if 'allowed_mode' in self.settings:
                 d = self.sconn.get_network_mode()
@@ -204,17 +364,32 @@ class SimpleStateMachine(Modal):
             log.msg("Simple SM: wait_for_registration exited")
 
         def do_next(self):
+            if self.netreg_pending:
+                # the answer to the ongoing request will do
+                return
+
+            def clear_pending(result):
+                self.netreg_pending = False
+                return result
 
             def get_netreg_status_cb(info):
-                if info[1] in [STATUS_HOME, STATUS_ROAMING]:
+                if self.mode != 'wait_for_registration':
+                    # a +CREG notification got here first
+                    return
+
+                if info[1] in [STATUS_HOME, STATUS_ROAMING] and \
+                        not self.switching_mode:
                     self.transition_to('connect')
                 elif self.registration_tries <= 0:
                     self.notify_failure(E.NoNetwork("Not registered"))
                 else:
                     self.registration_tries -= 1
-                    reactor.callLater(INTERVAL, self.do_next)
+                    self.call_id = reactor.callLater(INTERVAL, self.do_next)
 
+            self.call_id = None
+            self.netreg_pending = True
             d = self.sconn.get_netreg_status()
+            d.addBoth(clear_pending)
             d.addCallback(get_netreg_status_cb)
 
     class connect(mode):
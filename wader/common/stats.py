@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Network interface statistics shared by all the active dialers"""
+
+from time import time
+
+# a snapshot younger than this is served to every requester
+MAX_AGE = 0.5
+# ifaces not requested for this long are not sampled anymore
+IFACE_TTL = 300
+# resolutions of the traffic series, in seconds, and the number of values
+# kept for each of them: 10 minutes, 1 day and 30 days
+SERIES = [(1, 600), (60, 1440), (3600, 720)]
+
+_collector = None
+
+
+class IfaceStatsCollector(object):
+    """
+    I sample the counters of every wader-managed iface in one pass
+
+    All the dialers ask me for their iface counters, the first request
+    after :data:`MAX_AGE` seconds triggers a new sample of every known
+    iface and the rest are served from it.
+    """
+
+    def __init__(self, osobj=None):
+        super(IfaceStatsCollector, self).__init__()
+        self._osobj = osobj
+        # dict with the sampled ifaces, key is the iface name and
+        # the value is the last time it was requested
+        self.ifaces = {}
+        # dict with the last sample, key is the iface name and the
+        # value is a (rx_bytes, tx_bytes) tuple
+        self.snapshot = {}
+        # time of the last sample
+        self.timestamp = 0
+
+    @property
+    def osobj(self):
+        if self._osobj is None:
+            from wader.common.oal import get_os_object
+            self._osobj = get_os_object()
+
+        return self._osobj
+
+    def sample(self, now=None):
+        """Samples the counters of all the known ifaces at once"""
+        if now is None:
+            now = time()
+
+        for iface, last in self.ifaces.items():
+            if now - last > IFACE_TTL:
+                del self.ifaces[iface]
+
+        self.snapshot = self.osobj.get_ifaces_stats(self.ifaces.keys())
+        self.timestamp = now
+        return self.snapshot
+
+    def get_iface_stats(self, iface):
+        """
+        Returns a (rx_bytes, tx_bytes) tuple for ``iface``
+
+        The time the counters were read at is available in
+        :attr:`timestamp`.
+        """
+        now = time()
+        known = iface in self.ifaces
+        self.ifaces[iface] = now
+
+        if not known or now - self.timestamp > MAX_AGE:
+            self.sample(now)
+
+        return self.snapshot.get(iface, (0, 0))
+
+    def remove_iface(self, iface):
+        """Stops sampling ``iface``"""
+        self.ifaces.pop(iface, None)
+        self.snapshot.pop(iface, None)
+
+
+def get_stats_collector():
+    """Returns the process-wide :class:`IfaceStatsCollector`"""
+    global _collector
+    if _collector is None:
+        _collector = IfaceStatsCollector()
+
+    return _collector
+
+
+class RingBuffer(object):
+    """I keep the last ``size`` items appended to me"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+        # index of the oldest item once full
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, item):
+        if len(self.items) < self.size:
+            self.items.append(item)
+        else:
+            self.items[self.pos] = item
+            self.pos = (self.pos + 1) % self.size
+
+    def get_items(self):
+        """Returns the items, oldest first"""
+        return self.items[self.pos:] + self.items[:self.pos]
+
+
+class TrafficSeries(object):
+    """
+    I keep the rx/tx rates of a connection at several resolutions
+
+    Rates are added at 1 second resolution and downsampled to every
+    resolution in :data:`SERIES` as each minute and hour completes, all of
+    them in fixed size :class:`RingBuffer` so the memory used is constant.
+    """
+
+    def __init__(self):
+        self.rings = {}
+        for resolution, size in SERIES:
+            self.rings[resolution] = RingBuffer(size)
+        # dict with the buckets being downsampled, key is the resolution
+        # and the value a [start, rx_sum, tx_sum, count] list
+        self.buckets = {}
+        self.last = None
+
+    def add(self, timestamp, rx_rate, tx_rate):
+        """
+        Adds the rates measured at ``timestamp``
+
+        The rates are the average since the previous call, so every second
+        elapsed since then gets them.
+        """
+        second = int(timestamp)
+        if self.last is None:
+            start = second
+        else:
+            # do not fill more than the seconds we can keep
+            start = max(self.last + 1, second - SERIES[0][1] + 1)
+
+        for sec in range(start, second + 1):
+            self._add(0, sec, rx_rate, tx_rate)
+
+        if second >= start:
+            self.last = second
+
+    def _add(self, index, timestamp, rx_rate, tx_rate):
+        resolution = SERIES[index][0]
+        if index == 0:
+            self.rings[resolution].append((timestamp, rx_rate, tx_rate))
+            if len(SERIES) > 1:
+                self._add(1, timestamp, rx_rate, tx_rate)
+            return
+
+        start = timestamp - timestamp % resolution
+        bucket = self.buckets.get(resolution)
+        if bucket is not None and bucket[0] != start:
+            # the bucket is complete
+            value = (bucket[0], bucket[1] // bucket[3], bucket[2] // bucket[3])
+            self.rings[resolution].append(value)
+            if index + 1 < len(SERIES):
+                self._add(index + 1, *value)
+            bucket = None
+
+        if bucket is None:
+            bucket = self.buckets[resolution] = [start, 0, 0, 0]
+
+        bucket[1] += rx_rate
+        bucket[2] += tx_rate
+        bucket[3] += 1
+
+    def get_rate(self, seconds):
+        """
+        Returns the mean (rx_rate, tx_rate) of the last ``seconds`` seconds
+        """
+        values = self.get_window(SERIES[0][0])[-seconds:]
+        if not values:
+            return 0, 0
+
+        return (sum([v[1] for v in values]) // len(values),
+                sum([v[2] for v in values]) // len(values))
+
+    def get_window(self, resolution, seconds=0):
+        """
+        Returns the rates at ``resolution`` of the last ``seconds`` seconds
+
+        Only complete minutes and hours are returned.
+
+        :param resolution: one of the resolutions of :data:`SERIES`
+        :param seconds: length of the window, 0 returns every value kept
+        :return: list of (timestamp, rx_rate, tx_rate) tuples, oldest first
+        """
+        if resolution not in self.rings:
+            raise ValueError("Unknown resolution %s" % resolution)
+
+        values = self.rings[resolution].get_items()
+        if seconds and self.last is not None:
+            since = self.last - seconds
+            values = [v for v in values if v[0] > since]
+
+        return values
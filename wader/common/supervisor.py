@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Automatic reconnection of dropped connections
+
+When a connection drops unexpectedly the :class:`ReconnectionSupervisor`
+tries to bring it back with an exponential backoff. After
+:data:`MAX_FAILURES` consecutive failed attempts the circuit breaker opens
+and only one attempt is made every :data:`BREAKER_TIMEOUT` seconds until
+one succeeds.
+"""
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+# seconds before the first attempt, the data port needs to be released
+BACKOFF_INITIAL = 3
+BACKOFF_FACTOR = 2
+BACKOFF_MAX = 300
+# consecutive failures that open the circuit breaker
+MAX_FAILURES = 5
+# seconds between attempts while the circuit breaker is open
+BREAKER_TIMEOUT = 900
+# number of reconnection times used to compute the mean
+MAX_SAMPLES = 50
+
+
+class SupervisedLink(object):
+    """I hold the reconnection state of a device"""
+
+    def __init__(self, device_opath, conf):
+        self.device_opath = device_opath
+        self.conf = conf
+        # consecutive failed attempts
+        self.failures = 0
+        # time the link went down at, None if it is up
+        self.down_since = None
+        self.call_id = None
+
+    def __repr__(self):
+        return '<SupervisedLink %s>' % self.device_opath
+
+    @property
+    def breaker_open(self):
+        return self.failures >= MAX_FAILURES
+
+    def get_delay(self):
+        """Returns the seconds to wait before the next attempt"""
+        if self.breaker_open:
+            return BREAKER_TIMEOUT
+
+        delay = BACKOFF_INITIAL * BACKOFF_FACTOR ** self.failures
+        return min(delay, BACKOFF_MAX)
+
+    def cancel(self):
+        if self.call_id is not None and self.call_id.active():
+            self.call_id.cancel()
+        self.call_id = None
+
+
+class ReconnectionSupervisor(object):
+    """
+    I reconnect dropped connections
+
+    :param reconnect: callable that accepts a device object path and a
+        `DialerConf` and returns a deferred that will be callbacked once
+        the connection is up again
+    """
+
+    def __init__(self, reconnect):
+        self.reconnect = reconnect
+        # dict with the supervised links, key is the device object path
+        self.links = {}
+        # dict with the last reconnection times, key is the device object
+        # path and the value a list of seconds
+        self.reconnect_times = {}
+        # dict with the number of reconnections, key is the device opath
+        self.reconnections = {}
+
+    def link_up(self, device_opath, conf):
+        """Starts supervising the connection of ``device_opath``"""
+        link = self.links.get(device_opath)
+        if link is None:
+            link = self.links[device_opath] = SupervisedLink(device_opath,
+                                                             conf)
+
+        if link.down_since is not None:
+            elapsed = reactor.seconds() - link.down_since
+            log.msg("Supervisor: %s reconnected in %.2fs" % (link, elapsed))
+            self.reconnections[device_opath] = \
+                    self.reconnections.get(device_opath, 0) + 1
+            times = self.reconnect_times.setdefault(device_opath, [])
+            times.append(elapsed)
+            del times[:-MAX_SAMPLES]
+
+        link.cancel()
+        link.conf = conf
+        link.failures = 0
+        link.down_since = None
+
+    def link_down(self, device_opath):
+        """Executed when the connection of ``device_opath`` drops"""
+        link = self.links.get(device_opath)
+        if link is None or link.down_since is not None:
+            return
+
+        log.msg("Supervisor: %s dropped" % link)
+        link.down_since = reactor.seconds()
+        self._schedule(link)
+
+    def cancel(self, device_opath):
+        """Stops supervising ``device_opath``, e.g. the user disconnected"""
+        link = self.links.pop(device_opath, None)
+        if link is not None:
+            link.cancel()
+
+    def _schedule(self, link):
+        delay = link.get_delay()
+        log.msg("Supervisor: reconnecting %s in %ds" % (link, delay))
+        link.call_id = reactor.callLater(delay, self._attempt, link)
+
+    def _attempt(self, link):
+        link.call_id = None
+
+        def attempt_cb(ignored):
+            if self.links.get(link.device_opath) is link:
+                self.link_up(link.device_opath, link.conf)
+
+        def attempt_eb(failure):
+            if self.links.get(link.device_opath) is not link:
+                # cancelled in the meantime
+                return
+
+            link.failures += 1
+            log.msg("Supervisor: attempt %d for %s failed: %s"
+                    % (link.failures, link, failure.getErrorMessage()))
+            if link.failures == MAX_FAILURES:
+                log.msg("Supervisor: circuit breaker open for %s" % link)
+
+            self._schedule(link)
+
+        d = defer.maybeDeferred(self.reconnect, link.device_opath, link.conf)
+        d.addCallbacks(attempt_cb, attempt_eb)
+        return d
+
+    def get_mean_time_to_reconnect(self, device_opath):
+        """Returns the mean seconds that took to reconnect ``device_opath``"""
+        times = self.reconnect_times.get(device_opath)
+        if not times:
+            return 0.0
+
+        return sum(times) / len(times)
+
+    def get_stats(self, device_opath):
+        """
+        Returns the reconnection statistics of ``device_opath``
+
+        :rtype: dict
+        """
+        link = self.links.get(device_opath)
+        return {
+            'reconnections': self.reconnections.get(device_opath, 0),
+            'mean_time_to_reconnect':
+                self.get_mean_time_to_reconnect(device_opath),
+            'failures': link.failures if link is not None else 0,
+            'circuit_open': link is not None and link.breaker_open,
+        }
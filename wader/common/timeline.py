@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+Connection attempt timelines
+
+Every connection attempt records when each of its phases started and
+how long every AT command sent meanwhile took. The phases and commands
+are published on the device :class:`~wader.common.events.EventBus` by
+the state machines, the dialers and the serial protocol, and collected
+by a :class:`ConnectionTimeline`. The last :data:`MAX_TIMELINES`
+timelines are kept on disk by a :class:`TimelineStore`.
+"""
+
+import os
+import pickle
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from wader.common.consts import TIMELINES_PATH
+from wader.common.signals import SIG_AT_CMD, SIG_CONN_PHASE
+
+# number of connection attempts kept
+MAX_TIMELINES = 20
+
+_store = None
+
+
+def publish_phase(device, name):
+    """Announces that ``device`` has entered connection phase ``name``"""
+    events = getattr(device, 'events', None)
+    if events is not None:
+        events.publish(SIG_CONN_PHASE, name, reactor.seconds())
+
+
+class ConnectionTimeline(object):
+    """I record the phases and AT commands of a connection attempt"""
+
+    def __init__(self, device, store=None):
+        self.device = device
+        self.store = store
+        self.start = reactor.seconds()
+        self.end = None
+        self.result = None
+        # list of (name, start) tuples
+        self.phases = []
+        # list of (name, sent, done, ok) tuples
+        self.commands = []
+        self.signal_matchs = []
+
+    def __repr__(self):
+        return '<ConnectionTimeline %s %s>' % (self.device.opath, self.start)
+
+    def start_recording(self):
+        """Starts collecting the events of ``self.device``"""
+        events = self.device.events
+        self.signal_matchs.append(events.subscribe(SIG_CONN_PHASE,
+                                                   self.on_phase_cb))
+        self.signal_matchs.append(events.subscribe(SIG_AT_CMD,
+                                                   self.on_at_cmd_cb))
+
+    def clean_signals(self):
+        while self.signal_matchs:
+            sm = self.signal_matchs.pop()
+            sm.remove()
+
+    def on_phase_cb(self, name, timestamp):
+        self.phases.append((name, timestamp))
+
+    def on_at_cmd_cb(self, name, sent, done, ok):
+        self.commands.append((name, sent, done, ok))
+
+    def finish(self, result):
+        """
+        Finishes the timeline with ``result``
+
+        The events published right before the attempt finished are still
+        to be delivered, so the timeline is closed and stored on the next
+        reactor iteration.
+
+        :param result: 'connected' or the reason of the failure
+        """
+        self.end = reactor.seconds()
+        self.result = result
+        reactor.callLater(0, self._finish)
+
+    def _finish(self):
+        self.clean_signals()
+        store = self.store if self.store is not None else get_timeline_store()
+        store.add(self)
+
+    def get_phases(self):
+        """
+        Returns the phases of this timeline
+
+        A phase ends when the next one starts, the last one ends with the
+        timeline itself.
+
+        :return: list of (name, start, end) tuples
+        """
+        end = self.end if self.end is not None else reactor.seconds()
+        ends = [start for _, start in self.phases[1:]] + [end]
+        return [(name, start, _end)
+                    for (name, start), _end in zip(self.phases, ends)]
+
+    def to_dict(self):
+        return {
+            'device': self.device.opath,
+            'start': self.start,
+            'end': self.end,
+            'result': self.result,
+            'phases': self.get_phases(),
+            'commands': self.commands[:],
+        }
+
+
+class TimelineStore(object):
+    """I keep the timelines of the last ``size`` connection attempts"""
+
+    def __init__(self, path=TIMELINES_PATH, size=MAX_TIMELINES):
+        self.path = path
+        self.size = size
+        self.timelines = self.load()
+
+    def load(self):
+        try:
+            fobj = open(self.path)
+        except IOError:
+            return []
+
+        try:
+            try:
+                timelines = pickle.load(fobj)
+            except Exception, e:
+                # unpickling garbage can raise almost anything
+                log.msg("Discarding connection timelines in %s: %r"
+                        % (self.path, e))
+                return []
+        finally:
+            fobj.close()
+
+        return timelines[-self.size:]
+
+    def save(self):
+        # write to a temp file first so a crash never leaves a truncated file
+        tmp_path = self.path + '.tmp'
+        try:
+            fobj = open(tmp_path, 'w')
+            pickle.dump(self.timelines, fobj, pickle.HIGHEST_PROTOCOL)
+            fobj.close()
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), e:
+            log.msg("Could not save connection timelines: %s" % e)
+
+    def add(self, timeline):
+        """Adds ``timeline`` and drops the oldest one if full"""
+        self.timelines.append(timeline.to_dict())
+        del self.timelines[:-self.size]
+        self.save()
+
+    def get_timelines(self, device_opath=None):
+        """
+        Returns the stored timelines, oldest first
+
+        :param device_opath: only return the timelines of this device
+        """
+        return [t for t in self.timelines
+                    if device_opath is None or t['device'] == device_opath]
+
+
+def get_timeline_store():
+    """Returns the process-wide :class:`TimelineStore`"""
+    global _store
+    if _store is None:
+        _store = TimelineStore()
+
+    return _store
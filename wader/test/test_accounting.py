@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.accounting module
+"""
+
+import sqlite3
+
+from twisted.trial import unittest
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock
+
+import wader.common.accounting as accounting
+from wader.common.accounting import (UsageAccountant, UsageSession,
+                                     CHECKPOINT_INTERVAL)
+from wader.common.provider import UsageProvider
+
+CONN = '/org/freedesktop/ModemManager/Connections/0'
+
+
+class TestUsageSession(unittest.TestCase):
+
+    def test_counters_since_start(self):
+        # the iface was already used by a previous session
+        session = UsageSession(CONN, True, 1000, 100)
+        session.update(1500, 150)
+        self.assertEqual((session.bytes_recv, session.bytes_sent), (500, 50))
+        self.assertTrue(session.dirty)
+
+    def test_counters_reset(self):
+        session = UsageSession(CONN, True, 1000, 100)
+        session.update(1500, 150)
+        # the iface was recreated
+        session.update(200, 20)
+        self.assertEqual((session.bytes_recv, session.bytes_sent), (700, 70))
+        session.update(300, 30)
+        self.assertEqual((session.bytes_recv, session.bytes_sent), (800, 80))
+
+
+class TestUsageAccountant(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(accounting, 'reactor', self.clock)
+        self.path = self.mktemp()
+        self.accountant = UsageAccountant(self.path)
+
+    def tearDown(self):
+        if self.accountant.loop is not None:
+            self.accountant.loop.stop()
+        return self.accountant.close()
+
+    def flush(self, accountant=None):
+        """Returns a Deferred that fires once the pending writes are done"""
+        accountant = accountant or self.accountant
+        # the reads run after the writes queued before them
+        return accountant.provider.read('get_total_usage')
+
+    def get_checkpoints(self):
+        provider = UsageProvider(self.path)
+        try:
+            c = provider.conn.cursor()
+            c.execute("select session, bytes_recv, bytes_sent "
+                      "from usage_checkpoint order by session")
+            return c.fetchall()
+        finally:
+            provider.close()
+
+    def test_updates_do_not_touch_the_db(self):
+        self.accountant.session_started(CONN, True)
+        self.accountant.update(CONN, 1000, 100)
+        self.assertEqual(self.accountant._provider, None)
+
+        self.clock.advance(CHECKPOINT_INTERVAL)
+        d = self.flush()
+        d.addCallback(lambda _: self.assertEqual(self.get_checkpoints(),
+                                                 [(CONN, 1000, 100)]))
+        return d
+
+    def test_checkpoint_batches_sessions(self):
+        calls = []
+        provider = self.accountant.provider
+        write = provider.write
+
+        def record(name, *args):
+            calls.append((name, args))
+            return write(name, *args)
+
+        self.patch(provider, 'write', record)
+
+        self.accountant.session_started(CONN, True)
+        self.accountant.session_started(CONN + '1', False)
+        self.accountant.update(CONN, 1000, 100)
+        self.accountant.update(CONN + '1', 2000, 200)
+        self.clock.advance(CHECKPOINT_INTERVAL)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0][0], 'checkpoint_usage')
+        self.assertEqual(len(calls[0][1][0]), 2)
+
+        def advance(_):
+            # nothing changed, nothing written
+            self.clock.advance(CHECKPOINT_INTERVAL)
+            self.assertEqual(len(calls), 1)
+
+        d = self.flush()
+        d.addCallback(advance)
+        return d
+
+    def test_failed_checkpoint_is_retried(self):
+        provider = self.accountant.provider
+        write = provider.write
+        self.patch(provider, 'write',
+                   lambda name, *args: fail(sqlite3.OperationalError()))
+
+        self.accountant.session_started(CONN, True)
+        self.accountant.update(CONN, 1000, 100)
+        self.clock.advance(CHECKPOINT_INTERVAL)
+        self.assertEqual(len(self.flushLoggedErrors(sqlite3.Error)), 1)
+        self.assertTrue(self.accountant.sessions[CONN].dirty)
+
+        self.patch(provider, 'write', write)
+        self.clock.advance(CHECKPOINT_INTERVAL)
+        d = self.flush()
+        d.addCallback(lambda _: self.assertEqual(self.get_checkpoints(),
+                                                 [(CONN, 1000, 100)]))
+        return d
+
+    def test_session_ended(self):
+        self.accountant.session_started(CONN, True)
+        self.accountant.update(CONN, 1000, 100)
+        self.clock.advance(CHECKPOINT_INTERVAL)
+        self.accountant.update(CONN, 3000, 300)
+
+        def check(item):
+            self.assertEqual((item.bytes_recv, item.bytes_sent),
+                             (3000, 300))
+            # merged into a single item
+            self.assertEqual(self.get_checkpoints(), [])
+            d = self.flush()
+            d.addCallback(self.assertEqual, [item])
+            return d
+
+        d = self.accountant.session_ended(CONN)
+        self.assertEqual(self.accountant.loop, None)
+        d.addCallback(check)
+        return d
+
+    def test_recover_after_crash(self):
+        self.accountant.session_started(CONN, True)
+        self.accountant.update(CONN, 1000, 100)
+        self.clock.advance(CHECKPOINT_INTERVAL)
+
+        def crash(_):
+            # this update is lost, it happened after the last checkpoint
+            self.accountant.update(CONN, 1500, 150)
+            self.accountant.loop.stop()
+            self.accountant.loop = None
+
+            accountant = UsageAccountant(self.path)
+            d = accountant.recover()
+            d.addCallback(self.assertEqual, 1)
+            d.addCallback(lambda _: self.flush(accountant))
+            d.addCallback(lambda items: self.assertEqual(
+                [(i.bytes_recv, i.bytes_sent) for i in items], [(1000, 100)]))
+            d.addCallback(lambda _: self.assertEqual(self.get_checkpoints(),
+                                                     []))
+            d.addBoth(lambda ret: accountant.close().addCallback(
+                lambda _: ret))
+            return d
+
+        d = self.flush()
+        d.addCallback(crash)
+        return d
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.asyncdb module
+"""
+
+import sqlite3
+import threading
+
+from twisted.trial import unittest
+from twisted.internet.defer import DeferredList
+
+from wader.common.asyncdb import AsyncProvider
+from wader.common.provider import (DBProvider, SmsProvider, Message,
+                                   inbox_folder)
+from wader.common.utils import get_tz_aware_now
+
+ITEM_SCHEMA = """
+create table item (
+    id integer primary key autoincrement,
+    value text not null);
+"""
+
+
+class ItemProvider(DBProvider):
+
+    exclusive_methods = ('replace_items',)
+
+    def __init__(self, path):
+        super(ItemProvider, self).__init__(path, ITEM_SCHEMA)
+
+    def add_item(self, value):
+        c = self.conn.cursor()
+        c.execute("insert into item values (null, ?)", (value,))
+        return c.lastrowid
+
+    def get_items(self):
+        c = self.conn.cursor()
+        c.execute("select value from item order by id")
+        return (row[0] for row in c)
+
+    def get_thread(self):
+        return threading.currentThread().getName()
+
+    def wait(self, started, event):
+        started.set()
+        event.wait()
+
+    def replace_items(self, values):
+        c = self.conn.cursor()
+        c.execute("begin immediate")
+        c.execute("delete from item")
+        c.executemany("insert into item values (null, ?)",
+                      [(value,) for value in values])
+        c.execute("commit")
+
+
+class RecordingProvider(ItemProvider):
+    """I record the thread that closes me"""
+
+    closed_by = None
+
+    def close(self):
+        self.closed_by = threading.currentThread().getName()
+        super(RecordingProvider, self).close()
+
+
+class TestAsyncProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.provider = AsyncProvider(lambda: ItemProvider(self.path))
+
+    def tearDown(self):
+        return self.provider.close()
+
+    def block_writer(self):
+        """Keeps the writer busy until the returned event is set"""
+        started, event = threading.Event(), threading.Event()
+        self.provider.write('wait', started, event)
+        started.wait()
+        return event
+
+    def record_groups(self):
+        groups = []
+        run_group = self.provider._run_group
+
+        def _run_group(provider, calls):
+            if calls:
+                groups.append([call.name for call in calls])
+            return run_group(provider, calls)
+
+        self.patch(self.provider, '_run_group', _run_group)
+        return groups
+
+    def test_write_and_read(self):
+        d = self.provider.write('add_item', 'one')
+        d.addCallback(lambda index: self.assertEqual(index, 1))
+        d.addCallback(lambda _: self.provider.read('get_items'))
+        # generators are consumed in the reader thread
+        d.addCallback(self.assertEqual, ['one'])
+        return d
+
+    def test_runs_off_the_reactor_thread(self):
+        current = threading.currentThread().getName()
+        d = DeferredList([self.provider.read('get_thread'),
+                          self.provider.write('get_thread')])
+
+        def check(results):
+            read, write = [result for success, result in results]
+            self.assertNotEqual(read, current)
+            self.assertEqual(write, 'AsyncProvider writer')
+
+        d.addCallback(check)
+        return d
+
+    def test_the_db_is_in_wal_mode(self):
+
+        def check(_):
+            conn = sqlite3.connect(self.path)
+            mode = conn.execute("pragma journal_mode").fetchone()[0]
+            conn.close()
+            self.assertEqual(mode, 'wal')
+
+        d = self.provider.write('add_item', 'one')
+        d.addCallback(check)
+        return d
+
+    def test_queued_writes_are_grouped(self):
+        groups = self.record_groups()
+        event = self.block_writer()
+        ds = [self.provider.write('add_item', str(i)) for i in range(10)]
+        event.set()
+
+        d = DeferredList(ds, fireOnOneErrback=True)
+        d.addCallback(lambda _: self.assertEqual(
+            groups, [['wait'], ['add_item'] * 10]))
+        return d
+
+    def test_a_failed_write_only_fails_itself(self):
+        event = self.block_writer()
+        ok1 = self.provider.write('add_item', 'one')
+        failed = self.provider.write('add_item', None)
+        ok2 = self.provider.write('add_item', 'two')
+        event.set()
+
+        failed = self.assertFailure(failed, sqlite3.IntegrityError)
+        d = DeferredList([ok1, failed, ok2], fireOnOneErrback=True)
+        d.addCallback(lambda _: self.provider.read('get_items'))
+        d.addCallback(self.assertEqual, ['one', 'two'])
+        return d
+
+    def test_exclusive_methods_run_alone(self):
+        groups = self.record_groups()
+        event = self.block_writer()
+        self.provider.write('add_item', 'one')
+        self.provider.write('replace_items', ['two', 'three'])
+        d = self.provider.write('add_item', 'four')
+        event.set()
+
+        d.addCallback(lambda _: self.provider.read('get_items'))
+        d.addCallback(self.assertEqual, ['two', 'three', 'four'])
+        d.addCallback(lambda _: self.assertEqual(
+            groups, [['wait'], ['add_item'], ['add_item']]))
+        return d
+
+    def test_close_runs_the_pending_writes(self):
+        path = self.mktemp()
+        provider = AsyncProvider(lambda: ItemProvider(path))
+        for i in range(5):
+            provider.write('add_item', str(i))
+
+        d = provider.close()
+        d.addCallback(lambda _: list(ItemProvider(path).get_items()))
+        d.addCallback(self.assertEqual, map(str, range(5)))
+        self.assertRaises(RuntimeError, provider.write, 'add_item', 'late')
+        return d
+
+    def test_close_closes_every_connection(self):
+        path = self.mktemp()
+        providers = []
+
+        def factory():
+            provider = RecordingProvider(path)
+            providers.append(provider)
+            return provider
+
+        provider = AsyncProvider(factory, readers=2)
+        # keep both readers busy so each opens its connection
+        started = [threading.Event(), threading.Event()]
+        event = threading.Event()
+        reads = [provider.read('wait', started[i], event) for i in range(2)]
+        for flag in started:
+            flag.wait()
+        event.set()
+
+        d = DeferredList(reads, fireOnOneErrback=True)
+        d.addCallback(lambda _: provider.close())
+
+        def check(_):
+            self.assertEqual(len(providers), 3)
+            # each one by the thread that owns it
+            self.assertEqual(sorted([p.closed_by for p in providers]),
+                             ['AsyncProvider reader 0',
+                              'AsyncProvider reader 1',
+                              'AsyncProvider writer'])
+
+        d.addCallback(check)
+        return d
+
+    def test_memory_db_without_readers(self):
+        provider = AsyncProvider(lambda: ItemProvider(':memory:'), readers=0)
+        d = provider.write('add_item', 'one')
+        d.addCallback(lambda _: provider.read('get_items'))
+        d.addCallback(self.assertEqual, ['one'])
+        d.addCallback(lambda _: provider.close())
+        return d
+
+
+class TestAsyncSmsProvider(unittest.TestCase):
+
+    def setUp(self):
+        path = self.mktemp()
+        self.provider = AsyncProvider(lambda: SmsProvider(path))
+
+    def tearDown(self):
+        return self.provider.close()
+
+    def test_add_and_list_sms(self):
+        d = self.provider.write('add_folder', inbox_folder)
+
+        def add_sms(_):
+            messages = [Message(number='+3443545333', text='sms %d' % i,
+                                _datetime=get_tz_aware_now())
+                        for i in range(3)]
+            return self.provider.write('import_sms', messages)
+
+        d.addCallback(add_sms)
+        d.addCallback(lambda _: self.provider.read('list_sms'))
+        d.addCallback(lambda messages: self.assertEqual(
+            sorted([sms.text for sms in messages]),
+            ['sms 0', 'sms 1', 'sms 2']))
+        return d
@@ -17,10 +17,16 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 """Unittests for the contact module"""
 
+import time
+
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.task import Clock
 
-from wader.common.contact import ContactStore
+import wader.common.contact as contact_module
+from wader.common.contact import (Contact, ContactIndex, ContactNotifier,
+                                  ContactStore)
 
 SKIP_TEST = False
 try:
@@ -73,64 +79,456 @@ class TestContactStore(unittest.TestCase):
 
     def test_add_contact(self):
         c = SQLContact("John", "+433333223", email="john@mail.net")
-        contact = self.store.add_contact(c)
-        # now check that the contact is present
-        contacts = self.store.list_contacts()
-        self.assertIn(contact, contacts)
-        # leave it as we found it
-        self.store.remove_contact(contact)
+
+        def check(contact):
+            # now check that the contact is present
+            d = self.store.list_contacts()
+            d.addCallback(lambda contacts: self.assertIn(contact, contacts))
+            # leave it as we found it
+            d.addCallback(lambda _: self.store.remove_contact(contact))
+            return d
+
+        d = self.store.add_contact(c)
+        d.addCallback(check)
+        return d
 
     def test_remove_contact(self):
         # add a contact and remove it
         c = SQLContact("John", "+433333223", email="john@mail.net")
-        contact = self.store.add_contact(c)
-        self.store.remove_contact(contact)
-        # now check that is not present anymore
-        contacts = list(self.store.list_contacts())
-        self.assertNotIn(contact, contacts)
+
+        def check(contact):
+            d = self.store.remove_contact(contact)
+            # now check that is not present anymore
+            d.addCallback(lambda _: self.store.list_contacts())
+            d.addCallback(lambda contacts:
+                          self.assertNotIn(contact, contacts))
+            return d
+
+        d = self.store.add_contact(c)
+        d.addCallback(check)
+        return d
 
     def test_list_contacts(self):
         # add a couple of contacts and check they are present
-        contact1 = self.store.add_contact(
-                SQLContact("Daniel", "+213333223", email="dan@mail.net"))
-        contact2 = self.store.add_contact(
-                SQLContact("Andy", "+113333223", email="andy@mail.net"))
+        d = DeferredList([
+            self.store.add_contact(
+                SQLContact("Daniel", "+213333223", email="dan@mail.net")),
+            self.store.add_contact(
+                SQLContact("Andy", "+113333223", email="andy@mail.net"))])
+
+        def check(results):
+            added = [contact for success, contact in results]
+            d = self.store.list_contacts()
 
-        contacts = self.store.list_contacts()
-        self.assertIn(contact1, contacts)
-        self.assertIn(contact2, contacts)
-        # leave it as we found it
-        self.store.remove_contact(contact1)
-        self.store.remove_contact(contact2)
+            def check_contacts(contacts):
+                for contact in added:
+                    self.assertIn(contact, contacts)
+
+            d.addCallback(check_contacts)
+            # leave it as we found it
+            d.addCallback(lambda _: DeferredList(
+                map(self.store.remove_contact, added)))
+            return d
+
+        d.addCallback(check)
+        return d
+
+    def assertFoundByNumber(self, contact, number):
+        """Adds ``contact`` and checks that ``number`` finds it"""
+
+        def check(contact):
+            d = self.store.find_contacts_by_number(number)
+            d.addCallback(lambda matches: self.assertIn(contact, matches))
+            # leave it as we found it
+            d.addCallback(lambda _: self.store.remove_contact(contact))
+            return d
+
+        d = self.store.add_contact(contact)
+        d.addCallback(check)
+        return d
 
     def test_find_contacts_by_name(self):
-        contact1 = self.store.add_contact(
+
+        def check(contact):
+            d = self.store.find_contacts_by_name("Daniel")
+            d.addCallback(lambda matches: self.assertIn(contact, matches))
+            # leave it as we found it
+            d.addCallback(lambda _: self.store.remove_contact(contact))
+            return d
+
+        d = self.store.add_contact(
                 SQLContact("Daniel", "+213333223", email="dan@mail.net"))
-        matches = self.store.find_contacts_by_name("Daniel")
-        self.assertIn(contact1, matches)
-        # leave it as we found it
-        self.store.remove_contact(contact1)
+        d.addCallback(check)
+        return d
 
     def test_find_contacts_by_number_full_match(self):
-        contact1 = self.store.add_contact(
-                SQLContact("Daniel", "+213333223", email="dan@mail.net"))
-        matches = self.store.find_contacts_by_number("+213333223")
-        self.assertIn(contact1, matches)
-        # leave it as we found it
-        self.store.remove_contact(contact1)
+        return self.assertFoundByNumber(
+            SQLContact("Daniel", "+213333223", email="dan@mail.net"),
+            "+213333223")
 
     def test_find_contacts_by_number_uk_match(self):
-        contact1 = self.store.add_contact(
-                SQLContact("Daniel", "073333223", email="dan@mail.net"))
-        matches = self.store.find_contacts_by_number("+4473333223")
-        self.assertIn(contact1, matches)
-        # leave it as we found it
-        self.store.remove_contact(contact1)
+        return self.assertFoundByNumber(
+            SQLContact("Daniel", "073333223", email="dan@mail.net"),
+            "+4473333223")
 
     def test_find_contacts_by_number_ie_match(self):
-        contact1 = self.store.add_contact(
-                SQLContact("Daniel", "081234567", email="dan@mail.net"))
-        matches = self.store.find_contacts_by_number("+35381234567")
-        self.assertIn(contact1, matches)
-        # leave it as we found it
-        self.store.remove_contact(contact1)
+        return self.assertFoundByNumber(
+            SQLContact("Daniel", "081234567", email="dan@mail.net"),
+            "+35381234567")
+
+
+class StandInProvider(object):
+    """
+    I am a contact provider that answers after ``delay`` seconds
+
+    :param contacts: the contacts I hold
+    :param clock: the clock used to delay the answers
+    """
+
+    def __init__(self, name, contacts, clock, delay=0):
+        self.name = name
+        self.contacts = contacts
+        self.clock = clock
+        self.delay = delay
+        # list with the names of the methods called
+        self.calls = []
+
+    def __repr__(self):
+        return '<StandInProvider %s>' % self.name
+
+    def _answer(self, name, result):
+        self.calls.append(name)
+        if not self.delay:
+            return result
+
+        d = defer.Deferred()
+        self.clock.callLater(self.delay, d.callback, result)
+        return d
+
+    def add_contact(self, contact):
+        if not contact.name.startswith(self.name):
+            return self._answer('add_contact', None)
+
+        self.contacts.append(contact)
+        return self._answer('add_contact', contact)
+
+    def find_contacts_by_number(self, number):
+        # generators are valid answers too
+        return self._answer('find_contacts_by_number',
+                            (c for c in self.contacts if number in c.number))
+
+    def list_contacts(self):
+        return self._answer('list_contacts', list(self.contacts))
+
+    def close(self):
+        pass
+
+
+class FailingProvider(StandInProvider):
+    """I am a contact provider that always fails"""
+
+    def _answer(self, name, result):
+        self.calls.append(name)
+        raise ValueError("%s is broken" % self.name)
+
+
+class LazilyFailingProvider(StandInProvider):
+    """I am a contact provider whose answers fail while consumed"""
+
+    def _answer(self, name, result):
+        self.calls.append(name)
+
+        def contacts():
+            yield Contact(self.name, '+34600000009')
+            raise ValueError("%s is broken" % self.name)
+
+        return contacts()
+
+
+class CopyingProvider(StandInProvider):
+    """I am a stand-in provider that keeps a copy of the added contacts"""
+
+    def add_contact(self, contact):
+        return super(CopyingProvider, self).add_contact(
+                Contact(contact.name, contact.number))
+
+
+class NotifyingProvider(ContactNotifier, StandInProvider):
+    """I am a stand-in provider that notifies its changes"""
+
+    def add_contact(self, contact):
+        ret = super(NotifyingProvider, self).add_contact(contact)
+        if ret is not None:
+            self.notify_changes(changed=[contact])
+        return ret
+
+    def remove_contact(self, contact):
+        self.contacts.remove(contact)
+        self.notify_changes(removed=[contact])
+
+
+class TestContactStoreFanOut(unittest.TestCase):
+    """Tests for the provider fan out of ContactStore"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(contact_module, 'reactor', self.clock)
+        self.store = ContactStore(timeout=5)
+        self.results = []
+
+    def add_provider(self, cls, name, delay, *contacts):
+        provider = cls(name, list(contacts), self.clock, delay)
+        self.store.add_provider(provider)
+        return provider
+
+    def collect(self, d):
+        d.addCallback(self.results.append)
+        return d
+
+    def test_every_provider_is_called_once(self):
+        fast = self.add_provider(StandInProvider, 'fast', 0,
+                                 Contact('fast', '+34600000001'))
+        slow = self.add_provider(StandInProvider, 'slow', 1,
+                                 Contact('slow', '+34600000002'))
+        self.collect(self.store.list_contacts())
+
+        self.clock.advance(1)
+        self.assertEqual(fast.calls, ['list_contacts'])
+        self.assertEqual(slow.calls, ['list_contacts'])
+        self.assertEqual(self.results, [[Contact('fast', '+34600000001'),
+                                         Contact('slow', '+34600000002')]])
+
+    def test_providers_are_queried_concurrently(self):
+        for i in range(3):
+            self.add_provider(StandInProvider, 'slow%d' % i, 3,
+                              Contact('slow%d' % i, '+3460000000%d' % i))
+
+        self.collect(self.store.list_contacts())
+        # queried one after another it would take 9 seconds
+        self.clock.advance(3)
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(len(self.results[0]), 3)
+
+    def test_results_follow_the_registration_order(self):
+        self.add_provider(StandInProvider, 'slower', 2,
+                          Contact('slower', '+34600000001'))
+        self.add_provider(StandInProvider, 'slow', 1,
+                          Contact('slow', '+34600000002'))
+        self.collect(self.store.list_contacts())
+
+        self.clock.advance(2)
+        self.assertEqual([c.name for c in self.results[0]],
+                         ['slower', 'slow'])
+
+    def test_slow_providers_are_skipped(self):
+        self.add_provider(StandInProvider, 'fast', 0,
+                          Contact('fast', '+34600000001'))
+        self.add_provider(StandInProvider, 'stuck', 60,
+                          Contact('stuck', '+34600000002'))
+        self.collect(self.store.list_contacts())
+
+        self.clock.advance(4)
+        self.assertEqual(self.results, [])
+        self.clock.advance(1)
+        self.assertEqual(self.results, [[Contact('fast', '+34600000001')]])
+        # the late answer is ignored
+        self.clock.advance(60)
+        self.assertEqual(len(self.results), 1)
+
+    def test_failing_providers_are_skipped(self):
+        self.add_provider(FailingProvider, 'broken', 0)
+        self.add_provider(StandInProvider, 'fast', 0,
+                          Contact('fast', '+34600000001'))
+        self.collect(self.store.list_contacts())
+
+        self.assertEqual(self.results, [[Contact('fast', '+34600000001')]])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_lazily_failing_providers_are_skipped(self):
+        self.add_provider(LazilyFailingProvider, 'broken', 0)
+        self.add_provider(StandInProvider, 'fast', 0,
+                          Contact('fast', '+34600000001'))
+        self.collect(self.store.find_contacts_by_number('+34600000001'))
+
+        self.assertEqual(self.results, [[Contact('fast', '+34600000001')]])
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        # the timeout was cancelled
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_add_contact_to_the_provider_that_takes_it(self):
+        self.add_provider(StandInProvider, 'mm', 1)
+        sqlite = self.add_provider(StandInProvider, 'sqlite', 2)
+        self.collect(self.store.add_contact(Contact('sqlite', '+346')))
+
+        self.clock.advance(2)
+        self.assertEqual(self.results, [Contact('sqlite', '+346')])
+        self.assertEqual(sqlite.contacts, [Contact('sqlite', '+346')])
+
+    def test_add_contact_to_the_first_registered_provider(self):
+        # both take it, the first one wins even if it answers last
+        first = self.add_provider(CopyingProvider, 'sqlite', 2)
+        self.add_provider(CopyingProvider, 'sq', 1)
+        self.collect(self.store.add_contact(Contact('sqlite', '+346')))
+
+        self.clock.advance(2)
+        self.assertIdentical(self.results[0], first.contacts[0])
+
+    def test_find_contacts_by_number_without_prefix(self):
+        provider = self.add_provider(StandInProvider, 'slow', 1,
+                                     Contact('slow', '073333223'))
+        self.collect(self.store.find_contacts_by_number('+4473333223'))
+
+        self.clock.advance(1)
+        self.assertEqual(self.results, [])
+        self.clock.advance(1)
+        self.assertEqual(self.results, [[Contact('slow', '073333223')]])
+        self.assertEqual(provider.calls, ['find_contacts_by_number'] * 2)
+
+    def test_numbers_are_looked_up_in_the_index(self):
+        indexed = self.add_provider(NotifyingProvider, 'indexed', 1,
+                                    Contact('Daniel', '073333223', index=1))
+        self.collect(self.store.find_contacts_by_number('+4473333223'))
+        self.clock.advance(1)
+        self.assertEqual(self.results, [[Contact('Daniel', '073333223')]])
+
+        # the index is filled once, the next lookups need no provider
+        self.collect(self.store.find_contacts_by_number('073333223'))
+        self.collect(self.store.find_contacts_by_number('+4470000000'))
+        self.assertEqual(self.results[1:], [[Contact('Daniel', '073333223')],
+                                            []])
+        self.assertEqual(indexed.calls, ['list_contacts'])
+
+    def test_the_index_follows_the_changes(self):
+        indexed = self.add_provider(NotifyingProvider, 'indexed', 0)
+        self.collect(self.store.find_contacts_by_number('+35381234567'))
+        self.assertEqual(self.results, [[]])
+
+        c = Contact('indexed', '081234567', index=1)
+        self.store.add_contact(c)
+        self.collect(self.store.find_contacts_by_number('+35381234567'))
+        self.assertEqual(self.results[1], [c])
+
+        self.store.remove_contact(c)
+        self.collect(self.store.find_contacts_by_number('+35381234567'))
+        self.assertEqual(self.results[2], [])
+        self.assertEqual(indexed.calls, ['list_contacts', 'add_contact'])
+
+    def test_removals_during_the_index_fill(self):
+        c = Contact('indexed', '+34600000001', index=1)
+        indexed = self.add_provider(NotifyingProvider, 'indexed', 1, c)
+        self.collect(self.store.find_contacts_by_number('+34600000001'))
+        # the listing being indexed still has it
+        indexed.remove_contact(c)
+        self.clock.advance(1)
+        self.assertEqual(self.results, [[]])
+
+        self.collect(self.store.find_contacts_by_number('+34600000001'))
+        self.assertEqual(self.results[1], [])
+        self.assertEqual(self.store._removed, {})
+
+    def test_unindexed_providers_are_still_asked(self):
+        self.add_provider(NotifyingProvider, 'indexed', 0,
+                          Contact('indexed', '+34600000001', index=1))
+        other = self.add_provider(StandInProvider, 'other', 0,
+                                  Contact('other', '+34600000001', index=1))
+        self.collect(self.store.find_contacts_by_number('+34600000001'))
+
+        self.assertEqual([c.name for c in self.results[0]],
+                         ['indexed', 'other'])
+        self.assertEqual(other.calls, ['find_contacts_by_number'])
+
+    def test_failed_index_fill_is_retried(self):
+        indexed = self.add_provider(NotifyingProvider, 'indexed', 60,
+                                    Contact('indexed', '+346000001', index=1))
+        self.collect(self.store.find_contacts_by_number('+346000001'))
+        self.clock.advance(5)
+        self.assertEqual(self.results, [[]])
+
+        indexed.delay = 0
+        self.collect(self.store.find_contacts_by_number('+346000001'))
+        self.assertEqual(len(self.results[1]), 1)
+        self.clock.advance(60)
+
+
+class SyncProvider(StandInProvider):
+    """I am a contact provider that blocks for ``delay`` seconds"""
+
+    def _answer(self, name, result):
+        self.calls.append(name)
+        time.sleep(self.delay)
+        return result
+
+
+class TestContactStoreSyncProviders(unittest.TestCase):
+    """Tests for the synchronous providers of ContactStore"""
+
+    def test_synchronous_providers_cannot_time_out(self):
+        store = ContactStore(timeout=0.05)
+        store.add_provider(SyncProvider('sync', [Contact('sync', '+346')],
+                                        reactor, 0.1))
+        store.add_provider(StandInProvider('async', [Contact('async', '+34')],
+                                           reactor, 0.01))
+        d = store.list_contacts()
+        # it blocked the reactor longer than the timeout, yet its answer
+        # made it as the timeout could not fire meanwhile
+        d.addCallback(lambda contacts: self.assertEqual(
+            [c.name for c in contacts], ['sync', 'async']))
+        return d
+
+
+class TestContactIndex(unittest.TestCase):
+    """Tests for wader.common.contact.ContactIndex"""
+
+    def setUp(self):
+        self.index = ContactIndex()
+        self.provider = object()
+
+    def test_lookup_ignores_the_international_prefix(self):
+        contacts = [Contact('uk', '073333223', index=1),
+                    Contact('ie', '081234567', index=2),
+                    Contact('es', '+34 600 123 456', index=3)]
+        self.index.add(self.provider, contacts)
+
+        self.assertEqual(self.index.lookup('+4473333223'), contacts[:1])
+        self.assertEqual(self.index.lookup('+35381234567'), contacts[1:2])
+        self.assertEqual(self.index.lookup('0034600123456'), contacts[2:])
+        self.assertEqual(self.index.lookup('600123456'), contacts[2:])
+
+    def test_numbers_of_different_countries_do_not_match(self):
+        self.index.add(self.provider, [Contact('es', '+34600123456', index=1)])
+        self.assertEqual(self.index.lookup('+44600123456'), [])
+
+    def test_numbers_sharing_only_the_key_do_not_match(self):
+        contacts = [Contact('national', '600123456', index=1),
+                    Contact('es', '+34700123456', index=2)]
+        self.index.add(self.provider, contacts)
+
+        self.assertEqual(self.index.lookup('500123456'), [])
+        self.assertEqual(self.index.lookup('+34500123456'), [])
+        self.assertEqual(self.index.lookup('+34600123456'), contacts[:1])
+
+    def test_changes(self):
+        contact = Contact('Daniel', '+34600123456', index=1)
+        self.index.changed(self.provider, [contact], [])
+        self.assertEqual(self.index.lookup('+34600123456'), [contact])
+
+        # the number of the contact changed
+        edited = Contact('Daniel', '+34600654321', index=1)
+        self.index.changed(self.provider, [edited], [])
+        self.assertEqual(self.index.lookup('+34600123456'), [])
+        self.assertEqual(self.index.lookup('+34600654321'), [edited])
+        self.assertEqual(len(self.index), 1)
+
+        self.index.changed(self.provider, [], [edited])
+        self.assertEqual(self.index.lookup('+34600654321'), [])
+        self.assertEqual(self.index.keys, {})
+
+    def test_same_index_in_two_providers(self):
+        other = object()
+        self.index.add(self.provider, [Contact('a', '+34600123456', index=1)])
+        self.index.add(other, [Contact('b', '+34600123456', index=1)])
+        self.assertEqual(len(self.index.lookup('+34600123456')), 2)
+
+        self.index.remove_provider(other)
+        self.assertEqual([c.name for c in self.index.lookup('+34600123456')],
+                         ['a'])
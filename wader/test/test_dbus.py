@@ -930,6 +930,37 @@ class DBusTestCase(unittest.TestCase):
         for index in indexes:
             self.device.Delete(index, dbus_interface=SMS_INTFACE)
 
+    def test_SmsListPage(self):
+        """Test for Sms.ListPage"""
+        messages = [
+            {'number': '+324342322', 'text': 'page one'},
+            {'number': '+334223312', 'text': 'page two'},
+            {'number': '+324323232', 'text': 'page three'}]
+
+        indexes = []
+        for sms in messages:
+            indexes.extend(self.device.Save(sms, dbus_interface=SMS_INTFACE))
+
+        listed = []
+        cursor = ''
+        while True:
+            page, cursor = self.device.ListPage(cursor, 2,
+                                                dbus_interface=SMS_INTFACE)
+            self.failUnless(len(page) <= 2)
+            listed.extend([msg['index'] for msg in page])
+            if not cursor:
+                break
+
+        all_indexes = [msg['index'] for msg in
+                       self.device.List(dbus_interface=SMS_INTFACE)]
+        self.assertEqual(sorted(listed), sorted(all_indexes))
+        for index in indexes:
+            self.failUnless(index in listed)
+
+        # leave everything as found
+        for index in indexes:
+            self.device.Delete(index, dbus_interface=SMS_INTFACE)
+
     def test_SmsListMultiparted(self):
         """Test for Sms.List"""
         sms = {'number': '+34622754135',
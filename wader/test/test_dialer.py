@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the DialerManager of the wader.common.dialer module
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+import wader.common.dialer as dialer_module
+import wader.common.events as events_module
+import wader.common.supervisor as supervisor_module
+from wader.common.dialer import (Dialer, DialerManager,
+                                 STATS_BASE_INTERVAL)
+from wader.common.events import EventBus
+from wader.common.signals import SIG_DIAL_STATS, SIG_DISCONNECTED
+from wader.common.supervisor import BACKOFF_INITIAL
+
+DEVICE = '/org/freedesktop/ModemManager/Devices/0'
+OTHER_DEVICE = '/org/freedesktop/ModemManager/Devices/1'
+
+
+class FakeWatch(object):
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeBus(object):
+    """I record the name owner watches"""
+
+    def __init__(self):
+        self.watches = {}
+
+    def add_signal_receiver(self, *args, **kw):
+        pass
+
+    def watch_name_owner(self, name, callback):
+        watch = FakeWatch()
+        self.watches[name] = (watch, callback)
+        return watch
+
+
+class FakeAccountant(object):
+
+    def recover(self):
+        return defer.succeed(None)
+
+
+class FakeExporter(object):
+
+    def __init__(self):
+        self.stats = []
+
+    def DialStats(self, stats):
+        self.stats.append(stats)
+
+
+class FakeDevice(object):
+
+    def __init__(self, opath):
+        self.opath = opath
+        self.events = EventBus()
+        self.exporter = FakeExporter()
+
+
+class FakeDialer(object):
+    """I record the DialStats intervals and the calls I am given"""
+
+    def __init__(self, device_opath, opath='/dialer/0'):
+        self.device = FakeDevice(device_opath)
+        self.opath = opath
+        self.intervals = []
+        self.calls = []
+
+    def set_stats_interval(self, interval):
+        self.intervals.append(interval)
+
+    def disconnect(self):
+        self.calls.append('disconnect')
+        return defer.succeed(self.opath)
+
+    def stop(self):
+        self.calls.append('stop')
+        return defer.succeed(self.opath)
+
+    def close(self, ignored=None):
+        self.calls.append('close')
+        return self.opath
+
+
+class DialerManagerTestCase(unittest.TestCase):
+    """Builds a DialerManager that is not exported on the system bus"""
+
+    def setUp(self):
+        self.bus = FakeBus()
+        self.patch(dialer_module.dbus, 'SystemBus', lambda: self.bus)
+        self.patch(dialer_module, 'BusName', lambda *args, **kw: None)
+        self.patch(dialer_module.Object, '__init__', lambda self, **kw: None)
+        self.patch(dialer_module, 'UsageAccountant', FakeAccountant)
+        self.manager = DialerManager(None)
+
+
+class TestDialerSampling(DialerManagerTestCase):
+
+    def setUp(self):
+        super(TestDialerSampling, self).setUp()
+        # key is the timeout id and value its (period, callback) tuple
+        self.timeouts = {}
+        self.patch(dialer_module, 'timeout_add_seconds', self.add_timeout)
+        self.patch(dialer_module, 'source_remove', self.timeouts.pop)
+        self.dialer = Dialer(FakeDevice(DEVICE), '/conn/0')
+        self.stats = (1000, 500, 100, 50)
+        self.patch(self.dialer, 'get_stats', lambda: self.stats)
+        self.clock = Clock()
+        self.patch(events_module, 'reactor', self.clock)
+        self.published = []
+        self.dialer.device.events.subscribe(SIG_DIAL_STATS,
+                                            self.published.append)
+
+    def add_timeout(self, period, callback):
+        timeout_id = len(self.timeouts) + 1
+        self.timeouts[timeout_id] = (period, callback)
+        return timeout_id
+
+    def test_idle_connections_are_sampled_slowly(self):
+        self.dialer.set_stats_interval(0)
+        self.assertEqual(self.timeouts.values(),
+                         [(STATS_BASE_INTERVAL, self.dialer._emit_dial_stats)])
+
+        self.dialer._emit_dial_stats()
+        self.clock.advance(0)
+        # sampled for the internal consumers, nothing on DBus
+        self.assertEqual(self.published, [self.stats])
+        self.assertEqual(self.dialer.device.exporter.stats, [])
+        self.assertEqual(self.dialer.series.get_rate(1), (100, 50))
+
+    def test_subscribed_connections_are_sampled_at_their_interval(self):
+        self.dialer.set_stats_interval(0)
+        self.dialer.set_stats_interval(2)
+        self.assertEqual([period for period, _ in self.timeouts.values()],
+                         [2])
+
+        self.dialer._emit_dial_stats()
+        self.assertEqual(self.dialer.device.exporter.stats, [self.stats])
+
+        # the same period keeps the timeout
+        timeouts = self.timeouts.copy()
+        self.dialer.set_stats_interval(2)
+        self.assertEqual(self.timeouts, timeouts)
+
+        self.dialer.set_stats_interval(0)
+        self.assertEqual([period for period, _ in self.timeouts.values()],
+                         [STATS_BASE_INTERVAL])
+
+
+class TestDialStatsSubscriptions(DialerManagerTestCase):
+
+    def setUp(self):
+        super(TestDialStatsSubscriptions, self).setUp()
+        self.dialer = FakeDialer(DEVICE)
+        self.other = FakeDialer(OTHER_DEVICE)
+        self.manager.connections = {'/conn/0': (self.dialer, None),
+                                    '/conn/1': (self.other, None)}
+
+    def test_no_subscribers(self):
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 0)
+
+    def test_every_subscriber_has_its_interval(self):
+        self.manager.subscribe_dial_stats(DEVICE, 5, ':1.1')
+        self.manager.subscribe_dial_stats(OTHER_DEVICE, 10, ':1.1')
+
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 5)
+        self.assertEqual(self.manager.get_stats_interval(OTHER_DEVICE), 10)
+        self.assertEqual(self.dialer.intervals, [5])
+        self.assertEqual(self.other.intervals, [10])
+
+    def test_the_smallest_interval_wins(self):
+        self.manager.subscribe_dial_stats(DEVICE, 5, ':1.1')
+        self.manager.subscribe_dial_stats(DEVICE, 2, ':1.2')
+        self.manager.subscribe_dial_stats(DEVICE, 8, ':1.3')
+
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 2)
+        self.assertEqual(self.dialer.intervals, [5, 2, 2])
+        # a new interval replaces the previous one of the subscriber
+        self.manager.subscribe_dial_stats(DEVICE, 9, ':1.2')
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 5)
+
+    def test_invalid_interval(self):
+        self.assertRaises(ValueError, self.manager.subscribe_dial_stats,
+                          DEVICE, 0, ':1.1')
+        self.assertEqual(self.manager.stats_subscriptions, {})
+
+    def test_unsubscribe(self):
+        self.manager.subscribe_dial_stats(DEVICE, 5, ':1.1')
+        self.manager.subscribe_dial_stats(DEVICE, 2, ':1.2')
+        self.manager.subscribe_dial_stats(OTHER_DEVICE, 2, ':1.2')
+
+        self.manager.unsubscribe_dial_stats(DEVICE, ':1.2')
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 5)
+        # still subscribed to the other device
+        self.assertFalse(self.bus.watches[':1.2'][0].cancelled)
+
+        self.manager.unsubscribe_dial_stats(OTHER_DEVICE, ':1.2')
+        self.assertTrue(self.bus.watches[':1.2'][0].cancelled)
+        self.assertNotIn(':1.2', self.manager.stats_watches)
+
+        self.manager.unsubscribe_dial_stats(DEVICE, ':1.1')
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 0)
+        self.assertEqual(self.dialer.intervals[-1], 0)
+        self.assertEqual(self.manager.stats_subscriptions, {})
+        # unsubscribing twice is harmless
+        self.manager.unsubscribe_dial_stats(DEVICE, ':1.1')
+
+    def test_subscriber_leaves_the_bus(self):
+        self.manager.subscribe_dial_stats(DEVICE, 5, ':1.1')
+        self.manager.subscribe_dial_stats(OTHER_DEVICE, 3, ':1.1')
+        self.manager.subscribe_dial_stats(DEVICE, 7, ':1.2')
+        watch, callback = self.bus.watches[':1.1']
+
+        # a new owner is not a departure
+        callback(':1.1')
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 5)
+
+        callback('')
+        self.assertTrue(watch.cancelled)
+        self.assertEqual(self.manager.get_stats_interval(DEVICE), 7)
+        self.assertEqual(self.manager.get_stats_interval(OTHER_DEVICE), 0)
+        self.assertEqual(self.other.intervals[-1], 0)
+        self.assertFalse(self.bus.watches[':1.2'][0].cancelled)
+
+
+class TestSupervisedConnections(DialerManagerTestCase):
+
+    def setUp(self):
+        super(TestSupervisedConnections, self).setUp()
+        self.clock = Clock()
+        self.patch(supervisor_module, 'reactor', self.clock)
+        self.attempts = []
+        self.patch(self.manager.supervisor, 'reconnect', self.reconnect)
+        self.changes = []
+        self.patch(self.manager, 'ConnectionChanged',
+                   lambda *args: self.changes.append(args))
+
+        self.conf = object()
+        self.dialer = FakeDialer(DEVICE)
+        self.manager.connections['/conn/0'] = self.dialer, self.conf
+        self.manager.link_matchs['/conn/0'] = \
+            self.dialer.device.events.subscribe(SIG_DISCONNECTED, lambda: None)
+        self.manager.supervisor.link_up(DEVICE, self.conf)
+        # the link drops
+        self.manager._link_lost_cb('/conn/0', self.dialer.opath)
+
+    def reconnect(self, device_opath, conf):
+        self.attempts.append((device_opath, conf))
+        # never finishes on its own
+        return defer.Deferred()
+
+    def assertNotSupervised(self):
+        self.assertEqual(self.manager.supervisor.links, {})
+        self.assertEqual(self.manager.lost_connections, {})
+        self.clock.advance(BACKOFF_INITIAL * 10)
+        self.assertEqual(self.attempts, [])
+
+    def test_link_lost(self):
+        self.assertEqual(self.changes, [('/conn/0', False)])
+        self.assertEqual(self.dialer.calls, ['disconnect', 'close'])
+        self.assertEqual(self.manager.lost_connections, {'/conn/0': DEVICE})
+        self.clock.advance(BACKOFF_INITIAL)
+        self.assertEqual(self.attempts, [(DEVICE, self.conf)])
+
+    def test_deactivate_dropped_connection(self):
+        d = self.manager.deactivate_connection('/conn/0')
+        d.addCallback(lambda _: self.assertNotSupervised())
+        return d
+
+    def test_deactivate_dropped_connection_while_reconnecting(self):
+        self.clock.advance(BACKOFF_INITIAL)
+        attempt = FakeDialer(DEVICE, '/dialer/1')
+        self.manager.connection_attempts[DEVICE] = attempt, self.conf
+        self.attempts = []
+
+        d = self.manager.deactivate_connection('/conn/0')
+
+        def deactivate_cb(ignored):
+            self.assertEqual(attempt.calls, ['stop', 'close'])
+            self.assertEqual(self.manager.connection_attempts, {})
+            self.assertNotSupervised()
+            # the old opath is gone for good
+            self.assertRaises(KeyError, self.manager.deactivate_connection,
+                              '/conn/0')
+
+        d.addCallback(deactivate_cb)
+        return d
+
+    def test_stop_dropped_connection(self):
+        d = self.manager.stop_connection(DEVICE)
+        d.addCallback(lambda _: self.assertNotSupervised())
+        return d
+
+    def test_stop_without_attempt(self):
+        self.assertRaises(KeyError, self.manager.stop_connection,
+                          OTHER_DEVICE)
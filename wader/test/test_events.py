@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.events module
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from wader.common.events import EventBus
+
+
+def spin():
+    """Returns a deferred that fires after pending deliveries"""
+    return deferLater(reactor, 0.01, lambda: None)
+
+
+class TestEventBus(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = EventBus()
+
+    def test_publish_delivers_to_subscribers(self):
+        received = []
+        self.bus.subscribe('CregReceived', received.append)
+        self.bus.subscribe('CregReceived', lambda s: received.append(s * 10))
+        self.bus.publish('CregReceived', 1)
+        # delivery is asynchronous
+        self.assertEqual(received, [])
+
+        d = spin()
+        d.addCallback(lambda _: self.assertEqual(received, [1, 10]))
+        return d
+
+    def test_publish_only_to_matching_signal(self):
+        received = []
+        self.bus.subscribe('SignalQuality', received.append)
+        self.bus.publish('CregReceived', 1)
+
+        d = spin()
+        d.addCallback(lambda _: self.assertEqual(received, []))
+        return d
+
+    def test_remove_subscription(self):
+        received = []
+        sub = self.bus.subscribe('CregReceived', received.append)
+        self.assertTrue(self.bus.has_subscribers('CregReceived'))
+        sub.remove()
+        # removing twice is harmless
+        sub.remove()
+        self.assertFalse(self.bus.has_subscribers('CregReceived'))
+        self.bus.publish('CregReceived', 1)
+
+        d = spin()
+        d.addCallback(lambda _: self.assertEqual(received, []))
+        return d
+
+    def test_remove_before_delivery(self):
+        received = []
+        sub = self.bus.subscribe('CregReceived', received.append)
+        self.bus.publish('CregReceived', 1)
+        sub.remove()
+
+        d = spin()
+        d.addCallback(lambda _: self.assertEqual(received, []))
+        return d
+
+    def test_failing_subscriber_does_not_affect_others(self):
+        received = []
+
+        def broken(status):
+            raise ValueError(status)
+
+        self.bus.subscribe('CregReceived', broken)
+        self.bus.subscribe('CregReceived', received.append)
+        self.bus.publish('CregReceived', 5)
+
+        def check(_):
+            self.assertEqual(received, [5])
+            self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+        d = spin()
+        d.addCallback(check)
+        return d
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.mal module
+"""
+
+from datetime import datetime, timedelta
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from wader.common.aterrors import InputValueError
+from wader.common.mal import MessageAssemblyLayer
+from wader.common.sms import Message
+
+
+class FakeWrappee(object):
+    """I hold the sms of a SIM"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.state_dict = {}
+        self.deleted = []
+
+    def do_list_sms(self):
+        return defer.succeed(self.messages)
+
+    def do_delete_sms(self, index):
+        self.deleted.append(index)
+        return defer.succeed(None)
+
+
+class TestSmsPages(unittest.TestCase):
+
+    def setUp(self):
+        start = datetime(2011, 3, 1, 10, 0)
+        # two of them were received in the same second
+        dates = [start, start + timedelta(minutes=1),
+                 start + timedelta(minutes=1), start + timedelta(hours=1),
+                 start - timedelta(days=1)]
+        messages = [Message('+34600000000', 'sms %d' % i, index=i + 1,
+                            _datetime=sms_date)
+                    for i, sms_date in enumerate(dates)]
+        self.mal = MessageAssemblyLayer(FakeWrappee(messages))
+
+    def list_all(self, limit):
+        """Returns the logical indexes of every page of ``limit`` sms"""
+        pages = []
+
+        def page_cb((messages, cursor)):
+            pages.append([sms['index'] for sms in messages])
+            if cursor:
+                return get_page(cursor)
+            return pages
+
+        def get_page(cursor):
+            d = self.mal.list_sms_page(cursor, limit)
+            d.addCallback(page_cb)
+            return d
+
+        return get_page('')
+
+    def test_pages_newest_first(self):
+        d = self.list_all(2)
+        d.addCallback(self.assertEqual, [[4, 3], [2, 1], [5]])
+        return d
+
+    def test_single_page(self):
+        d = self.list_all(0)
+        d.addCallback(self.assertEqual, [[4, 3, 2, 1, 5]])
+        return d
+
+    def test_deleted_sms_leave_the_pages(self):
+        d = self.mal.list_sms_page('', 1)
+
+        def page_cb((messages, cursor)):
+            self.mal.delete_sms(3)
+            return self.mal.list_sms_page(cursor, 2)
+
+        d.addCallback(page_cb)
+        d.addCallback(lambda (messages, cursor): self.assertEqual(
+            ([sms['index'] for sms in messages], bool(cursor)),
+            ([2, 1], True)))
+        return d
+
+    def test_invalid_cursor(self):
+        d = self.mal.list_sms_page('', 1)
+
+        def page_cb(ignored):
+            for cursor in ['garbage', '12', '1:2:3', 'a:1']:
+                self.assertRaises(InputValueError, self.mal._list_sms_page,
+                                  cursor, 1)
+
+        d.addCallback(page_cb)
+        return d
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.operators module
+"""
+
+import os
+
+from twisted.internet.defer import DeferredList
+from twisted.trial import unittest
+
+from wader.common.operators import OperatorNames
+from wader.common.provider import (NetworkProvider, NetworkOperator,
+                                   TYPE_CONTRACT, rebuild_networks_db)
+
+
+class TestOperatorNames(unittest.TestCase):
+
+    def setUp(self):
+        self.networks_db = self.mktemp()
+        source = NetworkProvider(':memory:')
+        source.populate_networks_from_objs([
+            NetworkOperator(["21401"], "airtelnet.es", type=TYPE_CONTRACT,
+                            country="Spain", name="Vodafone"),
+            NetworkOperator(["2140161"], "internet.es", type=TYPE_CONTRACT,
+                            country="Spain", name="Yoigo")])
+        rebuild_networks_db(self.networks_db, source)
+
+        self.path = self.mktemp()
+        self.names = OperatorNames(self.path, self.networks_db)
+
+    def test_name_from_networks_db(self):
+        # only the names reported by the modems are used right away
+        self.assertEqual(self.names.get_name('21401'), None)
+
+        d = DeferredList([self.names.get_db_name(netid) for netid in
+                          ['21401', '2140161', '214015', '23415']])
+        # a prefix match is not enough
+        d.addCallback(lambda results: self.assertEqual(
+            [name for _, name in results],
+            ['Vodafone', 'Yoigo', None, None]))
+        return d
+
+    def test_missing_networks_db(self):
+        names = OperatorNames(self.path, os.path.join(self.mktemp(), 'x.db'))
+        d = names.get_db_name('21401')
+        d.addCallback(self.assertEqual, None)
+        return d
+
+    def test_reported_names_are_persisted(self):
+        self.names.add('23415', 'vodafone UK')
+        self.assertEqual(self.names.get_name('23415'), 'vodafone UK')
+
+        names = OperatorNames(self.path, self.networks_db)
+        self.assertEqual(names.get_name('23415'), 'vodafone UK')
+
+    def test_reported_names_win(self):
+        self.names.add('21401', 'vodafone ES')
+        self.assertEqual(self.names.get_name('21401'), 'vodafone ES')
+
+    def test_useless_names_are_not_remembered(self):
+        self.names.add('23415', '')
+        self.names.add('23415', '23415')
+        self.names.add('23415', '234015')
+        self.assertEqual(self.names.get_name('23415'), None)
+        self.assertEqual(OperatorNames(self.path).names, {})
+
+    def test_garbage_file(self):
+        fobj = open(self.path, 'w')
+        fobj.write('garbage')
+        fobj.close()
+        self.assertEqual(OperatorNames(self.path).names, {})
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.phonenumber module
+"""
+
+from twisted.trial import unittest
+
+from wader.common.phonenumber import (normalize_number, get_number_key,
+                                      numbers_match)
+
+
+class TestNormalizeNumber(unittest.TestCase):
+
+    def test_international(self):
+        for number in ['+34600123456', '+34 600 12 34 56', '0034600123456',
+                       '+34-600-123-456']:
+            self.assertEqual(normalize_number(number, '214'), '+34600123456')
+
+    def test_national_without_trunk_prefix(self):
+        self.assertEqual(normalize_number('600123456', '214'),
+                         '+34600123456')
+        self.assertEqual(normalize_number('06 1234 5678', '222'),
+                         '+390612345678')
+
+    def test_national_with_trunk_prefix(self):
+        self.assertEqual(normalize_number('07700 900123', '234'),
+                         '+447700900123')
+        self.assertEqual(normalize_number('8 916 123-45-67', '250'),
+                         '+79161234567')
+        self.assertEqual(normalize_number('011 34 600123456', '310'),
+                         '+34600123456')
+
+    def test_unknown_country(self):
+        self.assertEqual(normalize_number('600 123 456'), '600123456')
+        self.assertEqual(normalize_number('00 34 600 123 456'),
+                         '+34600123456')
+
+    def test_short_codes_and_senders(self):
+        self.assertEqual(normalize_number('1234', '214'), '1234')
+        self.assertEqual(normalize_number('Vodafone', '214'), 'Vodafone')
+        self.assertEqual(get_number_key('Vodafone'), 'Vodafone')
+
+    def test_numbers_match(self):
+        self.assertEqual(get_number_key('+34600123456'), '00123456')
+        self.assertTrue(numbers_match('+34600123456', '600123456'))
+        self.assertTrue(numbers_match('+34600123456', '+34600123456'))
+        # same key, different countries
+        self.assertFalse(numbers_match('+34600123456', '+44600123456'))
+        self.assertFalse(numbers_match('Vodafone', '+34600123456'))
+
+    def test_numbers_match_every_digit(self):
+        # same key, the digits before it differ
+        self.assertFalse(numbers_match('600123456', '500123456'))
+        self.assertFalse(numbers_match('600123456', '+34700123456'))
+        self.assertTrue(numbers_match('600123456', '0600123456'))
+        # the digits of a national number might follow its trunk prefix
+        self.assertTrue(numbers_match('07700900123', '+447700900123'))
+        self.assertFalse(numbers_match('07700900123', '17700900123'))
+        # too short to tell
+        self.assertFalse(numbers_match('123456', '+34600123456'))
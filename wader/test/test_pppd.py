@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the pppd dialer of the plain backend
+"""
+
+import os
+import stat
+
+from twisted.trial import unittest
+from twisted.internet import reactor
+
+import wader.common.backends.plain as plain
+from wader.common.backends.plain import (PPPDProtocol, _generate_pppd_conf,
+                                         get_pppd_conf, remove_pppd_confs,
+                                         parse_ip_up_status)
+from wader.common.dialer import DialerConf
+from wader.common.events import EventBus
+
+# stands in for pppd: runs the ip-up hook like pppd does once IPCP is
+# up, or fails like pppd does when the connect script fails
+FAKE_PPPD = """#!/bin/sh
+[ -n "$FAIL" ] && exit $FAIL
+IPUP=`sed -n 's/^ip-up-script //p' "$2"`
+DNS1=212.166.210.80 DNS2= $IPUP ppp7 /dev/ttyUSB0 460800 10.1.2.3 10.64.64.64
+trap 'exit 5' TERM
+while true; do sleep 0.1; done
+"""
+
+# stands in for pppd --version, older pppds exit with 1
+FAKE_PPPD_VERSION = """#!/bin/sh
+echo "pppd version %s" >&2
+exit 1
+"""
+
+
+class FakeOSPlugin(object):
+
+    def __init__(self):
+        self.dns = {}
+
+    def add_dns_info(self, dns, iface):
+        self.dns[iface] = dns
+
+    def delete_dns_info(self, iface):
+        self.dns.pop(iface, None)
+
+
+class FakeDevice(object):
+
+    def __init__(self):
+        self.opath = '/org/freedesktop/ModemManager/Devices/0'
+        self.events = EventBus()
+
+
+class FakeDialer(object):
+    """I record the dialer callbacks the protocol makes"""
+
+    def __init__(self):
+        self.device = FakeDevice()
+        self.opath = '/org/freedesktop/ModemManager/Connections/0'
+        self.conf = DialerConf()
+        self.iface = None
+        self.calls = []
+
+    def _set_iface(self, iface):
+        self.iface = iface
+
+    def Connected(self):
+        self.calls.append('Connected')
+
+    def Disconnected(self):
+        self.calls.append('Disconnected')
+
+    def InvalidDNS(self, dns):
+        self.calls.append('InvalidDNS')
+
+
+class TestPPPDConf(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(plain, 'get_os_object', FakeOSPlugin)
+        self.dirpath = self.mktemp()
+        os.mkdir(self.dirpath)
+
+        self.conf = DialerConf()
+        self.conf.username = 'vodafone'
+        self.conf.password = 'secret'
+        self.conf.refuse_chap = True
+        self.conf.refuse_pap = False
+
+    def test_generate_pppd_conf(self):
+        options_path, status_path = _generate_pppd_conf(self.conf, 3,
+                                '/dev/ttyUSB0', '/usr/sbin/chat', self.dirpath)
+        options = open(options_path).read()
+        self.assertIn('/dev/ttyUSB0\n', options)
+        self.assertIn('password "secret"', options)
+        self.assertIn('ip-up-script %s/ip-up' % self.dirpath, options)
+        self.assertIn('connect "/usr/sbin/chat -f %s/chat"' % self.dirpath,
+                      options)
+        # PAP only
+        self.assertIn('refuse-chap', options)
+        # the password must not be readable by others
+        mode = stat.S_IMODE(os.stat(options_path).st_mode)
+        self.assertEqual(mode, 0600)
+
+        chat = open(os.path.join(self.dirpath, 'chat')).read()
+        self.assertIn('OK ATDT*99***3#', chat)
+
+        ipup = open(os.path.join(self.dirpath, 'ip-up')).read()
+        self.assertIn('> %s.tmp' % status_path, ipup)
+        self.assertIn('"$1 $4 $DNS1 $DNS2"', ipup)
+
+    def test_unsafe_secrets_are_rejected(self):
+        for value in ['secret"\nplugin evil.so', 'secret\\', 'sec\x00ret']:
+            self.conf.password = value
+            self.assertRaises(ValueError, _generate_pppd_conf, self.conf, 3,
+                              '/dev/ttyUSB0', '/usr/sbin/chat', self.dirpath)
+            self.assertFalse(os.path.exists(
+                os.path.join(self.dirpath, 'options')))
+
+        self.conf.password = 'secret'
+        self.conf.username = 'voda"fone'
+        self.assertRaises(ValueError, _generate_pppd_conf, self.conf, 3,
+                          '/dev/ttyUSB0', '/usr/sbin/chat', self.dirpath)
+
+    def test_pppd_conf_is_cached(self):
+        self.patch(plain, '_pppd_confs', {})
+        self.addCleanup(remove_pppd_confs)
+
+        options_path, status_path = get_pppd_conf(self.conf, 3,
+                                            '/dev/ttyUSB0', '/usr/sbin/chat')
+        # the status file of the last connection is removed
+        open(status_path, 'w').close()
+        self.assertEqual(get_pppd_conf(self.conf, 3, '/dev/ttyUSB0',
+                                       '/usr/sbin/chat'),
+                         (options_path, status_path))
+        self.assertFalse(os.path.exists(status_path))
+
+        # the profile changed
+        self.conf.password = 'another'
+        new_path = get_pppd_conf(self.conf, 3, '/dev/ttyUSB0',
+                                 '/usr/sbin/chat')[0]
+        self.assertNotEqual(new_path, options_path)
+        self.assertFalse(os.path.exists(options_path))
+        self.assertIn('password "another"', open(new_path).read())
+
+        remove_pppd_confs()
+        self.assertFalse(os.path.exists(new_path))
+
+    def test_parse_ip_up_status(self):
+        self.assertEqual(parse_ip_up_status("ppp0 10.1.2.3 8.8.8.8 8.8.4.4\n"),
+                         ('ppp0', '10.1.2.3', ['8.8.8.8', '8.8.4.4']))
+        # no DNS from the network
+        self.assertEqual(parse_ip_up_status("ppp1 10.1.2.3  \n"),
+                         ('ppp1', '10.1.2.3', []))
+
+
+class TestPPPDProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.osobj = FakeOSPlugin()
+        self.patch(plain, 'get_os_object', lambda: self.osobj)
+        self.dirpath = self.mktemp()
+        os.mkdir(self.dirpath)
+        self.dialer = FakeDialer()
+
+        self.pppd = os.path.join(self.dirpath, 'pppd')
+        fobj = open(self.pppd, 'w')
+        fobj.write(FAKE_PPPD)
+        fobj.close()
+        os.chmod(self.pppd, 0700)
+
+    def spawn(self, **env):
+        environ = os.environ.copy()
+        environ.update(env)
+        options_path, status_path = _generate_pppd_conf(self.dialer.conf, 1,
+                                '/dev/ttyUSB0', '/usr/sbin/chat', self.dirpath)
+        proto = PPPDProtocol(self.dialer, status_path)
+        args = [self.pppd, 'file', options_path]
+        reactor.spawnProcess(proto, args[0], args, env=environ)
+        return proto
+
+    def test_connect_and_terminate(self):
+        proto = self.spawn()
+
+        def connected(opath):
+            self.assertEqual(opath, self.dialer.opath)
+            self.assertEqual(self.dialer.iface, 'ppp7')
+            self.assertEqual(self.osobj.dns, {'ppp7': ['212.166.210.80']})
+            self.assertEqual(self.dialer.calls, ['Connected'])
+            return proto.terminate()
+
+        def terminated(exit_code):
+            self.assertEqual(exit_code, 5)
+            self.assertEqual(self.dialer.calls, ['Connected', 'Disconnected'])
+            self.assertEqual(self.osobj.dns, {})
+
+        proto.deferred.addCallback(connected)
+        proto.deferred.addCallback(terminated)
+        return proto.deferred
+
+    def test_connect_script_failure(self):
+        proto = self.spawn(FAIL='8')
+
+        def failed(failure):
+            failure.trap(RuntimeError)
+            self.assertIn('connect script failed', failure.getErrorMessage())
+            self.assertEqual(self.dialer.calls, ['Disconnected'])
+
+        proto.deferred.addCallbacks(lambda _: self.fail("should fail"),
+                                    failed)
+        return proto.deferred
+
+
+class TestPPPDVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = self.mktemp()
+        os.mkdir(self.dirpath)
+        self.patch(plain, '_pppd_versions', {})
+        self.patch(plain.procutils, 'which',
+                   lambda name: [p for p in [os.path.join(self.dirpath, name)]
+                                 if os.path.exists(p)])
+        self.write_script('chat', '#!/bin/sh\n')
+
+    def write_script(self, name, text):
+        path = os.path.join(self.dirpath, name)
+        fobj = open(path, 'w')
+        fobj.write(text)
+        fobj.close()
+        os.chmod(path, 0700)
+        return path
+
+    def test_recent_pppd_is_driven_directly(self):
+        path = self.write_script('pppd', FAKE_PPPD_VERSION % '2.4.5')
+        self.assertEqual(plain.get_pppd_version(path), (2, 4, 5))
+        self.assertTrue(plain.PPPDDialer.is_available())
+
+    def test_old_pppd_is_not(self):
+        path = self.write_script('pppd', FAKE_PPPD_VERSION % '2.4.4')
+        self.assertEqual(plain.get_pppd_version(path), (2, 4, 4))
+        self.assertFalse(plain.PPPDDialer.is_available())
+
+    def test_unknown_version(self):
+        path = self.write_script('pppd', '#!/bin/sh\nexit 2\n')
+        self.assertEqual(plain.get_pppd_version(path), None)
+        self.assertFalse(plain.PPPDDialer.is_available())
+        self.assertEqual(plain.get_pppd_version(self.dirpath + '/none'),
+                         None)
+
+    def test_chat_is_needed(self):
+        self.write_script('pppd', FAKE_PPPD_VERSION % '2.4.5')
+        os.unlink(os.path.join(self.dirpath, 'chat'))
+        self.assertFalse(plain.PPPDDialer.is_available())
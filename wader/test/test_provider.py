@@ -27,12 +27,16 @@ from time import time
 
 from twisted.trial import unittest
 
+import wader.common.provider
 from wader.common.provider import (SMS_SCHEMA, SmsProvider, Message, Folder,
                                    Thread, DBError, inbox_folder,
                                    outbox_folder, drafts_folder, READ, UNREAD,
                                    message_read, NETWORKS_SCHEMA, TYPE_PREPAID,
                                    TYPE_CONTRACT, NetworkProvider,
-                                   NetworkOperator, UsageProvider)
+                                   NetworkOperator, UsageProvider,
+                                   USAGE_SCHEMA, date_to_datetime,
+                                   rebuild_networks_db, NetworkTrie,
+                                   get_network_trie, execute_script)
 from wader.common.utils import get_tz_aware_now
 
 
@@ -333,6 +337,83 @@ class TestNetworkProvider(unittest.TestCase):
         # leave it as we found it
         c.execute("delete from network_info")
 
+    def test_populate_db_from_mbpi_twice(self):
+        self.create_test_mbpi()
+        self.provider.populate_networks_from_mbpi(self.mbpi)
+        self.provider.populate_networks_from_mbpi(self.mbpi)
+
+        c = self.provider.conn.cursor()
+        c.execute("select count(*) from network_info")
+        self.assertEqual(c.fetchone()[0], 4)
+        # no duplicated APNs
+        c.execute("select count(*) from apn")
+        self.assertEqual(c.fetchone()[0], 8)
+
+        # leave it as we found it
+        c.execute("delete from network_info")
+
+    def build_source(self, networks):
+        source = NetworkProvider(':memory:')
+        source.populate_networks_from_objs(networks)
+        return source
+
+    def get_apn_ids(self, provider, netid):
+        c = provider.conn.cursor()
+        c.execute("select id from apn where network_id=?", (netid,))
+        return sorted([row[0] for row in c.fetchall()])
+
+    def test_rebuild_networks_db_incremental(self):
+        path = self.mktemp()
+        vf_es = [NetworkOperator(["21401"], "contract.vodafone.es",
+                    "vodafone", "vodafone", "10.0.0.1", "10.0.0.2",
+                    TYPE_CONTRACT, '+23123121', '+2132121', "Spain",
+                    "Vodafone"),
+                 NetworkOperator(["21401"], "prepaid.vodafone.es",
+                    "vodafone", "vodafone", "10.0.0.1", "10.0.0.2",
+                    TYPE_PREPAID, '+23323232', '+23423232', "Spain",
+                    "Vodafone")]
+        vf_de = NetworkOperator(["26202"], "web.vodafone.de", "vodafone",
+                    "vodafone", "139.7.30.125", "139.7.30.126",
+                    TYPE_CONTRACT, None, None, "Germany", "Vodafone")
+        vf_uk = NetworkOperator(["23415"], "internet", "web", "web",
+                    "10.206.65.68", "10.203.65.68", TYPE_CONTRACT, None,
+                    None, "United Kingdom", "Vodafone")
+
+        count = rebuild_networks_db(path, self.build_source(vf_es + [vf_de]))
+        self.assertEqual(count, 2)
+        # lookups are served from the old DB during the rebuild
+        old = NetworkProvider(path)
+        es_ids = self.get_apn_ids(old, '21401')
+
+        vf_de.apn = "event.vodafone.de"
+        count = rebuild_networks_db(path, self.build_source(vf_es + [vf_uk]
+                                                            + [vf_de]))
+        # 26202 changed and 23415 is new
+        self.assertEqual(count, 2)
+        self.assertEqual(old.get_network_by_id("262021234567890")[0].apn,
+                         "web.vodafone.de")
+        old.close()
+
+        new = NetworkProvider(path)
+        self.assertEqual(new.get_network_by_id("262021234567890")[0].apn,
+                         "event.vodafone.de")
+        self.assertEqual(len(new.get_network_by_id("234151234567890")), 1)
+        # untouched
+        self.assertEqual(self.get_apn_ids(new, '21401'), es_ids)
+        new.close()
+
+        # 26202 is gone
+        count = rebuild_networks_db(path, self.build_source(vf_es + [vf_uk]))
+        self.assertEqual(count, 1)
+        new = NetworkProvider(path)
+        self.assertEqual(new.get_network_by_id("262021234567890"), [])
+        self.assertEqual(self.get_apn_ids(new, '21401'), es_ids)
+        new.close()
+
+        # nothing changed
+        self.assertEqual(rebuild_networks_db(path, self.build_source(
+                                                    vf_es + [vf_uk])), 0)
+
     def test_assert_passing_netid_raises_exception(self):
         self.assertRaises(ValueError, self.provider.get_network_by_id, "21401")
 
@@ -392,6 +473,80 @@ class TestNetworkProvider(unittest.TestCase):
         c = self.provider.conn.cursor()
         c.execute("delete from network_info where 1=1")
 
+    def test_network_trie_longest_prefix(self):
+        networks = [NetworkOperator(["21401"], "prepaid.vodafone.es",
+                        "vodafone", "vodafone", "10.0.0.1", "10.0.0.2",
+                        TYPE_PREPAID, '+23323232', '+23423232', "Spain",
+                        "Vodafone"),
+                    NetworkOperator(["21401"], "contract.vodafone.es",
+                        "vodafone", "vodafone", "10.0.0.1", "10.0.0.2",
+                        TYPE_CONTRACT, '+23123121', '+2132121', "Spain",
+                        "Vodafone"),
+                    NetworkOperator(["2140161"], "internet.es",
+                        "vodafone", "vodafone", "10.0.0.1", "10.0.0.2",
+                        TYPE_CONTRACT, '+23123121', '+2132121', "Spain",
+                        "Vodafone")]
+
+        self.provider.populate_networks_from_objs(networks)
+        trie = NetworkTrie.from_provider(self.provider)
+        self.assertEqual(trie.size, 2)
+
+        for imsi in ["2140161213322323", "2140153241213122",
+                     "2140163241213122", "2340153241213122"]:
+            self.assertEqual(
+                [(n.netid, n.apn) for n in trie.get_network_by_id(imsi)],
+                [(n.netid, n.apn) for n in
+                                    self.provider.get_network_by_id(imsi)])
+
+        response = trie.get_network_by_id("2140161213322323")
+        self.assertEqual([n.apn for n in response], ["internet.es"])
+        self.assertEqual(len(trie.get_network_by_id("2140153241213122")), 2)
+        self.assertEqual(trie.get_network_by_id("2340153241213122"), [])
+        self.assertRaises(ValueError, trie.get_network_by_id, "21401")
+        # leave it as we found it
+        c = self.provider.conn.cursor()
+        c.execute("delete from network_info where 1=1")
+
+    def test_network_trie_invalidated_on_rebuild(self):
+        path = self.mktemp()
+        vf_de = NetworkOperator(["26202"], "web.vodafone.de", "vodafone",
+                    "vodafone", "139.7.30.125", "139.7.30.126",
+                    TYPE_CONTRACT, None, None, "Germany", "Vodafone")
+
+        rebuild_networks_db(path, self.build_source([vf_de]))
+        trie = get_network_trie(path)
+        # shared
+        self.assertIdentical(get_network_trie(path), trie)
+        self.assertEqual(trie.get_network_by_id("262021234567890")[0].apn,
+                         "web.vodafone.de")
+
+        vf_de.apn = "event.vodafone.de"
+        rebuild_networks_db(path, self.build_source([vf_de]))
+        trie = get_network_trie(path)
+        self.assertEqual(trie.get_network_by_id("262021234567890")[0].apn,
+                         "event.vodafone.de")
+
+    def test_network_trie_follows_db_file(self):
+        # a DB replaced by another process is noticed on next access
+        path = self.mktemp()
+        vf_de = NetworkOperator(["26202"], "web.vodafone.de", "vodafone",
+                    "vodafone", "139.7.30.125", "139.7.30.126",
+                    TYPE_CONTRACT, None, None, "Germany", "Vodafone")
+
+        rebuild_networks_db(path, self.build_source([vf_de]))
+        trie = get_network_trie(path)
+        self.assertIdentical(get_network_trie(path), trie)
+
+        other = self.mktemp()
+        vf_de.apn = "event.vodafone.de"
+        rebuild_networks_db(other, self.build_source([vf_de]))
+        os.rename(other, path)
+
+        trie = get_network_trie(path)
+        self.assertEqual(trie.get_network_by_id("262021234567890")[0].apn,
+                         "event.vodafone.de")
+        self.assertIdentical(get_network_trie(path), trie)
+
 
 class TestSmsDBTriggers(unittest.TestCase):
     """Tests for the SMS DB triggers"""
@@ -841,6 +996,347 @@ class TestSmsProvider(unittest.TestCase):
         self.provider.delete_thread(t1)
         self.provider.delete_thread(t2)
 
+    def test_list_from_thread_pages(self):
+        number = '+3443545333'
+        now = get_tz_aware_now()
+        t = self.provider.add_thread(
+            Thread(now, number, folder=inbox_folder))
+        # some messages share their date, the id breaks the tie
+        dates = [now - timedelta(minutes=i / 2) for i in range(7)]
+        for i, sms_date in enumerate(dates):
+            self.provider.add_sms(
+                Message(number=number, text='page %d' % i,
+                        _datetime=sms_date, thread=t))
+
+        expected = list(self.provider.list_from_thread(t))
+        pages = []
+        page = list(self.provider.list_from_thread(t, limit=3))
+        while page:
+            pages.append(page)
+            # a new message arrives while the user reads the page
+            self.provider.add_sms(
+                Message(number=number, text='new',
+                        _datetime=get_tz_aware_now(), thread=t))
+            page = list(self.provider.list_from_thread(t, before=page[-1],
+                                                       limit=3))
+
+        self.assertEqual(map(len, pages), [3, 3, 1])
+        self.assertEqual(sum(pages, []), expected)
+        # leave it as we found it
+        self.provider.delete_thread(t)
+
+    def test_list_sms_and_threads_pages(self):
+        now = get_tz_aware_now()
+        threads = []
+        for i in range(3):
+            t = self.provider.add_thread(
+                Thread(now - timedelta(minutes=i), '+344354533%d' % i,
+                       folder=inbox_folder))
+            threads.append(t)
+            for j in range(2):
+                self.provider.add_sms(
+                    Message(number=t.number, text='test_list_sms',
+                            _datetime=now - timedelta(minutes=i), thread=t))
+
+        messages = list(self.provider.list_sms(limit=4))
+        messages += list(self.provider.list_sms(before=messages[-1]))
+        self.assertEqual(messages, list(self.provider.list_sms()))
+        self.assertEqual(len(messages), 6)
+
+        first = list(self.provider.list_threads(limit=2))
+        rest = list(self.provider.list_threads(before=first[-1], limit=2))
+        self.assertEqual(first + rest, list(self.provider.list_threads()))
+        self.assertEqual(len(rest), 1)
+
+        # every message bumps the date of its thread, the ids break the tie
+        first = list(self.provider.list_from_folder(inbox_folder, limit=1))
+        self.assertEqual(first, [threads[-1]])
+        # leave it as we found it
+        for t in threads:
+            self.provider.delete_thread(t)
+
+    def test_list_sms_attaches_threads_and_folders(self):
+        folder = self.provider.add_folder(Folder("Archive"))
+        t1 = self.provider.add_thread(
+            Thread(get_tz_aware_now(), '+3643445333', folder=folder))
+        t2 = self.provider.add_thread(
+            Thread(get_tz_aware_now(), '+3443545333', folder=inbox_folder))
+        for t in [t1, t1, t2]:
+            self.provider.add_sms(
+                Message(number=t.number, text='test_list_sms',
+                        _datetime=get_tz_aware_now(), thread=t))
+
+        expected = {}
+        for t in [t1, t2]:
+            expected[t.index] = self.provider._get_thread_by_id(t.index)
+
+        # everything comes from a single query
+        self.patch(self.provider, '_get_thread_by_id', None)
+        self.patch(self.provider, '_get_folder_by_id', None)
+        messages = list(self.provider.list_sms())
+        self.assertEqual(len(messages), 3)
+        for sms in messages:
+            thread = expected[sms.thread.index]
+            self.assertEqual(sms.thread.number, thread.number)
+            self.assertEqual(sms.thread.message_count, thread.message_count)
+            self.assertEqual(sms.thread.folder, thread.folder)
+            self.assertEqual(sms.thread.folder.name, thread.folder.name)
+
+        threads = list(self.provider.list_threads())
+        self.assertEqual(sorted([(t.index, t.folder.name) for t in threads]),
+                         [(t1.index, "Archive"), (t2.index, "Inbox")])
+        # leave it as we found it
+        self.provider.delete_thread(t1)
+        self.provider.delete_thread(t2)
+        self.provider.delete_folder(folder)
+
+    def test_get_thread_by_number_in_any_format(self):
+        provider = SmsProvider(':memory:')
+        provider.add_folder(inbox_folder)
+        thread = provider.get_thread_by_number('+34 600 123 456')
+        for number in ['+34600123456', '0034600123456', '600123456']:
+            self.assertEqual(provider.get_thread_by_number(number), thread)
+
+        # same suffix, another country
+        other = provider.get_thread_by_number('+44 7700 123456')
+        self.assertNotEqual(other, thread)
+        self.assertEqual(provider.get_thread_by_number('00447700123456'),
+                         other)
+
+        c = provider.conn.cursor()
+        c.execute("explain query plan select t.* from thread_number n "
+                  "inner join thread t on n.thread_id = t.id "
+                  "where n.number_key=? and t.folder_id=?", ('00123456', 1))
+        self.assertIn('thread_number_key_index', repr(c.fetchall()))
+        provider.close()
+
+    def test_national_numbers_sharing_the_key_get_their_own_thread(self):
+        provider = SmsProvider(':memory:')
+        provider.add_folder(inbox_folder)
+        numbers = ['600123456', '500123456', '900123456', '+34700123456']
+        threads = [provider.get_thread_by_number(number)
+                   for number in numbers]
+        self.assertEqual(len(set([t.index for t in threads])), 4)
+        self.assertEqual(provider.get_thread_by_number('+34600123456'),
+                         threads[0])
+        provider.close()
+
+    def test_thread_numbers_built_for_old_dbs(self):
+        path = self.mktemp()
+        conn = sqlite3.connect(path)
+        conn.create_function('msg_is_read', 1, message_read)
+        conn.executescript(SMS_SCHEMA)
+        conn.execute("insert into folder values (1, 'Inbox')")
+        conn.execute("insert into thread values (1, 0, '+34600123456', 0, "
+                     "'', 0, 1)")
+        conn.commit()
+        conn.close()
+
+        provider = SmsProvider(path)
+        thread = provider.get_thread_by_number('600 123 456')
+        self.assertEqual(thread.index, 1)
+        provider.delete_thread(thread)
+        c = provider.conn.cursor()
+        c.execute("select count(*) from thread_number")
+        self.assertEqual(c.fetchone()[0], 0)
+        provider.close()
+
+    def add_messages(self, texts, number='+3443545333'):
+        thread = self.provider.add_thread(
+            Thread(get_tz_aware_now(), number, folder=inbox_folder))
+        now = get_tz_aware_now()
+        messages = []
+        for i, text in enumerate(texts):
+            # the later, the newer
+            messages.append(self.provider.add_sms(
+                Message(number=number, text=text,
+                        _datetime=now + timedelta(minutes=i),
+                        thread=thread)))
+
+        return thread, messages
+
+    def test_search_sms(self):
+        thread, messages = self.add_messages([
+            'see you at the station',
+            'the train is late, late, late',
+            'Late again?',
+            'nothing to see here'])
+
+        results = self.provider.search_sms('late')
+        self.assertEqual([sms.index for sms in results],
+                         [messages[1].index, messages[2].index])
+        # with their thread and folder
+        self.assertEqual(results[0].thread, thread)
+        self.assertEqual(results[0].thread.folder, inbox_folder)
+        # every word must be there
+        self.assertEqual(self.provider.search_sms('train late'),
+                         [messages[1]])
+        # the last word is a prefix
+        self.assertEqual(self.provider.search_sms('sta'), [messages[0]])
+        # bad syntax is not an error
+        self.assertEqual(self.provider.search_sms('"the OR'), [])
+        self.assertEqual(self.provider.search_sms('  '), [])
+        # leave it as we found it
+        self.provider.delete_thread(thread)
+
+    def test_search_sms_without_fts(self):
+        thread, messages = self.add_messages(['the train is late',
+                                              'Late again?'])
+        self.provider.fts = False
+        self.assertEqual([sms.index for sms in
+                          self.provider.search_sms('late')],
+                         [messages[1].index, messages[0].index])
+        self.assertEqual(self.provider.search_sms('train late'),
+                         [messages[0]])
+        self.provider.delete_thread(thread)
+
+    def test_search_sms_without_fts_is_literal(self):
+        thread, messages = self.add_messages(['50% off', 'top_up done',
+                                              'a\\b', '500 left',
+                                              'topXup'])
+        self.provider.fts = False
+        for text, expected in [('50%', [messages[0]]),
+                               ('top_up', [messages[1]]),
+                               ('a\\b', [messages[2]]),
+                               ('%', [messages[0]]),
+                               ('_', [messages[1]])]:
+            self.assertEqual(self.provider.search_sms(text), expected)
+        self.provider.delete_thread(thread)
+
+    def test_search_sms_pagination(self):
+        thread, messages = self.add_messages(['hello %d' % i
+                                              for i in range(5)])
+        # equally relevant, the newest first
+        pages = [self.provider.search_sms('hello', offset, 2)
+                 for offset in [0, 2, 4]]
+        self.assertEqual([[sms.index for sms in page] for page in pages],
+                         [[messages[4].index, messages[3].index],
+                          [messages[2].index, messages[1].index],
+                          [messages[0].index]])
+        self.provider.delete_thread(thread)
+
+    def test_search_sms_follows_changes(self):
+        thread, messages = self.add_messages(['first', 'second'])
+        self.provider.delete_sms(messages[0])
+        self.assertEqual(self.provider.search_sms('first'), [])
+        c = self.provider.conn.cursor()
+        c.execute("update message set text='third' where id=?",
+                  (messages[1].index,))
+        self.assertEqual(self.provider.search_sms('second'), [])
+        self.assertEqual(self.provider.search_sms('third'), [messages[1]])
+        self.provider.delete_thread(thread)
+
+    def test_search_sms_in_old_dbs(self):
+        path = self.mktemp()
+        conn = sqlite3.connect(path)
+        conn.create_function('msg_is_read', 1, message_read)
+        conn.executescript(SMS_SCHEMA)
+        conn.execute("insert into folder values (1, 'Inbox')")
+        conn.execute("insert into thread values (1, 0, '+34600123456', 0, "
+                     "'', 0, 1)")
+        conn.execute("insert into message values (1, 0, '+34600123456', "
+                     "'an old message', 0, 1)")
+        conn.commit()
+        conn.close()
+
+        provider = SmsProvider(path)
+        self.assertEqual([sms.index for sms in provider.search_sms('old')],
+                         [1])
+        provider.close()
+
+    def test_fts_falls_back_to_the_next_module(self):
+        self.patch(wader.common.provider, 'FTS_MODULES',
+                   ['nosuchmod(text)', 'fts3(text)'])
+        path = self.mktemp()
+        provider = SmsProvider(path)
+        self.assertTrue(provider.fts)
+        provider.add_folder(inbox_folder)
+        # the failed module left no transaction open
+        conn = sqlite3.connect(path)
+        self.assertEqual(conn.execute("select name from folder").fetchall(),
+                         [(u'Inbox',)])
+        conn.close()
+        provider.close()
+
+    def test_import_sms(self):
+        now = get_tz_aware_now()
+
+        def messages():
+            for i in range(5):
+                number = ['+34600123456', '+34600654321'][i % 2]
+                flags = [READ, UNREAD][i % 3 == 0]
+                yield Message(number=number, text='import %d' % i,
+                              _datetime=now, flags=flags)
+
+        # the same messages one at a time, to compare the thread counters
+        provider = SmsProvider(':memory:')
+        provider.add_folder(inbox_folder)
+        for sms in messages():
+            provider.add_sms(sms)
+
+        self.assertEqual(self.provider.import_sms(messages()), 5)
+        for number, count in [('+34600123456', 3), ('+34600654321', 2)]:
+            thread = self.provider.get_thread_by_number(number)
+            expected = provider.get_thread_by_number(number)
+            self.assertEqual((thread.message_count, thread.read,
+                              thread.snippet),
+                             (expected.message_count, expected.read,
+                              expected.snippet))
+            messages_ = list(self.provider.list_from_thread(thread))
+            self.assertEqual(len(messages_), count)
+        provider.close()
+
+        # the counters work as usual afterwards
+        self.provider.add_sms(
+            Message(number='+34600123456', text='after', _datetime=now))
+        self.assertEqual(self.provider.get_thread_by_number(
+                                        '+34600123456').snippet, 'after')
+        for thread in self.provider.list_threads():
+            self.provider.delete_thread(thread)
+
+    def test_import_sms_is_atomic(self):
+        now = get_tz_aware_now()
+
+        def messages():
+            yield Message(number='+34600123456', text='one', _datetime=now)
+            raise IOError("truncated backup")
+
+        self.assertRaises(IOError, self.provider.import_sms, messages())
+        self.assertEqual(list(self.provider.list_sms()), [])
+        self.assertEqual(list(self.provider.list_threads()), [])
+        # the trigger is back
+        c = self.provider.conn.cursor()
+        c.execute("select 1 from sqlite_master where type='trigger' "
+                  "and name='fki_update_thread_values'")
+        self.assertNotEqual(c.fetchone(), None)
+
+    def test_export_and_import_sms(self):
+        folder = self.provider.add_folder(Folder("Archive"))
+        thread, messages = self.add_messages(['one', 'two', 'three'])
+        self.provider.move_to_folder(thread, folder)
+
+        exported = self.provider.export_sms()
+        self.assertEqual([sms.text for sms in exported],
+                         ['one', 'two', 'three'])
+        c = self.provider.conn.cursor()
+        c.execute("explain query plan select m.*, t.*, f.* from message m "
+                  "inner join thread t on m.thread_id = t.id "
+                  "inner join folder f on t.folder_id = f.id "
+                  "order by m.id")
+        # streamed, never sorted
+        self.assertNotIn('TEMP B-TREE', repr(c.fetchall()))
+
+        provider = SmsProvider(':memory:')
+        for _folder in [inbox_folder, outbox_folder, drafts_folder, folder]:
+            provider.add_folder(Folder(_folder.name, _folder.index))
+        self.assertEqual(provider.import_sms(self.provider.export_sms()), 3)
+        self.assertEqual([(sms.text, sms.datetime, sms.thread.folder.name)
+                          for sms in provider.export_sms()],
+                         [(sms.text, sms.datetime, "Archive")
+                          for sms in self.provider.export_sms()])
+        provider.close()
+        self.provider.delete_folder(folder)
+
     def test_move_thread_from_folder_to_folder(self):
         # add a thread to inbox_folder and check its present
         t1 = self.provider.add_thread(
@@ -906,6 +1402,26 @@ class TestSmsProvider(unittest.TestCase):
         self.provider.delete_thread(t)
 
 
+class TestExecuteScript(unittest.TestCase):
+    """Tests for the scripts run in a transaction"""
+
+    def test_failed_script_is_rolled_back(self):
+        path = self.mktemp()
+        conn = sqlite3.connect(path, isolation_level=None)
+        c = conn.cursor()
+        c.execute("create table t (x)")
+        self.assertRaises(sqlite3.OperationalError, execute_script, c,
+                          "insert into t values (1);\n"
+                          "create virtual table v using nosuchmod(x);")
+        self.assertEqual(c.execute("select * from t").fetchall(), [])
+        # no transaction was left open
+        c.execute("insert into t values (2)")
+        other = sqlite3.connect(path)
+        self.assertEqual(other.execute("select * from t").fetchall(), [(2,)])
+        other.close()
+        conn.close()
+
+
 class TestUsageProvider(unittest.TestCase):
     def setUp(self):
         self.provider = UsageProvider(':memory:')
@@ -1067,3 +1583,76 @@ class TestUsageProvider(unittest.TestCase):
         # leave it as we found it
         for i in [item1, item2]:
             self.provider.delete_usage_item(i)
+
+    def add_session(self, day, hour, bytes_recv, bytes_sent, umts=True):
+        start = date_to_datetime(day) + timedelta(hours=hour)
+        return self.provider.add_usage_item(start,
+                                            start + timedelta(minutes=30),
+                                            bytes_recv, bytes_sent, umts)
+
+    def test_usage_summaries(self):
+        day1, day2 = date(2010, 3, 12), date(2010, 3, 13)
+        self.add_session(day1, 10, 1000, 100)
+        self.add_session(day1, 20, 2000, 200, umts=False)
+        self.add_session(day2, 9, 4000, 400)
+        self.add_session(date(2010, 4, 1), 9, 8000, 800)
+
+        summary = self.provider.get_usage_summary_for_day(day1)
+        self.assertEqual((summary.bytes_recv, summary.bytes_sent,
+                          summary.items), (3000, 300, 2))
+        summary = self.provider.get_usage_summary_for_day(day1, umts=False)
+        self.assertEqual(summary.total(), 2200)
+
+        summary = self.provider.get_usage_summary_for_month(day2)
+        self.assertEqual(summary.total(), 7700)
+        self.assertEqual(summary.items, 3)
+        # the same as adding up the items
+        items = self.provider.get_usage_for_month(day2)
+        self.assertEqual(summary.total(), sum(i.total() for i in items))
+
+        self.assertEqual(self.provider.get_total_usage_summary().total(),
+                         16500)
+        self.assertEqual(
+            self.provider.get_total_usage_summary(day2).total(), 13200)
+        self.assertEqual(self.provider.get_total_usage_summary(
+                            date(2010, 4, 1), umts=True).items, 1)
+
+        daily = self.provider.get_daily_usage(day1, date(2010, 4, 2))
+        self.assertEqual([(s.period, s.total()) for s in daily],
+                         [(day1, 3300), (day2, 4400),
+                          (date(2010, 4, 1), 8800)])
+
+    def test_rollups_follow_deletions(self):
+        day = date(2010, 3, 12)
+        item1 = self.add_session(day, 10, 1000, 100)
+        item2 = self.add_session(day, 11, 2000, 200)
+
+        self.provider.delete_usage_item(item1)
+        summary = self.provider.get_usage_summary_for_day(day)
+        self.assertEqual((summary.total(), summary.items), (2200, 1))
+
+        self.provider.delete_usage_item(item2)
+        self.assertEqual(self.provider.get_daily_usage(day, date(2010, 4, 1)),
+                         [])
+        summary = self.provider.get_usage_summary_for_month(day)
+        self.assertEqual((summary.total(), summary.items), (0, 0))
+
+    def test_rollups_built_for_old_dbs(self):
+        path = self.mktemp()
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.executescript(USAGE_SCHEMA % dict(version=1))
+        start = date_to_datetime(date(2010, 3, 12)) + timedelta(hours=10)
+        for i in range(3):
+            conn.execute("insert into usage(start_time, end_time, bytes_recv,"
+                         "bytes_sent, umts) values (?,?,?,?,?)",
+                         (start, start + timedelta(minutes=5), 1000, 100,
+                          True))
+        conn.close()
+
+        provider = UsageProvider(path)
+        summary = provider.get_usage_summary_for_day(date(2010, 3, 12))
+        self.assertEqual((summary.total(), summary.items), (3300, 3))
+        c = provider.conn.cursor()
+        c.execute("select version from version")
+        self.assertEqual(c.fetchone()[0], UsageProvider.version)
+        provider.close()
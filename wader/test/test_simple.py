@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""Unittests for the SimpleStateMachine"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+import wader.common.aterrors as E
+from wader.common.consts import (STATUS_HOME, STATUS_SEARCHING,
+                                 MM_NETWORK_MODE_2G_ONLY,
+                                 MM_NETWORK_MODE_3G_ONLY,
+                                 MM_NETWORK_BAND_ANY, MM_NETWORK_BAND_U2100,
+                                 MM_ALLOWED_MODE_3G_ONLY)
+import wader.common.events as events
+from wader.common.events import EventBus
+from wader.common.signals import SIG_CREG
+import wader.common.statem.simple as simple
+from wader.common.statem.simple import SimpleStateMachine
+
+
+class FakeAuth(object):
+    DELAY = 15
+
+
+class FakeCustom(object):
+    auth_klass = FakeAuth
+
+
+class FakeSerialConnection(object):
+    """
+    I record the commands sent by the state machine
+
+    I also keep the configuration written to me, just like a real device
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.state_dict = {'conn_id': 1}
+        self.netreg_status = [(1, STATUS_HOME)]
+        self.netid = '21401'
+        self.network_mode = MM_NETWORK_MODE_2G_ONLY
+        self.band = MM_NETWORK_BAND_ANY
+        self.apns = [(1, 'internet')]
+        # if set, get_netreg_status answers with it
+        self.netreg_deferred = None
+
+    def _record(self, name, *args):
+        self.calls.append((name,) + args)
+
+    def check_pin(self):
+        self._record('check_pin')
+        return defer.succeed('READY')
+
+    def get_apns(self):
+        self._record('get_apns')
+        return defer.succeed(self.apns[:])
+
+    def set_apn(self, apn):
+        self._record('set_apn', apn)
+        conn_id = max([index for index, _ in self.apns]) + 1
+        self.apns.append((conn_id, apn))
+        self.state_dict['conn_id'] = conn_id
+        return defer.succeed(True)
+
+    def get_band(self):
+        self._record('get_band')
+        return defer.succeed(self.band)
+
+    def set_band(self, band):
+        self._record('set_band', band)
+        self.band = band
+        return defer.succeed(True)
+
+    def get_network_mode(self):
+        self._record('get_network_mode')
+        return defer.succeed(self.network_mode)
+
+    def set_allowed_mode(self, mode):
+        self._record('set_allowed_mode', mode)
+        self.network_mode = MM_NETWORK_MODE_3G_ONLY
+        return defer.succeed(True)
+
+    def get_netreg_info(self):
+        self._record('get_netreg_info')
+        return defer.succeed((self.netreg_status[0][1], self.netid, 'Foo'))
+
+    def register_with_netid(self, netid):
+        self._record('register_with_netid', netid)
+        self.netid = netid
+        return defer.succeed(True)
+
+    def get_netreg_status(self):
+        self._record('get_netreg_status')
+        if self.netreg_deferred is not None:
+            return self.netreg_deferred
+        if len(self.netreg_status) > 1:
+            return defer.succeed(self.netreg_status.pop(0))
+        return defer.succeed(self.netreg_status[0])
+
+    def connect_to_internet(self, settings):
+        self._record('connect_to_internet', settings['number'])
+        return defer.succeed(True)
+
+
+class FakeDevice(object):
+
+    def __init__(self):
+        self.custom = FakeCustom()
+        self.sconn = FakeSerialConnection()
+        self.events = EventBus()
+
+
+class TestSimpleStateMachine(unittest.TestCase):
+    """Tests for wader.common.statem.simple.SimpleStateMachine"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(simple, 'reactor', self.clock)
+        self.patch(events, 'reactor', self.clock)
+        self.device = FakeDevice()
+        self.sconn = self.device.sconn
+
+    def start(self, **settings):
+        self.result = []
+        sm = SimpleStateMachine(self.device, settings)
+        d = sm.start_simple()
+        d.addBoth(self.result.append)
+        return sm
+
+    def names(self):
+        return [call[0] for call in self.sconn.calls]
+
+    def test_already_registered(self):
+        self.start(apn='internet.foo')
+        self.assertEqual(self.result, [True])
+        self.assertEqual(self.names(), ['check_pin', 'get_apns', 'set_apn',
+                                        'get_netreg_status',
+                                        'connect_to_internet'])
+        self.assertEqual(self.sconn.calls[-1][1], '*99***2#')
+
+    def test_registration_driven_by_creg(self):
+        self.sconn.netreg_status = [(1, STATUS_SEARCHING)]
+        self.start()
+        self.assertEqual(self.result, [])
+
+        self.device.events.publish(SIG_CREG, STATUS_HOME)
+        self.clock.advance(0)
+        self.assertEqual(self.result, [True])
+        # no more polling was necessary
+        self.assertEqual(self.names().count('get_netreg_status'), 1)
+        # and no delayed call is left behind
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_registration_poll_fallback(self):
+        self.sconn.netreg_status = [(1, STATUS_SEARCHING), (1, STATUS_HOME)]
+        self.start()
+        self.assertEqual(self.result, [])
+
+        self.clock.advance(simple.INTERVAL)
+        self.assertEqual(self.result, [True])
+        self.assertEqual(self.names().count('get_netreg_status'), 2)
+
+    def test_registration_timeout(self):
+        self.sconn.netreg_status = [(1, STATUS_SEARCHING)]
+        self.start()
+        self.clock.pump([simple.INTERVAL] * (simple.TRIES + 1))
+        self.assertEqual(len(self.result), 1)
+        self.assertTrue(self.result[0].check(E.NoNetwork))
+        self.assertFalse(self.device.events.has_subscribers(SIG_CREG))
+
+    def test_allowed_mode_switch_waits_for_creg(self):
+        # registered, but with the old mode
+        self.start(allowed_mode=MM_ALLOWED_MODE_3G_ONLY)
+        self.assertIn(('set_allowed_mode', MM_ALLOWED_MODE_3G_ONLY),
+                      self.sconn.calls)
+        self.assertEqual(self.result, [])
+
+        # the device drops its registration and registers again
+        self.device.events.publish(SIG_CREG, STATUS_SEARCHING)
+        self.clock.advance(0)
+        self.assertEqual(self.result, [])
+        self.device.events.publish(SIG_CREG, STATUS_HOME)
+        self.clock.advance(0)
+        self.assertEqual(self.result, [True])
+
+    def test_allowed_mode_switch_timeout(self):
+        self.start(allowed_mode=MM_ALLOWED_MODE_3G_ONLY)
+        self.assertEqual(self.result, [])
+
+        # no +CREG at all, trust the status after SWITCH_TIMEOUT
+        self.clock.advance(simple.SWITCH_TIMEOUT)
+        self.assertEqual(self.result, [True])
+
+    def test_allowed_mode_switch_timeout_during_poll(self):
+        self.start(allowed_mode=MM_ALLOWED_MODE_3G_ONLY)
+        # the poll is still waiting for an answer when the switch times out
+        self.sconn.netreg_deferred = defer.Deferred()
+        self.clock.advance(simple.INTERVAL)
+        self.clock.advance(simple.SWITCH_TIMEOUT - simple.INTERVAL)
+        self.assertEqual(self.names().count('get_netreg_status'), 2)
+
+        self.sconn.netreg_deferred.callback((1, STATUS_HOME))
+        self.assertEqual(self.result, [True])
+        self.assertEqual(self.names().count('connect_to_internet'), 1)
+        # no second poll chain is left behind
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_reconnect_skips_redundant_steps(self):
+        settings = dict(apn='internet.foo', band=MM_NETWORK_BAND_U2100,
+                        allowed_mode=MM_ALLOWED_MODE_3G_ONLY,
+                        network_id='21403')
+        self.start(**settings)
+        self.clock.advance(simple.SWITCH_TIMEOUT)
+        self.assertEqual(self.result, [True])
+        first = self.names()
+        for name in ['register_with_netid', 'set_apn', 'set_band',
+                     'set_allowed_mode']:
+            self.assertIn(name, first)
+
+        # reconnect with the very same settings
+        self.sconn.calls = []
+        sm = self.start(**settings)
+        self.assertEqual(self.result, [True])
+        self.assertEqual(self.names(), ['check_pin', 'get_netreg_info',
+                                        'get_apns', 'get_band',
+                                        'get_network_mode',
+                                        'get_netreg_status',
+                                        'connect_to_internet'])
+        # the existing context is used
+        self.assertEqual(self.sconn.calls[-1][1], '*99***2#')
+
+        skipped = [name for name, _, skip in sm.get_phase_timings() if skip]
+        self.assertEqual(skipped, ['register', 'set_apn', 'set_band',
+                                   'set_allowed_mode'])
+
+    def test_phase_timings(self):
+        self.sconn.netreg_status = [(1, STATUS_SEARCHING), (1, STATUS_HOME)]
+        sm = self.start()
+        self.clock.advance(simple.INTERVAL)
+        self.assertEqual(self.result, [True])
+
+        timings = dict((name, secs)
+                       for name, secs, _ in sm.get_phase_timings())
+        self.assertEqual(timings['wait_for_registration'], simple.INTERVAL)
+        self.assertEqual(timings['set_apn'], 0)
+        self.assertEqual([name for name, _, _ in sm.get_phase_timings()],
+                         ['begin', 'check_pin', 'register', 'set_apn',
+                          'set_band', 'set_allowed_mode',
+                          'wait_for_registration', 'connect', 'done'])
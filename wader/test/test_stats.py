@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.stats module
+"""
+
+from twisted.trial import unittest
+
+from wader.common.oses.linux import LinuxPlugin, parse_net_dev
+from wader.common.stats import (IfaceStatsCollector, RingBuffer,
+                                TrafficSeries, SERIES)
+
+NET_DEV = """\
+Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:   84648     886    0    0    0     0          0         0    84648     886    0    0    0     0       0          0
+  eth0:1937421841 1589355    0    0    0     0          0     12345 98233412  694833    0    0    0     0       0          0
+  ppp0:  123456     321    0    0    0     0          0         0    65432     210    0    0    0     0       0          0
+ wwan0:4294967296 3    0    0    0     0          0         0        7       1    0    0    0     0       0          0
+"""
+
+
+class FakeOSPlugin(object):
+    """I count how many times the counters are read"""
+
+    def __init__(self):
+        self.reads = 0
+        self.counters = {'ppp0': (10, 20), 'ppp1': (30, 40)}
+
+    def get_ifaces_stats(self, ifaces):
+        self.reads += 1
+        return dict((i, self.counters.get(i, (0, 0))) for i in ifaces)
+
+
+class TestNetDev(unittest.TestCase):
+
+    def test_parse_net_dev(self):
+        stats = parse_net_dev(NET_DEV)
+        self.assertEqual(stats['lo'], (84648, 84648))
+        # no space between iface name and counters
+        self.assertEqual(stats['eth0'], (1937421841, 98233412))
+        self.assertEqual(stats['ppp0'], (123456, 65432))
+        # counters beyond 32 bits
+        self.assertEqual(stats['wwan0'], (4294967296, 7))
+        self.assertEqual(len(stats), 4)
+
+    def test_get_ifaces_stats_from_fixture(self):
+        path = self.mktemp()
+        fobj = open(path, 'w')
+        fobj.write(NET_DEV)
+        fobj.close()
+
+        plugin = LinuxPlugin()
+        plugin.net_dev_path = path
+        stats = plugin.get_ifaces_stats(['ppp0', 'wwan0', 'ppp9'])
+        self.assertEqual(stats, {'ppp0': (123456, 65432),
+                                 'wwan0': (4294967296, 7),
+                                 'ppp9': (0, 0)})
+
+    def test_get_ifaces_stats_missing_file(self):
+        plugin = LinuxPlugin()
+        plugin.net_dev_path = self.mktemp()
+        self.assertEqual(plugin.get_ifaces_stats(['ppp0']), {'ppp0': (0, 0)})
+
+
+class TestIfaceStatsCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.osobj = FakeOSPlugin()
+        self.collector = IfaceStatsCollector(self.osobj)
+
+    def test_one_pass_for_all_ifaces(self):
+        self.assertEqual(self.collector.get_iface_stats('ppp0'), (10, 20))
+        self.assertEqual(self.collector.get_iface_stats('ppp1'), (30, 40))
+        # a new iface forces a new sample
+        self.assertEqual(self.osobj.reads, 2)
+        # both are served from the same sample now
+        self.collector.get_iface_stats('ppp0')
+        self.collector.get_iface_stats('ppp1')
+        self.assertEqual(self.osobj.reads, 2)
+
+    def test_stale_sample_is_refreshed(self):
+        self.collector.get_iface_stats('ppp0')
+        self.osobj.counters['ppp0'] = (11, 21)
+        self.collector.timestamp -= 1
+        self.assertEqual(self.collector.get_iface_stats('ppp0'), (11, 21))
+        self.assertEqual(self.osobj.reads, 2)
+
+    def test_remove_iface(self):
+        self.collector.get_iface_stats('ppp0')
+        self.collector.get_iface_stats('ppp1')
+        self.collector.remove_iface('ppp0')
+        self.assertEqual(self.collector.sample().keys(), ['ppp1'])
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_keeps_last_items(self):
+        ring = RingBuffer(3)
+        for i in range(5):
+            ring.append(i)
+
+        self.assertEqual(ring.get_items(), [2, 3, 4])
+        self.assertEqual(len(ring), 3)
+
+
+class TestTrafficSeries(unittest.TestCase):
+
+    def test_downsampling(self):
+        series = TrafficSeries()
+        # two full minutes and the first second of the third one
+        for sec in range(121):
+            series.add(sec, sec, 2 * sec)
+
+        self.assertEqual(len(series.get_window(1)), 121)
+        self.assertEqual(series.get_window(60),
+                         [(0, 29, 59), (60, 89, 179)])
+        # the hour is not complete
+        self.assertEqual(series.get_window(3600), [])
+
+    def test_hours(self):
+        series = TrafficSeries()
+        # the second hour completes with the first minute of the third one
+        for sec in range(0, 7261, 10):
+            series.add(sec, 100, 10)
+
+        self.assertEqual(series.get_window(3600),
+                         [(0, 100, 10), (3600, 100, 10)])
+        self.assertEqual(len(series.get_window(60)), 121)
+
+    def test_gaps_are_filled(self):
+        series = TrafficSeries()
+        series.add(100.2, 0, 0)
+        # a 5 second average
+        series.add(105.3, 500, 50)
+        self.assertEqual(series.get_window(1)[-5:],
+                         [(sec, 500, 50) for sec in range(101, 106)])
+
+    def test_constant_memory(self):
+        series = TrafficSeries()
+        for sec in range(0, 3 * 86400, 5):
+            series.add(sec, 1, 1)
+
+        for resolution, size in SERIES[:2]:
+            self.assertEqual(len(series.get_window(resolution)), size)
+
+    def test_window_and_rate(self):
+        series = TrafficSeries()
+        for sec in range(100):
+            series.add(sec, sec, 0)
+
+        window = series.get_window(1, 10)
+        self.assertEqual([v[0] for v in window], range(90, 100))
+        self.assertEqual(series.get_rate(10), (94, 0))
+        self.assertRaises(ValueError, series.get_window, 5)
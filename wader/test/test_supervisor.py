@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.supervisor module
+"""
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+import wader.common.supervisor as supervisor
+from wader.common.supervisor import (ReconnectionSupervisor, BACKOFF_INITIAL,
+                                     BACKOFF_MAX, MAX_FAILURES,
+                                     BREAKER_TIMEOUT)
+
+DEVICE = '/org/freedesktop/ModemManager/Devices/0'
+
+
+class TestReconnectionSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(supervisor, 'reactor', self.clock)
+        self.attempts = []
+        # results of the next reconnection attempts, True means success
+        self.results = []
+        self.supervisor = ReconnectionSupervisor(self.reconnect)
+        self.conf = object()
+
+    def reconnect(self, device_opath, conf):
+        self.attempts.append(self.clock.seconds())
+        if self.results.pop(0):
+            return defer.succeed(True)
+        return defer.fail(RuntimeError("pppd exited with code 8"))
+
+    def test_reconnects_dropped_link(self):
+        self.results = [True]
+        self.supervisor.link_up(DEVICE, self.conf)
+        self.supervisor.link_down(DEVICE)
+        self.clock.advance(BACKOFF_INITIAL)
+
+        self.assertEqual(self.attempts, [BACKOFF_INITIAL])
+        stats = self.supervisor.get_stats(DEVICE)
+        self.assertEqual(stats['reconnections'], 1)
+        self.assertEqual(stats['mean_time_to_reconnect'], BACKOFF_INITIAL)
+        self.assertFalse(stats['circuit_open'])
+
+    def test_exponential_backoff(self):
+        self.results = [False, False, False, True]
+        self.supervisor.link_up(DEVICE, self.conf)
+        self.supervisor.link_down(DEVICE)
+        self.clock.pump([1] * 100)
+
+        delays = [b - a for a, b in zip([0] + self.attempts, self.attempts)]
+        self.assertEqual(delays, [BACKOFF_INITIAL, BACKOFF_INITIAL * 2,
+                                  BACKOFF_INITIAL * 4, BACKOFF_INITIAL * 8])
+        self.assertEqual(self.supervisor.get_mean_time_to_reconnect(DEVICE),
+                         BACKOFF_INITIAL * 15)
+        self.assertEqual(self.supervisor.get_stats(DEVICE)['failures'], 0)
+
+    def test_circuit_breaker(self):
+        self.results = [False] * (MAX_FAILURES + 1) + [True]
+        self.supervisor.link_up(DEVICE, self.conf)
+        self.supervisor.link_down(DEVICE)
+        # enough time to exhaust the backoff, but not the breaker timeout
+        self.clock.pump([1] * (BREAKER_TIMEOUT - 1))
+        self.assertEqual(len(self.attempts), MAX_FAILURES)
+        self.assertTrue(self.supervisor.get_stats(DEVICE)['circuit_open'])
+
+        # while open, one attempt per BREAKER_TIMEOUT
+        last = self.attempts[-1]
+        self.clock.advance(last + BREAKER_TIMEOUT - self.clock.seconds())
+        self.assertEqual(len(self.attempts), MAX_FAILURES + 1)
+        self.assertTrue(self.supervisor.get_stats(DEVICE)['circuit_open'])
+
+        self.clock.advance(BREAKER_TIMEOUT)
+        self.assertEqual(self.attempts[-1], last + 2 * BREAKER_TIMEOUT)
+        stats = self.supervisor.get_stats(DEVICE)
+        self.assertFalse(stats['circuit_open'])
+        self.assertEqual(stats['reconnections'], 1)
+
+    def test_cancel(self):
+        self.supervisor.link_up(DEVICE, self.conf)
+        self.supervisor.link_down(DEVICE)
+        # the user disconnected
+        self.supervisor.cancel(DEVICE)
+        self.clock.advance(BACKOFF_MAX)
+        self.assertEqual(self.attempts, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_unsupervised_device(self):
+        self.supervisor.link_down(DEVICE)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2011  Vodafone España, S.A.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+"""
+tests for the wader.common.timeline module
+"""
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+import wader.common.events as events
+from wader.common.events import EventBus
+from wader.common.signals import SIG_AT_CMD, SIG_CONN_PHASE
+import wader.common.timeline as timeline
+from wader.common.timeline import (ConnectionTimeline, TimelineStore,
+                                   publish_phase)
+
+
+class FakeDevice(object):
+
+    def __init__(self, opath='/org/freedesktop/ModemManager/Devices/0'):
+        self.opath = opath
+        self.events = EventBus()
+
+
+class TestConnectionTimeline(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.patch(events, 'reactor', self.clock)
+        self.patch(timeline, 'reactor', self.clock)
+        self.device = FakeDevice()
+        self.store = TimelineStore(self.mktemp())
+
+    def test_records_phases_and_commands(self):
+        tl = ConnectionTimeline(self.device, self.store)
+        tl.start_recording()
+
+        publish_phase(self.device, 'check_pin')
+        self.device.events.publish(SIG_AT_CMD, 'check_pin', 1000, 1000.5,
+                                   True)
+        self.clock.advance(2)
+        publish_phase(self.device, 'wait_for_registration')
+        self.clock.advance(10)
+        publish_phase(self.device, 'connect')
+        self.clock.advance(1)
+        tl.finish('connected')
+        self.clock.advance(0)
+
+        self.assertEqual(tl.get_phases(),
+                         [('check_pin', 1000, 1002),
+                          ('wait_for_registration', 1002, 1012),
+                          ('connect', 1012, 1013)])
+        self.assertEqual(tl.commands, [('check_pin', 1000, 1000.5, True)])
+        # no longer listening
+        self.assertFalse(self.device.events.has_subscribers(SIG_CONN_PHASE))
+
+        stored = self.store.get_timelines()
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(stored[0]['result'], 'connected')
+        self.assertEqual(stored[0]['end'] - stored[0]['start'], 13)
+
+    def test_events_published_before_finish_are_kept(self):
+        tl = ConnectionTimeline(self.device, self.store)
+        tl.start_recording()
+        publish_phase(self.device, 'ip_config')
+        # finished before the phase is delivered
+        tl.finish('connected')
+        self.clock.advance(0)
+        self.assertEqual(tl.get_phases(), [('ip_config', 1000, 1000)])
+
+
+class TestTimelineStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+
+    def add_timeline(self, store, device, result):
+        tl = ConnectionTimeline(device, store)
+        tl.end = tl.start
+        tl.result = result
+        store.add(tl)
+
+    def test_keeps_last_attempts(self):
+        store = TimelineStore(self.path, size=3)
+        device = FakeDevice()
+        for i in range(5):
+            self.add_timeline(store, device, 'failure %d' % i)
+
+        results = [t['result'] for t in store.get_timelines()]
+        self.assertEqual(results, ['failure 2', 'failure 3', 'failure 4'])
+
+    def test_persisted(self):
+        store = TimelineStore(self.path)
+        self.add_timeline(store, FakeDevice('/dev/0'), 'connected')
+        self.add_timeline(store, FakeDevice('/dev/1'), 'No network')
+
+        store = TimelineStore(self.path)
+        self.assertEqual(len(store.get_timelines()), 2)
+        timelines = store.get_timelines('/dev/1')
+        self.assertEqual([t['result'] for t in timelines], ['No network'])
+
+    def test_corrupt_file_is_discarded(self):
+        fobj = open(self.path, 'w')
+        fobj.write('garbage')
+        fobj.close()
+        self.assertEqual(TimelineStore(self.path).get_timelines(), [])